@@ -1,9 +1,11 @@
-import imp
+import argparse
+import time
 import numpy as np
-from scipy import interpolate
 import imageio
 from tqdm import tqdm
 
+import lut_interp
+
 tLUT_res = (256, 64)
 msLUT_res = (32, 32)
 
@@ -20,15 +22,24 @@ mie_absorption_base = 4.4
 
 ozone_absorption_base = np.array([0.650, 1.881, 0.085])
 
+sun_transmittance_steps = 32
+ms_steps = 20
+sqrt_samples = 8
 
+# The batched bake matches the per-texel reference loops to within this
+# absolute error on every texel (only summation order differs).
+check_tolerance = 1e-9
+
+
+# All helpers below broadcast over leading axes: vectors are (..., 3) arrays
+# and scalars come back as (...) arrays, so a single (3,) vector still works.
 def rayIntersectSphere(ro, rd, rad):
-    b = np.dot(ro, rd)
-    c = np.dot(ro, ro) - rad * rad
-    if c > 0 and b > 0: return -1.0
-    discr = b*b - c
-    if discr < 0: return -1.0
-    if discr > b * b: return (-b + np.sqrt(discr))
-    return -b - np.sqrt(discr)
+    b = np.sum(ro * rd, axis=-1)
+    c = np.sum(ro * ro, axis=-1) - rad * rad
+    discr = b * b - c
+    sqrt_discr = np.sqrt(np.maximum(discr, 0.0))
+    res = np.where(discr > b * b, -b + sqrt_discr, -b - sqrt_discr)
+    return np.where((c > 0) & (b > 0) | (discr < 0), -1.0, res)
 
 
 def getSphericalDir(theta, phi):
@@ -36,7 +47,7 @@ def getSphericalDir(theta, phi):
     sin_phi = np.sin(phi)
     cos_theta = np.cos(theta)
     sin_theta = np.sin(theta)
-    return np.array([sin_phi * sin_theta, cos_phi, sin_phi * cos_theta])
+    return np.stack([sin_phi * sin_theta, cos_phi, sin_phi * cos_theta], axis=-1)
 
 
 def getMiePhase(cos_theta):
@@ -55,148 +66,266 @@ def getRayleighPhase(cos_theta):
 
 
 def getScatteringValues(pos):
-    altitude_KM = max((np.linalg.norm(pos) - ground_radius)*1000.0, -100.0)
+    height = np.sqrt(np.einsum('...i,...i->...', pos, pos))[..., None]
+    altitude_KM = np.maximum((height - ground_radius) * 1000.0, -100.0)
     # Note: Paper gets these switched up.
     rayleigh_density = np.exp(-altitude_KM/8.0)
     mie_density = np.exp(-altitude_KM/1.2)
-    
-    rayleigh_scattering = rayleigh_scattering_base * rayleigh_density
-    rayleigh_absorption = rayleigh_absorption_base * rayleigh_density
-    
+    ozone_density = np.maximum(0.0, 1.0 - np.abs(altitude_KM - 25.0) / 15.0)
+
+    # Density profiles times per-profile coefficients as one small matmul, much
+    # cheaper than broadcasting every term to (..., 3) separately.
+    rayleigh_scattering = rayleigh_density @ rayleigh_scattering_base[None]
     mie_scattering = mie_scattering_base * mie_density
-    mie_absorption = mie_absorption_base * mie_density
-    
-    ozon_absorption = ozone_absorption_base * max(0.0, 1.0 - abs(altitude_KM - 25.0) / 15.0)
-    
-    extinction = rayleigh_scattering + rayleigh_absorption + mie_scattering + mie_absorption + ozon_absorption
+
+    extinction_base = np.stack([
+        rayleigh_scattering_base + rayleigh_absorption_base,
+        np.full(3, mie_scattering_base + mie_absorption_base),
+        ozone_absorption_base,
+    ])
+    extinction = np.concatenate([rayleigh_density, mie_density, ozone_density], axis=-1) @ extinction_base
 
     return rayleigh_scattering, mie_scattering, extinction
 
 
+def getLUTParams(res):
+    # Texel (i, j) -> position on the y axis and sun direction in the yz plane, shape (res[1], res[0], 3).
+    u = np.arange(res[0]) / (res[0] - 1)
+    v = np.arange(res[1]) / (res[1] - 1)
+    sun_cos_theta = 2 * u - 1
+    sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
+    height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
+    pos = np.zeros((res[1], res[0], 3))
+    pos[..., 1] = height[:, None]
+    sun_dir = np.zeros((res[1], res[0], 3))
+    sun_dir[..., 1] = sun_cos_theta
+    sun_dir[..., 2] = sun_sin_theta
+    return pos, sun_dir
+
+
+def getMarchSteps(t_max, steps):
+    # Sample distances (step + 0.3) / steps * t_max and the segment lengths leading to them.
+    t = (np.arange(steps) + 0.3) / steps * t_max[..., None]
+    dt = np.diff(t, axis=-1, prepend=0.0)
+    return t, dt
+
+
 '''=============== Transmittance LUT ==============='''
-tLUT = np.zeros((tLUT_res[1], tLUT_res[0], 3))
-sun_transmittance_steps = 32
+def bake_tLUT():
+    pos, sun_dir = getLUTParams(tLUT_res)
+    ground_hit = rayIntersectSphere(pos, sun_dir, ground_radius) > 0
+    atmo_dist = rayIntersectSphere(pos, sun_dir, atmosphere_radius)
 
-for i in tqdm(range(tLUT_res[1])):
-    for j in tqdm(range(tLUT_res[0]), leave=bool(i == tLUT_res[1] - 1)):
-        u = j / (tLUT_res[0] - 1)
-        v = i / (tLUT_res[1] - 1)
-        sun_cos_theta = 2 * u - 1
-        sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
-        height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
-        pos = np.array([0, height, 0])
-        sun_dir = np.array([0, sun_cos_theta, sun_sin_theta])
-
-        if rayIntersectSphere(pos, sun_dir, ground_radius) > 0:
-            transmittance = np.array([0., 0., 0.])
-        else:
-            atmo_dist = rayIntersectSphere(pos, sun_dir, atmosphere_radius)
-            t = 0.
-            transmittance = np.array([1., 1., 1.])
-            for k in range(sun_transmittance_steps):
-                new_t = (k + 0.3) / sun_transmittance_steps * atmo_dist
-                dt = new_t - t
-                t = new_t
-                new_pos = pos + t * sun_dir
-
-                rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
-
-                transmittance *= np.exp(-dt * extinction)
-        
-        tLUT[i, j] = transmittance
-
-imageio.imwrite('./utils/atmosphere_transmittance.png', (tLUT * 255).astype(np.uint8))
-
-def getValFromTLUT(pos, sun_dir):
-    height = np.linalg.norm(pos)
-    up = pos / height
-    sun_cos_theta = np.dot(sun_dir, up)
+    t, dt = getMarchSteps(atmo_dist, sun_transmittance_steps)
+    new_pos = pos[..., None, :] + t[..., None] * sun_dir[..., None, :]
+    rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
+
+    transmittance = np.exp(-np.sum(dt[..., None] * extinction, axis=-2))
+    transmittance[ground_hit] = 0.0
+    return transmittance
+
+
+def sampleTLUT(tLUT, pos, sun_dir):
+    height = np.linalg.norm(pos, axis=-1)
+    up = pos / height[..., None]
+    sun_cos_theta = np.sum(sun_dir * up, axis=-1)
     u = 0.5 + 0.5 * sun_cos_theta
     v = (height - ground_radius) / (atmosphere_radius - ground_radius)
-    if u < 0 or v < 0 : print(u, v)
-    return interpolate.interpn(
-        points=(np.linspace(0.5 / tLUT_res[1], 1 - 0.5 / tLUT_res[1], tLUT_res[1]), np.linspace(0, 1, tLUT_res[0])),
-        values=tLUT,
-        xi=np.array([v, u]),
-        method='linear',
-        bounds_error=False,
-        fill_value=None
-    )
+    return lut_interp.sample(tLUT, u, v)
 
 
 '''=============== Multiple Scattering LUT ==============='''
-msLUT = np.zeros((msLUT_res[1], msLUT_res[0], 3))
-ms_steps = 20
-sqrt_samples = 8
-
-for i in tqdm(range(msLUT_res[1])):
-    for j in tqdm(range(msLUT_res[0]), leave=bool(i == msLUT_res[1] - 1)):
-        u = j / (msLUT_res[0] - 1)
-        v = i / (msLUT_res[1] - 1)
-        sun_cos_theta = 2 * u - 1
-        sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
-        height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
-        pos = np.array([0, height, 0])
-        sun_dir = np.array([0, sun_cos_theta, sun_sin_theta])
-
-        # Calculates Equation (5) and (7) from the paper.
-        lum_total = 0.0
-        fms = 0.0
-        inv_samples = 1.0 / (sqrt_samples * sqrt_samples)
-        for l in range(sqrt_samples):
-            for m in range(sqrt_samples):
-                # This integral is symmetric about theta = 0 (or theta = PI), so we
-                # only need to integrate from zero to PI, not zero to 2*PI.
-                theta = np.pi * (l + 0.5) / sqrt_samples
-                phi = np.arccos(1.0 - 2.0 * (m + 0.5) / sqrt_samples)
-                ray_dir = getSphericalDir(theta, phi)
-                
-                atmo_dist = rayIntersectSphere(pos, ray_dir, atmosphere_radius)
-                ground_dist = rayIntersectSphere(pos, ray_dir, ground_radius)
-                t_max = atmo_dist if ground_dist <= 0 else ground_dist
-                
-                cos_theta = np.dot(ray_dir, sun_dir)
-        
-                mie_phase_value = getMiePhase(cos_theta)
-                rayleigh_phase_value = getRayleighPhase(cos_theta)
-                
-                lum = 0.0
-                lum_factor = 0.0
-                transmittance = 1.0
-                t = 0.0
-                for step_i in range(ms_steps):
-                    new_t = (step_i + 0.3) / ms_steps * t_max
+def bake_msLUT(tLUT):
+    pos, sun_dir = getLUTParams(msLUT_res)
+    pos = pos[:, :, None, :]
+    sun_dir = sun_dir[:, :, None, :]
+
+    # Calculates Equation (5) and (7) from the paper, all sample directions at once.
+    # This integral is symmetric about theta = 0 (or theta = PI), so we
+    # only need to integrate from zero to PI, not zero to 2*PI.
+    l, m = np.meshgrid(np.arange(sqrt_samples), np.arange(sqrt_samples), indexing='ij')
+    theta = np.pi * (l.reshape(-1) + 0.5) / sqrt_samples
+    phi = np.arccos(1.0 - 2.0 * (m.reshape(-1) + 0.5) / sqrt_samples)
+    ray_dir = getSphericalDir(theta, phi)
+
+    atmo_dist = rayIntersectSphere(pos, ray_dir, atmosphere_radius)
+    ground_dist = rayIntersectSphere(pos, ray_dir, ground_radius)
+    t_max = np.where(ground_dist <= 0, atmo_dist, ground_dist)
+
+    cos_theta = np.sum(ray_dir * sun_dir, axis=-1)[..., None]
+    mie_phase_value = getMiePhase(cos_theta)
+    rayleigh_phase_value = getRayleighPhase(cos_theta)
+
+    t, dt = getMarchSteps(t_max, ms_steps)
+    new_pos = pos[..., None, :] + t[..., None] * ray_dir[..., None, :]
+    rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
+
+    optical_depth = dt[..., None] * extinction
+    sample_transmittance = np.exp(-optical_depth)
+    # Transmittance from the ray origin to the start of each segment.
+    transmittance = np.exp(-(np.cumsum(optical_depth, axis=-2) - optical_depth))
+
+    # Integrate within each segment.
+    scattering_no_phase = rayleigh_scattering + mie_scattering
+    scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
+    lum_factor = np.sum(transmittance * scattering_f, axis=-2)
+
+    # This is slightly different from the paper, but I think the paper has a mistake?
+    # In equation (6), I think S(x,w_s) should be S(x-tv,w_s).
+    sun_transmittance = sampleTLUT(tLUT, new_pos, sun_dir[..., None, :])
+
+    rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value[..., None, :]
+    mie_in_scattering = mie_scattering * mie_phase_value[..., None, :]
+    in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
+
+    # Integrated scattering within path segment.
+    scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
+    lum = np.sum(transmittance * scattering, axis=-2)
+
+    fms = np.mean(lum_factor, axis=-2)
+    lum_total = np.mean(lum, axis=-2)
+    return lum_total / (1.0 - fms)
+
+
+'''=============== Reference (per-texel loops) ==============='''
+def getValFromTLUT(tLUT, pos, sun_dir):
+    height = np.linalg.norm(pos)
+    up = pos / height
+    sun_cos_theta = np.dot(sun_dir, up)
+    u = 0.5 + 0.5 * sun_cos_theta
+    v = (height - ground_radius) / (atmosphere_radius - ground_radius)
+    return lut_interp.sample(tLUT, u, v)
+
+
+def bake_tLUT_reference():
+    tLUT = np.zeros((tLUT_res[1], tLUT_res[0], 3))
+    for i in tqdm(range(tLUT_res[1])):
+        for j in tqdm(range(tLUT_res[0]), leave=bool(i == tLUT_res[1] - 1)):
+            u = j / (tLUT_res[0] - 1)
+            v = i / (tLUT_res[1] - 1)
+            sun_cos_theta = 2 * u - 1
+            sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
+            height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
+            pos = np.array([0, height, 0])
+            sun_dir = np.array([0, sun_cos_theta, sun_sin_theta])
+
+            if rayIntersectSphere(pos, sun_dir, ground_radius) > 0:
+                transmittance = np.array([0., 0., 0.])
+            else:
+                atmo_dist = rayIntersectSphere(pos, sun_dir, atmosphere_radius)
+                t = 0.
+                transmittance = np.array([1., 1., 1.])
+                for k in range(sun_transmittance_steps):
+                    new_t = (k + 0.3) / sun_transmittance_steps * atmo_dist
                     dt = new_t - t
                     t = new_t
-                    new_pos = pos + t * ray_dir
+                    new_pos = pos + t * sun_dir
 
                     rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
 
-                    sample_transmittance = np.exp(-dt * extinction)
-                    
-                    # Integrate within each segment.
-                    scattering_no_phase = rayleigh_scattering + mie_scattering
-                    scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
-                    lum_factor += transmittance * scattering_f
-                    
-                    # This is slightly different from the paper, but I think the paper has a mistake?
-                    # In equation (6), I think S(x,w_s) should be S(x-tv,w_s).
-                    sun_transmittance = getValFromTLUT(new_pos, sun_dir)
-
-                    rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value
-                    mie_in_scattering = mie_scattering * mie_phase_value
-                    in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
-
-                    # Integrated scattering within path segment.
-                    scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
-
-                    lum += transmittance * scattering
-                    transmittance *= sample_transmittance
-            
-                fms += lum_factor * inv_samples
-                lum_total += lum * inv_samples
-        
-        psi = lum_total / (1.0 - fms); 
-        msLUT[i, j] = psi
-
-imageio.imwrite('./utils/atmosphere_multiple_scattering.png', (msLUT * 255).astype(np.uint8))
+                    transmittance *= np.exp(-dt * extinction)
+
+            tLUT[i, j] = transmittance
+    return tLUT
+
+
+def bake_msLUT_reference(tLUT):
+    msLUT = np.zeros((msLUT_res[1], msLUT_res[0], 3))
+    for i in tqdm(range(msLUT_res[1])):
+        for j in tqdm(range(msLUT_res[0]), leave=bool(i == msLUT_res[1] - 1)):
+            u = j / (msLUT_res[0] - 1)
+            v = i / (msLUT_res[1] - 1)
+            sun_cos_theta = 2 * u - 1
+            sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
+            height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
+            pos = np.array([0, height, 0])
+            sun_dir = np.array([0, sun_cos_theta, sun_sin_theta])
+
+            # Calculates Equation (5) and (7) from the paper.
+            lum_total = 0.0
+            fms = 0.0
+            inv_samples = 1.0 / (sqrt_samples * sqrt_samples)
+            for l in range(sqrt_samples):
+                for m in range(sqrt_samples):
+                    # This integral is symmetric about theta = 0 (or theta = PI), so we
+                    # only need to integrate from zero to PI, not zero to 2*PI.
+                    theta = np.pi * (l + 0.5) / sqrt_samples
+                    phi = np.arccos(1.0 - 2.0 * (m + 0.5) / sqrt_samples)
+                    ray_dir = getSphericalDir(theta, phi)
+
+                    atmo_dist = rayIntersectSphere(pos, ray_dir, atmosphere_radius)
+                    ground_dist = rayIntersectSphere(pos, ray_dir, ground_radius)
+                    t_max = atmo_dist if ground_dist <= 0 else ground_dist
+
+                    cos_theta = np.dot(ray_dir, sun_dir)
+
+                    mie_phase_value = getMiePhase(cos_theta)
+                    rayleigh_phase_value = getRayleighPhase(cos_theta)
+
+                    lum = 0.0
+                    lum_factor = 0.0
+                    transmittance = 1.0
+                    t = 0.0
+                    for step_i in range(ms_steps):
+                        new_t = (step_i + 0.3) / ms_steps * t_max
+                        dt = new_t - t
+                        t = new_t
+                        new_pos = pos + t * ray_dir
+
+                        rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
+
+                        sample_transmittance = np.exp(-dt * extinction)
+
+                        # Integrate within each segment.
+                        scattering_no_phase = rayleigh_scattering + mie_scattering
+                        scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
+                        lum_factor += transmittance * scattering_f
+
+                        sun_transmittance = getValFromTLUT(tLUT, new_pos, sun_dir)
+
+                        rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value
+                        mie_in_scattering = mie_scattering * mie_phase_value
+                        in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
+
+                        # Integrated scattering within path segment.
+                        scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
+
+                        lum += transmittance * scattering
+                        transmittance *= sample_transmittance
+
+                    fms += lum_factor * inv_samples
+                    lum_total += lum * inv_samples
+
+            psi = lum_total / (1.0 - fms);
+            msLUT[i, j] = psi
+    return msLUT
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true', help='also run the per-texel reference loops and compare')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tLUT = bake_tLUT()
+    tLUT_time = time.perf_counter() - start
+    start = time.perf_counter()
+    msLUT = bake_msLUT(tLUT)
+    msLUT_time = time.perf_counter() - start
+    print(f'tLUT: {tLUT_time:.3f}s, msLUT: {msLUT_time:.3f}s')
+
+    imageio.imwrite('./utils/atmosphere_transmittance.png', (tLUT * 255).astype(np.uint8))
+    imageio.imwrite('./utils/atmosphere_multiple_scattering.png', (msLUT * 255).astype(np.uint8))
+
+    if args.check:
+        start = time.perf_counter()
+        tLUT_ref = bake_tLUT_reference()
+        tLUT_ref_time = time.perf_counter() - start
+        start = time.perf_counter()
+        msLUT_ref = bake_msLUT_reference(tLUT_ref)
+        msLUT_ref_time = time.perf_counter() - start
+        for name, val, ref, t, t_ref in [('tLUT', tLUT, tLUT_ref, tLUT_time, tLUT_ref_time),
+                                         ('msLUT', msLUT, msLUT_ref, msLUT_time, msLUT_ref_time)]:
+            err = np.abs(val - ref).max()
+            print(f'{name}: max abs error {err:.3e} (tolerance {check_tolerance:.0e}), reference {t_ref:.2f}s, speedup {t_ref / t:.0f}x')
+            assert err <= check_tolerance, f'{name} differs from the reference loop'
@@ -0,0 +1,101 @@
+import dataclasses
+import os
+
+# Backend used to bake the atmosphere LUTs: 'taichi-gpu', 'taichi-cpu' or 'numpy'.
+# Scripts override it with --backend, otherwise ATMO_BACKEND is used.
+backends = ('taichi-gpu', 'taichi-cpu', 'numpy')
+backend = os.environ.get('ATMO_BACKEND', 'taichi-gpu')
+cpu_threads = int(os.environ.get('ATMO_CPU_THREADS', os.cpu_count()))
+# Offline cache of the compiled taichi kernels.
+taichi_cache_dir = os.environ.get('ATMO_TAICHI_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.taichi_cache'))
+
+# Max abs difference allowed between LUTs baked by different backends.
+backend_tolerance = 1e-7
+# Float precision of the taichi bakes, 'f64' or 'f32'. f32 bakes run faster,
+# most of all on GPUs, and are cached apart from f64 ones, see lut_inputs.
+# Overridden by --precision, otherwise ATMO_PRECISION is used.
+precisions = ('f64', 'f32')
+precision = os.environ.get('ATMO_PRECISION', 'f64')
+
+# How the bakes place their steps along a ray, see AtmosphereConfig.integrator.
+integrators = ('uniform', 'importance')
+# How the bakes read the LUTs they depend on, see lut_interp.py.
+lut_filters = ('linear', 'cubic')
+
+# Everything the baked tLUT/msLUT depend on. Configs are frozen so they can be
+# compared, hashed and sent to worker processes; derive variants with
+# dataclasses.replace(default_config, ...).
+@dataclasses.dataclass(frozen=True)
+class AtmosphereConfig:
+    tLUT_res: tuple = (256, 64)
+    msLUT_res: tuple = (32, 32)
+    ms_samples: int = 4096
+    # The multiple scattering samples of a texel are summed in this many tiles.
+    ms_tiles: int = 64
+
+    sun_transmittance_steps: int = 1024
+    ms_steps: int = 128
+    # 'uniform' steps along the rays, or 'importance' sampled steps that follow
+    # the density falloff, which need about a tenth of the steps for the same
+    # accuracy. importance_scale_height (megameters) sets how far they spread.
+    integrator: str = 'uniform'
+    importance_scale_height: float = 0.03
+    # Filter of the tLUT and msLUT lookups of the multiple scattering and
+    # sky-view bakes. 'cubic' about halves the mean lookup error at the same
+    # resolution, python utils/lut_interp.py reports it per resolution.
+    lut_filter: str = 'linear'
+
+    # Units are in megameters.
+    ground_radius: float = 6.360
+    atmosphere_radius: float = 6.460
+
+    # These are per megameter.
+    rayleigh_scattering_base: tuple = (5.802, 13.558, 33.1)
+    rayleigh_absorption_base: float = 0.0
+
+    mie_scattering_base: float = 3.996
+    mie_absorption_base: float = 4.4
+
+    ozone_absorption_base: tuple = (0.650, 1.881, 0.085)
+
+    ground_albedo: float = 0.3
+
+    def __post_init__(self):
+        if self.integrator not in integrators:
+            raise ValueError(f'unknown integrator {self.integrator!r}, expected one of {", ".join(integrators)}')
+        if self.lut_filter not in lut_filters:
+            raise ValueError(f'unknown LUT filter {self.lut_filter!r}, expected one of {", ".join(lut_filters)}')
+
+    def lut_inputs(self, precision='f64'):
+        # Backends agree to within backend_tolerance and ms_tiles only changes
+        # the summation order, so neither is part of it. Uniform bakes keep the
+        # inputs they had before there was a choice of integrator.
+        inputs = dataclasses.asdict(self)
+        del inputs['ms_tiles']
+        if self.integrator == 'uniform':
+            del inputs['integrator'], inputs['importance_scale_height']
+        # precision is the one the bake ran at, see atmosphere_lut.bake_precision.
+        # f32 bakes differ by more than backend_tolerance, f64 ones keep their inputs.
+        if check_precision(precision) != 'f64':
+            inputs['precision'] = precision
+        return dict(lut_version=lut_version, **inputs)
+
+
+default_config = AtmosphereConfig()
+
+
+def check_backend(name):
+    if name not in backends:
+        raise ValueError(f'unknown atmosphere backend {name!r}, expected one of {", ".join(backends)}')
+    return name
+
+
+def check_precision(name):
+    if name not in precisions:
+        raise ValueError(f'unknown bake precision {name!r}, expected one of {", ".join(precisions)}')
+    return name
+
+
+# Bump when the LUT kernels change in a way that changes their output, so
+# cached LUTs from older kernels are not reused.
+lut_version = 2
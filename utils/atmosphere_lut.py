@@ -0,0 +1,198 @@
+import argparse
+import dataclasses
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import imageio
+
+import atmosphere_config as cfg
+import lut_cache
+
+transmittance_png_path = './utils/atmosphere_transmittance.png'
+multiple_scattering_png_path = './utils/atmosphere_multiple_scattering.png'
+# Running sums of an interrupted progressive bake, see bake_luts_progressive.
+ms_checkpoint_path = './utils/ms_checkpoint.npz'
+
+
+def bake_luts(config=None, backend=None, rebuild=False):
+    # Returns (tLUT, msLUT) of config, by default cfg.default_config, in data
+    # texture layout, i.e. (v, u, 3). LUTs baked earlier with the same inputs
+    # come from lut_cache unless rebuild is set.
+    config = config or cfg.default_config
+    key = lut_cache.cache_key(lut_inputs(config, backend))
+    if not rebuild:
+        luts = lut_cache.load(key, ['tLUT', 'msLUT'])
+        if luts is not None:
+            return luts
+    tLUT, msLUT = bake_luts_uncached(config, backend)
+    lut_cache.store(key, tLUT=tLUT, msLUT=msLUT)
+    write_previews(tLUT, msLUT)
+    return tLUT, msLUT
+
+
+def bake_precision(backend=None):
+    # The precision backend bakes at. numpy always bakes in f64, taichi in the
+    # precision it was initialized with, which is cfg.precision until then.
+    if cfg.check_backend(backend or cfg.backend) == 'numpy':
+        return 'f64'
+    atmosphere_taichi = sys.modules.get('atmosphere_taichi')
+    if atmosphere_taichi is not None and atmosphere_taichi.precision is not None:
+        return atmosphere_taichi.precision
+    return cfg.check_precision(cfg.precision)
+
+
+def lut_inputs(config=None, backend=None):
+    # The lut_cache inputs of config baked by backend.
+    return (config or cfg.default_config).lut_inputs(bake_precision(backend))
+
+
+def bake_luts_uncached(config=None, backend=None):
+    config = config or cfg.default_config
+    backend = cfg.check_backend(backend or cfg.backend)
+    if backend == 'numpy':
+        import atmosphere_numpy
+        return atmosphere_numpy.bake_luts(config)
+    # atmosphere_taichi picks its arch from cfg.backend on first use.
+    cfg.backend = backend
+    import atmosphere_taichi
+    return atmosphere_taichi.bake_luts(config)
+
+
+def bake_luts_progressive(config=None, backend=None, chunks=16, checkpoint=ms_checkpoint_path, tolerance=0.0):
+    # Bakes with the taichi backend, the msLUT in resumable chunks, see
+    # atmosphere_taichi.bake_multiscatter_progressive. Only a bake that ran
+    # every chunk is the bake of config and goes into lut_cache.
+    config = config or cfg.default_config
+    cfg.backend = backend or cfg.backend
+    if cfg.check_backend(cfg.backend) == 'numpy':
+        raise ValueError('progressive bakes need a taichi backend')
+    import atmosphere_taichi
+    tLUT = atmosphere_taichi.bake_transmittance(config)
+    msLUT, samples = atmosphere_taichi.bake_multiscatter_progressive(config, tLUT, chunks, checkpoint, tolerance)
+    if samples == config.ms_samples:
+        lut_cache.store(lut_cache.cache_key(config.lut_inputs(atmosphere_taichi.precision)), tLUT=tLUT, msLUT=msLUT)
+        write_previews(tLUT, msLUT)
+    else:
+        print(f'stopped at {samples} of {config.ms_samples} samples, the LUTs are not cached')
+    return tLUT, msLUT
+
+
+def write_previews(tLUT, msLUT):
+    # Top of the atmosphere at the top of the image.
+    for lut, path in [(tLUT, transmittance_png_path), (msLUT * 5, multiple_scattering_png_path)]:
+        imageio.imwrite(path, (np.clip(lut[::-1], 0, 1) * 255).astype(np.uint8))
+
+
+def compare_backends(backends):
+    # Each backend bakes in its own process, a taichi arch can only be initialized once per module import.
+    luts = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in backends:
+            path = os.path.join(tmp, f'{backend}.npz')
+            subprocess.run([sys.executable, __file__, '--backend', backend, '--precision', cfg.precision, '--rebuild', '--dump', path],
+                           check=True)
+            luts[backend] = np.load(path)
+    ok = True
+    ref = backends[0]
+    for backend in backends[1:]:
+        for name in ['tLUT', 'msLUT']:
+            err = np.abs(luts[backend][name] - luts[ref][name]).max()
+            ok &= err <= cfg.backend_tolerance
+            print(f'{name}: {backend} vs {ref}: max abs error {err:.3e} (tolerance {cfg.backend_tolerance:.0e})')
+    return ok
+
+
+def bake_at_precision(precision, backend, config):
+    # Runs in a fresh process, see compare_precisions. Returns the tLUT, msLUT
+    # and sky-view preview baked at precision, as float64, and the seconds of
+    # every kernel. The kernels are compiled on a cheap config first, so the
+    # times are bake time only.
+    cfg.backend, cfg.precision = backend, precision
+    import taichi as ti
+    import atmosphere_taichi
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = atmosphere_taichi.lut_fields(config)
+    kernels = {
+        'cal_tLUT': lambda: atmosphere_taichi.cal_tLUT(tLUT),
+        'cal_ms_buffer': lambda: atmosphere_taichi.cal_ms_buffer(tLUT, ms_buffer_lum, ms_buffer_fms),
+        'sum_ms_buffer': lambda: atmosphere_taichi.sum_ms_buffer(ms_buffer_lum, ms_buffer_fms, msLUT),
+        'cal_skyLUT': lambda: atmosphere_taichi.cal_skyLUT(tLUT, msLUT, atmosphere_taichi.sun_angle,
+                                                            atmosphere_taichi.view_height, 1),
+    }
+    atmosphere_taichi.set_params(dataclasses.replace(config, sun_transmittance_steps=1, ms_steps=1, ms_samples=config.ms_tiles))
+    for bake in kernels.values():
+        bake()
+    ti.sync()
+    atmosphere_taichi.set_params(config)
+    seconds = {}
+    for name, bake in kernels.items():
+        start = time.perf_counter()
+        bake()
+        ti.sync()
+        seconds[name] = time.perf_counter() - start
+    luts = dict(tLUT=tLUT.to_numpy(), msLUT=msLUT.to_numpy(), skyLUT=atmosphere_taichi.skyLUT.to_numpy())
+    return {name: lut.astype(np.float64) for name, lut in luts.items()}, seconds
+
+
+def compare_precisions(backend, config=None):
+    # Bakes at every precision, each in its own process, and reports the
+    # speedup of every kernel and the error of every LUT against f64, as abs
+    # errors relative to the peak of the f64 LUT. Returns the max errors.
+    config = config or cfg.default_config
+    # Spawned rather than forked, taichi runtimes do not survive a fork.
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for precision in cfg.precisions:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            results[precision] = pool.submit(bake_at_precision, precision, backend, config).result()
+    ref, ref_seconds = results['f64']
+    max_errors = {}
+    for precision in cfg.precisions[1:]:
+        luts, seconds = results[precision]
+        print(f'{"kernel":<16} {"f64 ms":>10} {f"{precision} ms":>10} {"speedup":>8}')
+        for name in [*seconds, 'total']:
+            before = sum(ref_seconds.values()) if name == 'total' else ref_seconds[name]
+            after = sum(seconds.values()) if name == 'total' else seconds[name]
+            print(f'{name:<16} {before * 1000:>10.1f} {after * 1000:>10.1f} {before / after:>7.2f}x')
+        print(f'{"LUT":<16} {"max err":>10} {"mean err":>10}')
+        for name in ref:
+            err = np.abs(luts[name] - ref[name]) / np.abs(ref[name]).max()
+            max_errors[precision, name] = err.max()
+            print(f'{name:<16} {err.max():>10.2e} {err.mean():>10.2e}')
+    return max_errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends, default=cfg.backend)
+    parser.add_argument('--precision', choices=cfg.precisions, default=cfg.precision, help='float precision of the taichi bakes')
+    parser.add_argument('--compare-precision', action='store_true', help='bake at every precision and compare their speed and error')
+    parser.add_argument('--dump', help='write the baked LUTs to this .npz file')
+    parser.add_argument('--rebuild', action='store_true', help='bake even if the LUTs are cached')
+    parser.add_argument('--compare', nargs='+', choices=cfg.backends, help='bake with each backend and compare them')
+    parser.add_argument('--chunks', type=int, help='bake the msLUT progressively in this many chunks of samples')
+    parser.add_argument('--checkpoint', default=ms_checkpoint_path, help='running sums of a progressive bake, resumed if present')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='stop a progressive bake once a chunk changes the msLUT by less')
+    args = parser.parse_args()
+
+    cfg.precision = args.precision
+    if args.compare_precision:
+        if args.backend == 'numpy':
+            parser.error('--compare-precision needs a taichi backend')
+        compare_precisions(args.backend)
+        sys.exit()
+    if args.compare:
+        sys.exit(0 if compare_backends(args.compare) else 1)
+    if args.chunks:
+        if args.backend == 'numpy':
+            parser.error('--chunks needs a taichi backend')
+        tLUT, msLUT = bake_luts_progressive(backend=args.backend, chunks=args.chunks, checkpoint=args.checkpoint,
+                                            tolerance=args.tolerance)
+    else:
+        tLUT, msLUT = bake_luts(backend=args.backend, rebuild=args.rebuild)
+    if args.dump:
+        np.savez(args.dump, tLUT=tLUT, msLUT=msLUT)
@@ -0,0 +1,199 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import atmosphere_config as cfg
+import lut_interp
+from atmosphere import rayIntersectSphere, getMiePhase, getRayleighPhase
+
+# NumPy port of the kernels in atmosphere_taichi.py. It follows them step by
+# step (texel mapping, sample directions, clamps and LUT lookups) so the LUTs
+# agree with the taichi backends to within cfg.backend_tolerance. LUTs are
+# baked for a cfg.AtmosphereConfig and returned in data texture layout, i.e.
+# (v, u, 3).
+
+
+def getSphericalDir(theta, cos_phi):
+    sin_phi = np.sqrt(1 - cos_phi * cos_phi)
+    return np.stack([sin_phi * np.sin(theta), cos_phi, sin_phi * np.cos(theta)], axis=-1)
+
+
+def getScatteringValues(config, pos):
+    altitude_KM = np.maximum((np.linalg.norm(pos, axis=-1, keepdims=True) - config.ground_radius) * 1000.0, -100.0)
+    # Note: Paper gets these switched up.
+    rayleigh_density = np.minimum(np.exp(-altitude_KM/8.0), 10)
+    mie_density = np.minimum(np.exp(-altitude_KM/1.2), 10)
+
+    rayleigh_scattering = np.array(config.rayleigh_scattering_base) * rayleigh_density
+    rayleigh_absorption = config.rayleigh_absorption_base * rayleigh_density
+
+    mie_scattering = config.mie_scattering_base * mie_density
+    mie_absorption = config.mie_absorption_base * mie_density
+
+    ozon_absorption = np.array(config.ozone_absorption_base) * np.maximum(0.0, 1.0 - np.abs(altitude_KM - 25.0) / 15.0)
+
+    extinction = rayleigh_scattering + rayleigh_absorption + mie_scattering + mie_absorption + ozon_absorption
+
+    return rayleigh_scattering, mie_scattering, extinction
+
+
+def getValFromTLUT(config, tLUT, pos, sun_dir):
+    height = np.linalg.norm(pos, axis=-1)
+    up = pos / height[..., None]
+    u, v = lut_interp.lut_uv(config, height, np.sum(sun_dir * up, axis=-1))
+    return lut_interp.sample(tLUT, u, v, config.lut_filter)
+
+
+def getTexelParams(config, i, j, res):
+    u, v = np.broadcast_arrays(i / (res[0] - 1), j / (res[1] - 1))
+    sun_cos_theta = 2 * u - 1
+    sun_sin_theta = np.sqrt(1 - sun_cos_theta * sun_cos_theta)
+    height = config.ground_radius + 1e-6 + v * (config.atmosphere_radius - config.ground_radius - 2e-6)
+    pos = np.stack([np.zeros_like(u), height, np.zeros_like(u)], axis=-1)
+    sun_dir = np.stack([np.zeros_like(u), sun_cos_theta, sun_sin_theta], axis=-1)
+    return pos, sun_dir
+
+
+def getMarchParams(config, pos, ray_dir, t_max):
+    # See march_params in atmosphere_taichi.py.
+    t_c = np.minimum(np.maximum(-np.sum(pos * ray_dir, axis=-1), 0.0), t_max)
+    ground_dist = rayIntersectSphere(pos, ray_dir, config.ground_radius)
+    t_c = np.where(ground_dist > 0.0, np.minimum(t_c, ground_dist), t_c)
+    pos_c = pos + t_c[..., None] * ray_dir
+    r_c = np.maximum(np.linalg.norm(pos_c, axis=-1), 1e-9)
+    mu_c = np.abs(np.sum(pos_c * ray_dir, axis=-1)) / r_c
+    h = config.importance_scale_height
+    scale = np.sqrt(r_c * mu_c * r_c * mu_c + h * (2 * r_c + h)) - r_c * mu_c
+    mass_0 = 1 - np.exp(-t_c / scale)
+    mass_1 = 1 - np.exp(-(t_max - t_c) / scale)
+    return t_c, scale, mass_0, mass_1
+
+
+def getMarchT(t_max, t_c, scale, mass_0, mass_1, x):
+    # See march_t in atmosphere_taichi.py, x is broadcast against the trailing axis.
+    t_max, t_c, scale, mass_0, mass_1 = (a[..., None] for a in (t_max, t_c, scale, mass_0, mass_1))
+    split = mass_0 / np.maximum(mass_0 + mass_1, 1e-300)
+    y_0 = (split - x) / np.maximum(split, 1e-300)
+    y_1 = (x - split) / np.maximum(1 - split, 1e-300)
+    t_0 = t_c - np.minimum(t_c, -scale * np.log(np.maximum(1 - y_0 * mass_0, 1e-300)))
+    t_1 = t_c + np.minimum(t_max - t_c, -scale * np.log(np.maximum(1 - y_1 * mass_1, 1e-300)))
+    return np.where(x < split, t_0, t_1)
+
+
+def getMarchSteps(config, pos, ray_dir, t_max, steps):
+    # Sample distances and segment lengths of the steps along the rays.
+    if config.integrator == 'importance':
+        params = getMarchParams(config, pos, ray_dir, t_max)
+        t = getMarchT(t_max, *params, (np.arange(steps) + 0.5) / steps)
+        dt = np.diff(getMarchT(t_max, *params, np.arange(steps + 1) / steps), axis=-1)
+        return t, dt
+    t = (np.arange(steps) + 0.3) / steps * t_max[..., None]
+    dt = np.diff(t, axis=-1, prepend=0.0)
+    return t, dt
+
+
+# State of the worker processes, see _map.
+_config = None
+_tLUT = None
+
+
+def _set_state(config, tLUT=None):
+    global _config, _tLUT
+    _config = config
+    _tLUT = tLUT
+
+
+'''=============== Transmittance LUT ==============='''
+def cal_tLUT_row(j):
+    config = _config
+    pos, sun_dir = getTexelParams(config, np.arange(config.tLUT_res[0]), j, config.tLUT_res)
+    atmo_dist = rayIntersectSphere(pos, sun_dir, config.atmosphere_radius)
+    t, dt = getMarchSteps(config, pos, sun_dir, atmo_dist, config.sun_transmittance_steps)
+    new_pos = pos[:, None] + t[..., None] * sun_dir[:, None]
+    rayleigh_scattering, mie_scattering, extinction = getScatteringValues(config, new_pos)
+    return np.exp(-np.sum(dt[..., None] * extinction, axis=-2))
+
+
+'''=============== Multiple Scattering LUT ==============='''
+def cal_ms_texel(ij):
+    # Returns the sample-averaged (lum, fms) of one msLUT texel.
+    config = _config
+    pos, sun_dir = getTexelParams(config, ij[0], ij[1], config.msLUT_res)
+
+    # This integral is symmetric about theta = 0 (or theta = PI), so we
+    # only need to integrate from zero to PI, not zero to 2*PI.
+    l = np.arange(config.ms_samples, dtype=np.float64)
+    theta = l * (np.sqrt(5) - 1) / 2
+    theta = theta - np.floor(theta)
+    theta = theta * np.pi
+    cos_phi = l / (config.ms_samples - 1)
+    cos_phi = 2 * cos_phi - 1
+    ray_dir = getSphericalDir(theta, cos_phi)
+
+    atmo_dist = rayIntersectSphere(pos, ray_dir, config.atmosphere_radius)
+    ground_dist = rayIntersectSphere(pos, ray_dir, config.ground_radius)
+    t_max = np.where(ground_dist <= 0, atmo_dist, np.minimum(ground_dist + 1, atmo_dist))
+
+    cos_theta = np.sum(ray_dir * sun_dir, axis=-1)[:, None, None]
+    mie_phase_value = getMiePhase(cos_theta)
+    rayleigh_phase_value = getRayleighPhase(cos_theta)
+
+    t, dt = getMarchSteps(config, pos, ray_dir, t_max, config.ms_steps)
+    new_pos = pos + t[..., None] * ray_dir[:, None]
+    rayleigh_scattering, mie_scattering, extinction = getScatteringValues(config, new_pos)
+
+    sample_transmittance = np.exp(-dt[..., None] * extinction)
+    # Transmittance from the ray origin to the start of each segment, then past the last one.
+    cum_transmittance = np.cumprod(sample_transmittance, axis=-2)
+    transmittance = np.concatenate([np.ones_like(cum_transmittance[:, :1]), cum_transmittance[:, :-1]], axis=-2)
+
+    # Integrate within each segment.
+    scattering_no_phase = rayleigh_scattering + mie_scattering
+    scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
+    lum_factor = np.sum(transmittance * scattering_f, axis=-2)
+
+    # This is slightly different from the paper, but I think the paper has a mistake?
+    # In equation (6), I think S(x,w_s) should be S(x-tv,w_s).
+    sun_transmittance = getValFromTLUT(config, _tLUT, new_pos, sun_dir)
+
+    rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value
+    mie_in_scattering = mie_scattering * mie_phase_value
+    in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
+
+    # Integrated scattering within path segment.
+    scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
+    lum = np.sum(transmittance * scattering, axis=-2)
+
+    ground_hit = ground_dist > 0.0
+    hit_pos = pos + ground_dist[ground_hit, None] * ray_dir[ground_hit]
+    hit_pos = hit_pos / np.linalg.norm(hit_pos, axis=-1, keepdims=True) * config.ground_radius
+    lum[ground_hit] += cum_transmittance[ground_hit, -1] * config.ground_albedo * getValFromTLUT(config, _tLUT, hit_pos, sun_dir)
+
+    inv_samples = 1.0 / config.ms_samples
+    return np.sum(lum * inv_samples, axis=0), np.sum(lum_factor * inv_samples, axis=0)
+
+
+def _map(fn, items, initializer=None, initargs=()):
+    # Spread the work over cfg.cpu_threads processes; numpy itself stays single-threaded here.
+    if cfg.cpu_threads <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return list(map(fn, items))
+    with ProcessPoolExecutor(cfg.cpu_threads, initializer=initializer, initargs=initargs) as pool:
+        return list(pool.map(fn, items, chunksize=max(1, len(items) // (4 * cfg.cpu_threads))))
+
+
+def cal_tLUT(config):
+    return np.stack(_map(cal_tLUT_row, list(range(config.tLUT_res[1])), _set_state, (config,)))
+
+
+def cal_msLUT(config, tLUT):
+    texels = [(i, j) for j in range(config.msLUT_res[1]) for i in range(config.msLUT_res[0])]
+    lum, fms = map(np.array, zip(*_map(cal_ms_texel, texels, _set_state, (config, tLUT))))
+    psi = lum / (1.0 - fms)
+    return psi.reshape(config.msLUT_res[1], config.msLUT_res[0], 3)
+
+
+def bake_luts(config=cfg.default_config):
+    tLUT = cal_tLUT(config)
+    msLUT = cal_msLUT(config, tLUT)
+    return tLUT, msLUT
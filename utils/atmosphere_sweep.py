@@ -0,0 +1,129 @@
+import argparse
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import atmosphere_config as cfg
+import atmosphere_lut
+import data
+import lut_cache
+
+# Bakes the atmosphere LUTs for every combination of the swept parameters and
+# writes one data texture per variant, e.g.
+#   python utils/atmosphere_sweep.py --param mie_scattering_base 3 4 5 \
+#       --param ozone_absorption_base 0.650,1.881,0.085 0.7,2.0,0.1
+# Variants are baked concurrently, one per worker process.
+sweep_dir = './utils/sweep'
+
+
+def parse_value(field, text):
+    if field.type is tuple:
+        return tuple(float(x) for x in text.split(','))
+    return field.type(text)
+
+
+def sweep_configs(params, base=cfg.default_config):
+    # params is a list of (name, [value text, ...]); returns one config per combination.
+    fields = {field.name: field for field in dataclasses.fields(cfg.AtmosphereConfig)}
+    for name, values in params:
+        if name not in fields:
+            raise ValueError(f'unknown atmosphere parameter {name!r}, expected one of {", ".join(fields)}')
+    names = [name for name, values in params]
+    choices = [[parse_value(fields[name], text) for text in values] for name, values in params]
+    return [dataclasses.replace(base, **dict(zip(names, combination))) for combination in itertools.product(*choices)]
+
+
+def _init_worker(backend, cpu_threads, precision):
+    cfg.backend = backend
+    cfg.precision = precision
+    cfg.cpu_threads = cpu_threads
+
+
+def bake_variant(config):
+    # Runs in a worker. The first bake of a taichi worker includes compiling the kernels.
+    start = time.perf_counter()
+    tLUT, msLUT = atmosphere_lut.bake_luts_uncached(config)
+    return tLUT, msLUT, time.perf_counter() - start, os.getpid()
+
+
+def run_sweep(configs, backend, workers, data_format='float32', out_dir=sweep_dir, rebuild=False):
+    os.makedirs(out_dir, exist_ok=True)
+    fmt = data.data_formats[data_format]
+    precision = atmosphere_lut.bake_precision(backend)
+    keys = [lut_cache.cache_key(config.lut_inputs(precision)) for config in configs]
+    results = [dict(index=index, file=f'data_{index:03d}.bin', status='cached', bake_seconds=0.0, worker=None)
+               for index in range(len(configs))]
+    todo = [index for index in range(len(configs)) if rebuild or lut_cache.load(keys[index], ['tLUT', 'msLUT']) is None]
+
+    def write_variant(index):
+        start = time.perf_counter()
+        raw = data.encode(data.build_data(configs[index]), fmt)
+        data.write_data(raw, os.path.join(out_dir, results[index]['file']))
+        results[index]['write_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(len(configs)):
+        if index not in todo:
+            write_variant(index)
+    if todo:
+        # Split the cores between the workers instead of letting every worker use all of them.
+        cpu_threads = max(1, cfg.cpu_threads // workers)
+        # Spawned rather than forked workers, taichi runtimes do not survive a fork.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(backend, cpu_threads, precision)) as pool:
+            futures = {pool.submit(bake_variant, configs[index]): index for index in todo}
+            for future in as_completed(futures):
+                index = futures[future]
+                tLUT, msLUT, seconds, pid = future.result()
+                lut_cache.store(keys[index], tLUT=tLUT, msLUT=msLUT)
+                results[index].update(status='baked', bake_seconds=seconds, worker=pid)
+                write_variant(index)
+    wall_seconds = time.perf_counter() - start
+
+    changed = [name for name in cfg.AtmosphereConfig.__dataclass_fields__
+               if len({getattr(config, name) for config in configs}) > 1]
+    for config, result in zip(configs, results):
+        result['params'] = {name: getattr(config, name) for name in changed}
+        result['lut_inputs'] = config.lut_inputs(precision)
+    with open(os.path.join(out_dir, 'variants.json'), 'w') as fout:
+        json.dump(dict(backend=backend, workers=workers, format=data_format, height=data.data_height,
+                       wall_seconds=wall_seconds, variants=results), fout, indent=2)
+    print_summary(results, changed, wall_seconds)
+    return results
+
+
+def print_summary(results, changed, wall_seconds):
+    def format_value(value):
+        return ','.join(f'{x:g}' for x in value) if isinstance(value, tuple) else f'{value:g}'
+
+    widths = [max([len(name)] + [len(format_value(result['params'][name])) for result in results]) for name in changed]
+    print(f'{"#":>3}  ' + '  '.join(f'{name:<{width}}' for name, width in zip(changed, widths))
+          + f'  {"status":<6} {"bake s":>8} {"write ms":>9}  file')
+    for result in results:
+        print(f'{result["index"]:>3}  '
+              + '  '.join(f'{format_value(result["params"][name]):<{width}}' for name, width in zip(changed, widths))
+              + f'  {result["status"]:<6} {result["bake_seconds"]:>8.2f} {result["write_seconds"] * 1000:>9.1f}  {result["file"]}')
+    bake_seconds = sum(result['bake_seconds'] for result in results)
+    print(f'{len(results)} variants in {wall_seconds:.2f} s wall, {bake_seconds:.2f} s of baking'
+          + (f' ({bake_seconds / wall_seconds:.2f}x concurrency)' if bake_seconds > 0 else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--param', nargs='+', action='append', required=True, metavar=('NAME', 'VALUE'),
+                        help='config field and the values to sweep, vectors as comma separated components')
+    parser.add_argument('--backend', choices=cfg.backends, default='taichi-cpu')
+    parser.add_argument('--workers', type=int, default=cfg.cpu_threads, help='variants baked concurrently')
+    parser.add_argument('--format', choices=data.data_formats, default='float32', help='storage format of the data textures')
+    parser.add_argument('--out', default=sweep_dir, help='directory for the data textures and variants.json')
+    parser.add_argument('--rebuild', action='store_true', help='rebake variants even if they are cached')
+    args = parser.parse_args()
+    if any(len(param) < 2 for param in args.param):
+        parser.error('--param needs a config field and at least one value')
+
+    configs = sweep_configs([(param[0], param[1:]) for param in args.param])
+    run_sweep(configs, args.backend, max(1, min(args.workers, len(configs))), args.format, args.out, args.rebuild)
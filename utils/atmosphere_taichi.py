@@ -1,41 +1,113 @@
+import argparse
+import hashlib
+import os
+import time
 import numpy as np
 import taichi as ti
-from scipy import interpolate
-import imageio
-from tqdm import tqdm
 
-ti.init(arch=ti.gpu, default_fp =ti.f64)  # Try to run on GPU
-
-vec3f = ti.types.matrix(3, 1, ti.f64)
-vec2f = ti.types.matrix(2, 1, ti.f64)
-
-tLUT_res = (256, 64)
-msLUT_res = (32, 32)
-ms_samples = 4096
-
-tLUT = vec3f.field(shape=(tLUT_res[0], tLUT_res[1]))
-ms_buffer_lum = vec3f.field(shape=(msLUT_res[0], msLUT_res[1], ms_samples))
-ms_buffer_fms = vec3f.field(shape=(msLUT_res[0], msLUT_res[1], ms_samples))
-msLUT = vec3f.field(shape=(msLUT_res[0], msLUT_res[1]))
-
-# Units are in megameters.
-ground_radius = 6.360
-atmosphere_radius = 6.460
-
-# These are per megameter.
-rayleigh_scattering_base = vec3f(5.802, 13.558, 33.1)
-rayleigh_absorption_base = 0.0
-
-mie_scattering_base = 3.996
-mie_absorption_base = 4.4
-
-ozone_absorption_base = vec3f(0.650, 1.881, 0.085)
-
-ground_albedo = 0.3
+import atmosphere_config as cfg
+import lut_cache
+
+# Types and fields created by init. Kernels use float, which is the precision
+# taichi was initialized with.
+vec3f = None
+vec2f = None
+MarchParams = None
+atmo = None
+skyLUT = None
+# Precision taichi was initialized with, and the smallest positive float of
+# it, the lower bound of divisors and logs.
+precision = None
+tiny = None
+float_dtypes = dict(f64=np.float64, f32=np.float32)
+
+
+def init(backend=None):
+    # Initializes taichi for backend, by default cfg.backend, on first use
+    # rather than at import. The kernels are shared by both taichi backends,
+    # only the arch differs; the numpy backend has no taichi kernels, so this
+    # module runs on the CPU then. Compiled kernels are kept in
+    # cfg.taichi_cache_dir, so later processes skip most of the JIT. Like the
+    # arch, the precision of cfg.precision is fixed for the process.
+    global vec3f, vec2f, MarchParams, atmo, skyLUT, precision, tiny
+    if atmo is not None:
+        return
+    precision = cfg.check_precision(cfg.precision)
+    options = dict(default_fp=getattr(ti, precision), offline_cache=True, offline_cache_file_path=cfg.taichi_cache_dir)
+    if cfg.check_backend(backend or cfg.backend) == 'taichi-gpu':
+        ti.init(arch=ti.gpu, **options)  # Falls back to CPU if there is no GPU
+    else:
+        ti.init(arch=ti.cpu, cpu_max_num_threads=cfg.cpu_threads, **options)
+    vec3f = ti.types.vector(3, float)
+    vec2f = ti.types.vector(2, float)
+    # Importance sampled steps of a march, see march_params.
+    MarchParams = ti.types.struct(t_max=float, t_c=float, scale=float, mass_0=float, mass_1=float)
+    # Physical parameters and sample counts of the config being baked, see
+    # set_params. They live in a field rather than in Python globals so the
+    # kernels are compiled once and rebaked for every config of a sweep.
+    AtmosphereParams = ti.types.struct(
+        ground_radius=float,
+        atmosphere_radius=float,
+        rayleigh_scattering_base=vec3f,
+        rayleigh_absorption_base=float,
+        mie_scattering_base=float,
+        mie_absorption_base=float,
+        ozone_absorption_base=vec3f,
+        ground_albedo=float,
+        sun_transmittance_steps=ti.i32,
+        ms_steps=ti.i32,
+        ms_samples=ti.i32,
+        ms_tile_size=ti.i32,
+        importance=ti.i32,
+        importance_scale_height=float,
+        lut_filter=ti.i32,
+    )
+    tiny = float(np.finfo(float_dtypes[precision]).tiny)
+    atmo = AtmosphereParams.field(shape=())
+    skyLUT = vec3f.field(shape=skyLUT_res)
+
+
+def set_params(config):
+    init()
+    atmo[None] = dict(
+        ground_radius=config.ground_radius,
+        atmosphere_radius=config.atmosphere_radius,
+        rayleigh_scattering_base=config.rayleigh_scattering_base,
+        rayleigh_absorption_base=config.rayleigh_absorption_base,
+        mie_scattering_base=config.mie_scattering_base,
+        mie_absorption_base=config.mie_absorption_base,
+        ozone_absorption_base=config.ozone_absorption_base,
+        ground_albedo=config.ground_albedo,
+        sun_transmittance_steps=config.sun_transmittance_steps,
+        ms_steps=config.ms_steps,
+        ms_samples=config.ms_samples,
+        ms_tile_size=(config.ms_samples + config.ms_tiles - 1) // config.ms_tiles,
+        importance=config.integrator == 'importance',
+        importance_scale_height=config.importance_scale_height,
+        lut_filter=cfg.lut_filters.index(config.lut_filter),
+    )
+
+
+# LUT fields by resolution. Fields are kernel template arguments, so configs
+# sharing a resolution also share the compiled kernels.
+_lut_fields = {}
+
+
+def lut_fields(config):
+    init()
+    key = (config.tLUT_res, config.msLUT_res, config.ms_tiles)
+    if key not in _lut_fields:
+        tLUT = vec3f.field(shape=config.tLUT_res)
+        # Per-tile partial sums of the multiple scattering samples, see cal_ms_buffer.
+        ms_buffer_lum = vec3f.field(shape=(*config.msLUT_res, config.ms_tiles))
+        ms_buffer_fms = vec3f.field(shape=(*config.msLUT_res, config.ms_tiles))
+        msLUT = vec3f.field(shape=config.msLUT_res)
+        _lut_fields[key] = tLUT, ms_buffer_lum, ms_buffer_fms, msLUT
+    return _lut_fields[key]
 
 
 @ti.func
-def rayIntersectSphere(ro, rd, rad: ti.f64) -> ti.f64:
+def rayIntersectSphere(ro, rd, rad: float) -> float:
     res = 0.0
     b = ro.dot(rd)
     c = ro.dot(ro) - rad * rad
@@ -49,7 +121,7 @@ def rayIntersectSphere(ro, rd, rad: ti.f64) -> ti.f64:
 
 
 @ti.func
-def getSphericalDir(theta: ti.f64, cos_phi: ti.f64) -> vec3f:
+def getSphericalDir(theta: float, cos_phi: float):
     sin_phi = ti.sqrt(1 - cos_phi * cos_phi)
     cos_theta = ti.cos(theta)
     sin_theta = ti.sin(theta)
@@ -57,7 +129,7 @@ def getSphericalDir(theta: ti.f64, cos_phi: ti.f64) -> vec3f:
 
 
 @ti.func
-def getMiePhase(cos_theta: ti.f64):
+def getMiePhase(cos_theta: float):
     g = 0.8
     scale = 3.0 / (8.0 * np.pi)
 
@@ -68,25 +140,26 @@ def getMiePhase(cos_theta: ti.f64):
 
 
 @ti.func
-def getRayleighPhase(cos_theta: ti.f64):
+def getRayleighPhase(cos_theta: float):
     k = 3.0 / (16.0 * np.pi)
     return k * (1.0 + cos_theta * cos_theta)
 
 
 @ti.func
 def getScatteringValues(pos):
-    altitude_KM = ti.max((pos.norm() - ground_radius) * 1000.0, -100.0)
+    p = atmo[None]
+    altitude_KM = ti.max((pos.norm() - p.ground_radius) * 1000.0, -100.0)
     # Note: Paper gets these switched up.
     rayleigh_density = ti.min(ti.exp(-altitude_KM/8.0), 10)
     mie_density = ti.min(ti.exp(-altitude_KM/1.2), 10)
     
-    rayleigh_scattering = rayleigh_scattering_base * rayleigh_density
-    rayleigh_absorption = rayleigh_absorption_base * rayleigh_density
+    rayleigh_scattering = p.rayleigh_scattering_base * rayleigh_density
+    rayleigh_absorption = p.rayleigh_absorption_base * rayleigh_density
     
-    mie_scattering = mie_scattering_base * mie_density
-    mie_absorption = mie_absorption_base * mie_density
+    mie_scattering = p.mie_scattering_base * mie_density
+    mie_absorption = p.mie_absorption_base * mie_density
     
-    ozon_absorption = ozone_absorption_base * ti.max(0.0, 1.0 - ti.abs(altitude_KM - 25.0) / 15.0)
+    ozon_absorption = p.ozone_absorption_base * ti.max(0.0, 1.0 - ti.abs(altitude_KM - 25.0) / 15.0)
     
     extinction = rayleigh_scattering + rayleigh_absorption + mie_scattering + mie_absorption + ozon_absorption
 
@@ -94,257 +167,549 @@ def getScatteringValues(pos):
 
 
 @ti.func
-def bilerp(texture: ti.template(), u: ti.f64, v: ti.f64):
-    u = u * texture.shape[0] - 0.5
-    v = v * texture.shape[1] - 0.5
-    l = ti.floor(u)
-    r = ti.ceil(u)
-    b = ti.floor(v)
-    t = ti.ceil(v)
-    w00 = (r - u) * (t - v)
-    w01 = (r - u) * (v - b)
-    w10 = (u - l) * (t - v)
-    w11 = (u - l) * (v - b)
-    l_ = ti.cast(ti.max(0, ti.min(texture.shape[0] - 1, l)), ti.int32)
-    r_ = ti.cast(ti.max(0, ti.min(texture.shape[0] - 1, r)), ti.int32)
-    b_ = ti.cast(ti.max(0, ti.min(texture.shape[1] - 1, b)), ti.int32)
-    t_ = ti.cast(ti.max(0, ti.min(texture.shape[1] - 1, t)), ti.int32)
-    res = w00 * texture[l_, b_] + w01 * texture[l_, t_] + w10 * texture[r_, b_] + w11 * texture[r_, t_]
+def texel_coords(u: float, n: ti.i32):
+    # See lut_interp.texel_coords.
+    x = ti.min(ti.max(u, 0.0), 1.0) * (n - 1)
+    i = ti.min(ti.max(ti.cast(ti.floor(x), ti.i32), 0), n - 2)
+    return i, x - i
+
+
+@ti.func
+def cubic_weights(f: float):
+    return ti.Vector([f * (-0.5 + f * (1.0 - 0.5 * f)),
+                      1.0 + f * f * (-2.5 + 1.5 * f),
+                      f * (0.5 + f * (2.0 - 1.5 * f)),
+                      f * f * (-0.5 + 0.5 * f)], dt=float)
+
+
+@ti.func
+def lut_sample(texture: ti.template(), u: float, v: float):
+    # Same lookup as lut_interp.sample with the filter of the config, on a
+    # texture indexed [u, v].
+    w = texture.shape[0]
+    h = texture.shape[1]
+    i, fu = texel_coords(u, w)
+    j, fv = texel_coords(v, h)
+    res = vec3f(0.0)
+    if atmo[None].lut_filter == 0:
+        res = ((1 - fu) * (1 - fv) * texture[i, j] + fu * (1 - fv) * texture[i + 1, j]
+               + (1 - fu) * fv * texture[i, j + 1] + fu * fv * texture[i + 1, j + 1])
+    else:
+        wu = cubic_weights(fu)
+        wv = cubic_weights(fv)
+        for b in ti.static(range(4)):
+            for a in ti.static(range(4)):
+                res += wu[a] * wv[b] * texture[ti.min(ti.max(i + a - 1, 0), w - 1), ti.min(ti.max(j + b - 1, 0), h - 1)]
+        lo = ti.min(texture[i, j], texture[i + 1, j], texture[i, j + 1], texture[i + 1, j + 1])
+        hi = ti.max(texture[i, j], texture[i + 1, j], texture[i, j + 1], texture[i + 1, j + 1])
+        res = ti.min(ti.max(res, lo), hi)
     return res
 
 
 @ti.func
-def getValFromTLUT(pos, sun_dir):
+def getValFromTLUT(tLUT: ti.template(), pos, sun_dir):
+    p = atmo[None]
     height = pos.norm()
     up = pos / height
     sun_cos_theta = sun_dir.dot(up)
     u = 0.5 + 0.5 * sun_cos_theta
-    v = (height - ground_radius) / (atmosphere_radius - ground_radius)
-    return bilerp(tLUT, u, v)
+    v = (height - p.ground_radius) / (p.atmosphere_radius - p.ground_radius)
+    return lut_sample(tLUT, u, v)
 
 
 @ti.func
-def getValFromMsLUT(pos, sun_dir):
+def getValFromMsLUT(msLUT: ti.template(), pos, sun_dir):
+    p = atmo[None]
     height = pos.norm()
     up = pos / height
     sun_cos_theta = sun_dir.dot(up)
     u = 0.5 + 0.5 * sun_cos_theta
-    v = (height - ground_radius) / (atmosphere_radius - ground_radius)
-    return bilerp(msLUT, u, v)
+    v = (height - p.ground_radius) / (p.atmosphere_radius - p.ground_radius)
+    return lut_sample(msLUT, u, v)
 
 
-'''=============== Transmittance LUT ==============='''
-sun_transmittance_steps = 1024
+@ti.func
+def march_params(pos, ray_dir, t_max):
+    # The density falls off about exponentially with the distance from t_c, the
+    # lowest point of the ray, over `scale`, the distance in which the ray rises
+    # by importance_scale_height. Steps are spread so every one holds the same
+    # density mass of that falloff, on both sides of t_c.
+    p = atmo[None]
+    t_c = ti.min(ti.max(-pos.dot(ray_dir), 0.0), t_max)
+    ground_dist = rayIntersectSphere(pos, ray_dir, p.ground_radius)
+    if ground_dist > 0.0:
+        # The density is clamped below the ground, so the ground is the lowest point.
+        t_c = ti.min(t_c, ground_dist)
+    pos_c = pos + t_c * ray_dir
+    r_c = ti.max(pos_c.norm(), 1e-9)
+    mu_c = ti.abs(pos_c.dot(ray_dir)) / r_c
+    h = p.importance_scale_height
+    scale = ti.sqrt(r_c * mu_c * r_c * mu_c + h * (2 * r_c + h)) - r_c * mu_c
+    # Falloff mass before and after t_c, in units of scale.
+    mass_0 = 1 - ti.exp(-t_c / scale)
+    mass_1 = 1 - ti.exp(-(t_max - t_c) / scale)
+    return MarchParams(t_max=t_max, t_c=t_c, scale=scale, mass_0=mass_0, mass_1=mass_1)
+
+
+@ti.func
+def march_t(m, x):
+    # Distance along the ray at x in [0, 1] of the importance sampled march.
+    split = m.mass_0 / ti.max(m.mass_0 + m.mass_1, tiny)
+    t = 0.0
+    if x < split:
+        y = (split - x) / split
+        t = m.t_c - ti.min(m.t_c, -m.scale * ti.log(ti.max(1 - y * m.mass_0, tiny)))
+    else:
+        y = (x - split) / ti.max(1 - split, tiny)
+        t = m.t_c + ti.min(m.t_max - m.t_c, -m.scale * ti.log(ti.max(1 - y * m.mass_1, tiny)))
+    return t
+
+
+@ti.func
+def march_step(m, k, n, t):
+    # Sample distance and segment length of step k of n, t is the sample distance of step k - 1.
+    new_t = 0.0
+    dt = 0.0
+    if atmo[None].importance:
+        # Midpoint of every segment of the importance sampled march.
+        new_t = march_t(m, (k + 0.5) / n)
+        dt = march_t(m, (k + 1.0) / n) - march_t(m, float(k) / n)
+    else:
+        new_t = (k + 0.3) / n * m.t_max
+        dt = new_t - t
+    return new_t, dt
+
 
+'''=============== Transmittance LUT ==============='''
 @ti.kernel
-def cal_tLUT():
+def cal_tLUT(tLUT: ti.template()):
     for i, j in tLUT:
-        u = i / (tLUT_res[0] - 1)
-        v = j / (tLUT_res[1] - 1)
+        p = atmo[None]
+        u = i / (tLUT.shape[0] - 1)
+        v = j / (tLUT.shape[1] - 1)
         sun_cos_theta = 2 * u - 1
         sun_sin_theta = ti.sqrt(1 - sun_cos_theta * sun_cos_theta)
-        height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
+        height = p.ground_radius + 1e-6 + v * (p.atmosphere_radius - p.ground_radius - 2e-6)
         pos = vec3f(0, height, 0)
         sun_dir = vec3f(0, sun_cos_theta, sun_sin_theta)
-        transmittance = vec3f(0.0)
-        atmo_dist = rayIntersectSphere(pos, sun_dir, atmosphere_radius)
+        atmo_dist = rayIntersectSphere(pos, sun_dir, p.atmosphere_radius)
+        m = march_params(pos, sun_dir, atmo_dist)
         t = 0.
-        transmittance = vec3f(1., 1., 1.)
-        for k in range(sun_transmittance_steps):
-            new_t = (float(k) + 0.3) / sun_transmittance_steps * atmo_dist
-            dt = new_t - t
-            t = new_t
+        # Summing the optical depth rather than multiplying the transmittance of
+        # every step rounds once per step instead of twice, and takes one exp.
+        optical_depth = vec3f(0.0)
+        for k in range(p.sun_transmittance_steps):
+            t, dt = march_step(m, k, p.sun_transmittance_steps, t)
             new_pos = pos + t * sun_dir
             rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
-            transmittance *= ti.exp(-dt * extinction)
-        tLUT[i, j] = transmittance
+            optical_depth += dt * extinction
+        tLUT[i, j] = ti.exp(-optical_depth)
 
 
 '''=============== Multiple Scattering LUT ==============='''
-ms_steps = 128
-
-@ti.kernel
-def cal_ms_buffer():
-    for i, j, l in ms_buffer_lum:
-        u = i / (msLUT_res[0] - 1)
-        v = j / (msLUT_res[1] - 1)
-        sun_cos_theta = 2 * u - 1
-        sun_sin_theta = ti.sqrt(1 - sun_cos_theta * sun_cos_theta)
-        height = ground_radius + 1e-6 + v * (atmosphere_radius - ground_radius - 2e-6)
-        pos = vec3f(0, height, 0)
-        sun_dir = vec3f(0, sun_cos_theta, sun_sin_theta)
+@ti.func
+def cal_ms_sample(tLUT: ti.template(), u, v, l):
+    p = atmo[None]
+    sun_cos_theta = 2 * u - 1
+    sun_sin_theta = ti.sqrt(1 - sun_cos_theta * sun_cos_theta)
+    height = p.ground_radius + 1e-6 + v * (p.atmosphere_radius - p.ground_radius - 2e-6)
+    pos = vec3f(0, height, 0)
+    sun_dir = vec3f(0, sun_cos_theta, sun_sin_theta)
+
+    # Calculates Equation (5) and (7) from the paper.
+    # This integral is symmetric about theta = 0 (or theta = PI), so we
+    # only need to integrate from zero to PI, not zero to 2*PI.
+    
+    theta = l * (ti.sqrt(5) - 1) / 2
+    theta = theta - ti.floor(theta)
+    theta = theta * np.pi
+    cos_phi = l / (p.ms_samples - 1)
+    cos_phi = 2 * cos_phi - 1
+    ray_dir = getSphericalDir(theta, cos_phi)
+    
+    atmo_dist = rayIntersectSphere(pos, ray_dir, p.atmosphere_radius)
+    ground_dist = rayIntersectSphere(pos, ray_dir, p.ground_radius)
+    t_max = atmo_dist if ground_dist <= 0 else ti.min(ground_dist + 1, atmo_dist)
+    
+    cos_theta = ray_dir.dot(sun_dir)
 
-        # Calculates Equation (5) and (7) from the paper.
-        # This integral is symmetric about theta = 0 (or theta = PI), so we
-        # only need to integrate from zero to PI, not zero to 2*PI.
-        
-        theta = l * (ti.sqrt(5) - 1) / 2
-        theta = theta - ti.floor(theta)
-        theta = theta * np.pi
-        cos_phi = l / (ms_samples - 1)
-        cos_phi = 2 * cos_phi - 1
-        ray_dir = getSphericalDir(theta, cos_phi)
+    mie_phase_value = getMiePhase(cos_theta)
+    rayleigh_phase_value = getRayleighPhase(cos_theta)
+    
+    lum = vec3f(0.0)
+    lum_factor = vec3f(0.0)
+    transmittance = vec3f(1.0)
+    m = march_params(pos, ray_dir, t_max)
+    t = 0.0
+    for step_i in range(p.ms_steps):
+        t, dt = march_step(m, step_i, p.ms_steps, t)
+        new_pos = pos + t * ray_dir
+
+        rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
+
+        sample_transmittance = ti.exp(-dt * extinction)
         
-        atmo_dist = rayIntersectSphere(pos, ray_dir, atmosphere_radius)
-        ground_dist = rayIntersectSphere(pos, ray_dir, ground_radius)
-        t_max = atmo_dist if ground_dist <= 0 else ti.min(ground_dist + 1, atmo_dist)
+        # Integrate within each segment.
+        scattering_no_phase = rayleigh_scattering + mie_scattering
+        scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
+        lum_factor += transmittance * scattering_f
         
-        cos_theta = ray_dir.dot(sun_dir)
+        # This is slightly different from the paper, but I think the paper has a mistake?
+        # In equation (6), I think S(x,w_s) should be S(x-tv,w_s).
+        sun_transmittance = getValFromTLUT(tLUT, new_pos, sun_dir)
 
-        mie_phase_value = getMiePhase(cos_theta)
-        rayleigh_phase_value = getRayleighPhase(cos_theta)
-        
-        lum = vec3f(0.0)
-        lum_factor = vec3f(0.0)
-        transmittance = vec3f(1.0)
-        t = 0.0
-        for step_i in range(ms_steps):
-            new_t = (step_i + 0.3) / ms_steps * t_max
-            dt = new_t - t
-            t = new_t
-            new_pos = pos + t * ray_dir
+        rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value
+        mie_in_scattering = mie_scattering * mie_phase_value
+        in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
 
-            rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
+        # Integrated scattering within path segment.
+        scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
 
-            sample_transmittance = ti.exp(-dt * extinction)
-            
-            # Integrate within each segment.
-            scattering_no_phase = rayleigh_scattering + mie_scattering
-            scattering_f = (scattering_no_phase - scattering_no_phase * sample_transmittance) / extinction
-            lum_factor += transmittance * scattering_f
-            
-            # This is slightly different from the paper, but I think the paper has a mistake?
-            # In equation (6), I think S(x,w_s) should be S(x-tv,w_s).
-            sun_transmittance = getValFromTLUT(new_pos, sun_dir)
-
-            rayleigh_in_scattering = rayleigh_scattering * rayleigh_phase_value
-            mie_in_scattering = mie_scattering * mie_phase_value
-            in_scattering = (rayleigh_in_scattering + mie_in_scattering) * sun_transmittance
-
-            # Integrated scattering within path segment.
-            scattering = (in_scattering - in_scattering * sample_transmittance) / extinction
-
-            lum += transmittance * scattering
-            transmittance *= sample_transmittance
-        if ground_dist > 0.0:
-            hit_pos = pos + ground_dist * ray_dir
-            hit_pos = hit_pos.normalized() * ground_radius
-            lum += transmittance * ground_albedo * getValFromTLUT(hit_pos, sun_dir)
+        lum += transmittance * scattering
+        transmittance *= sample_transmittance
+    if ground_dist > 0.0:
+        hit_pos = pos + ground_dist * ray_dir
+        hit_pos = hit_pos.normalized() * p.ground_radius
+        lum += transmittance * p.ground_albedo * getValFromTLUT(tLUT, hit_pos, sun_dir)
+    return lum, lum_factor
 
-    
-        ms_buffer_fms[i, j, l] = lum_factor
-        ms_buffer_lum[i, j, l] = lum
+
+@ti.kernel
+def cal_ms_chunk(tLUT: ti.template(), ms_buffer_lum: ti.template(), ms_buffer_fms: ti.template(),
+                 chunk: ti.i32, chunks: ti.i32, tile_size: ti.i32):
+    # Sums the samples chunk, chunk + chunks, chunk + 2 * chunks, ... so every
+    # chunk spreads over all sample directions. Each (texel, tile) pair
+    # accumulates tile_size of them, so the scratch memory is ms_tiles rather
+    # than ms_samples entries per texel.
+    for i, j, k in ms_buffer_lum:
+        p = atmo[None]
+        u = i / (ms_buffer_lum.shape[0] - 1)
+        v = j / (ms_buffer_lum.shape[1] - 1)
+        lum = vec3f(0.0)
+        fms = vec3f(0.0)
+        for s in range(tile_size):
+            l = chunk + chunks * (k * tile_size + s)
+            if l < p.ms_samples:
+                sample_lum, sample_fms = cal_ms_sample(tLUT, u, v, l)
+                lum += sample_lum
+                fms += sample_fms
+        ms_buffer_fms[i, j, k] = fms
+        ms_buffer_lum[i, j, k] = lum
+
+
+def cal_ms_buffer(tLUT, ms_buffer_lum, ms_buffer_fms):
+    # All samples as one chunk.
+    cal_ms_chunk(tLUT, ms_buffer_lum, ms_buffer_fms, 0, 1, atmo[None].ms_tile_size)
 
 
 @ti.kernel
-def sum_ms_buffer():
+def sum_ms_buffer(ms_buffer_lum: ti.template(), ms_buffer_fms: ti.template(), msLUT: ti.template()):
     for i, j in msLUT:
         lum = vec3f(0.0)
         fms = vec3f(0.0)
-        inv_samples = 1.0 / ms_samples
-        for l in range(ms_samples):
-            fms += ms_buffer_fms[i, j, l] * inv_samples
-            lum += ms_buffer_lum[i, j, l] * inv_samples
-        psi = lum / (1.0 - fms) 
+        inv_samples = 1.0 / atmo[None].ms_samples
+        for k in range(ms_buffer_lum.shape[2]):
+            fms += ms_buffer_fms[i, j, k]
+            lum += ms_buffer_lum[i, j, k]
+        psi = lum * inv_samples / (1.0 - fms * inv_samples)
         msLUT[i, j] = psi
-        
 
-def cal_msLUT():
-    cal_ms_buffer()
-    sum_ms_buffer()
+
+def ms_scratch_bytes(config, tiles):
+    # Two vec3 buffers with `tiles` entries per msLUT texel.
+    return 2 * config.msLUT_res[0] * config.msLUT_res[1] * tiles * 3 * np.dtype(float_dtypes[precision]).itemsize
+
+
+def cal_msLUT(config, tLUT, ms_buffer_lum, ms_buffer_fms, msLUT):
+    print(f'ms scratch: {ms_scratch_bytes(config, config.ms_tiles) / 2**20:.1f} MB '
+          f'(per-sample buffers would take {ms_scratch_bytes(config, config.ms_samples) / 2**20:.1f} MB)')
+    cal_ms_buffer(tLUT, ms_buffer_lum, ms_buffer_fms)
+    sum_ms_buffer(ms_buffer_lum, ms_buffer_fms, msLUT)
+
+
+def load_ms_checkpoint(path, key):
+    # Returns (lum, fms, chunks done, samples done) of the bake key, or None.
+    try:
+        with np.load(path) as checkpoint:
+            if str(checkpoint['key']) != key:
+                return None
+            return checkpoint['lum'], checkpoint['fms'], int(checkpoint['done']), int(checkpoint['samples'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_ms_checkpoint(path, key, lum, fms, done, samples):
+    # Written aside and renamed, so a bake killed while saving keeps the last checkpoint.
+    tmp = f'{path}.tmp.npz'
+    np.savez(tmp, key=key, lum=lum, fms=fms, done=done, samples=samples)
+    os.replace(tmp, path)
+
+
+def bake_multiscatter_progressive(config=cfg.default_config, tLUT=None, chunks=16, checkpoint=None, tolerance=0.0):
+    # Bakes the msLUT of config from tLUT, like bake_multiscatter, one chunk of
+    # samples at a time (see cal_ms_chunk), and returns it with the number of
+    # samples it took. The running sums are saved to checkpoint after every
+    # chunk, a later call for the same bake resumes from them. The bake stops
+    # early once a chunk changes the estimate by less than tolerance, relative
+    # to its peak; with all chunks it matches bake_multiscatter up to the
+    # summation order.
+    set_params(config)
+    tLUT_field, ms_buffer_lum, ms_buffer_fms, msLUT = lut_fields(config)
+    if tLUT is None:
+        cal_tLUT(tLUT_field)
+        tLUT = tLUT_field.to_numpy().transpose(1, 0, 2)
+    else:
+        tLUT_field.from_numpy(tLUT.transpose(1, 0, 2))
+    key = lut_cache.cache_key(dict(config.lut_inputs(precision), chunks=chunks,
+                                   tLUT=hashlib.sha256(np.ascontiguousarray(tLUT).tobytes()).hexdigest()))
+
+    lum = np.zeros((*config.msLUT_res, 3))
+    fms = np.zeros((*config.msLUT_res, 3))
+    done = samples = 0
+    state = load_ms_checkpoint(checkpoint, key) if checkpoint else None
+    if state is not None:
+        lum, fms, done, samples = state
+        print(f'resuming from {checkpoint}: {done} of {chunks} chunks, {samples} samples')
+    estimate = lum / max(samples, 1) / (1.0 - fms / max(samples, 1))
+    chunk_samples = (config.ms_samples + chunks - 1) // chunks
+    tile_size = (chunk_samples + config.ms_tiles - 1) // config.ms_tiles
+    print(f'{"chunk":>9} {"samples":>8} {"bake ms":>10} {"change":>10}')
+    for chunk in range(done, chunks):
+        start = time.perf_counter()
+        cal_ms_chunk(tLUT_field, ms_buffer_lum, ms_buffer_fms, chunk, chunks, tile_size)
+        lum += ms_buffer_lum.to_numpy().sum(axis=2)
+        fms += ms_buffer_fms.to_numpy().sum(axis=2)
+        seconds = time.perf_counter() - start
+        samples += len(range(chunk, config.ms_samples, chunks))
+        previous, estimate = estimate, lum / samples / (1.0 - fms / samples)
+        change = np.abs(estimate - previous).max() / np.abs(estimate).max() if chunk else np.inf
+        if checkpoint:
+            save_ms_checkpoint(checkpoint, key, lum, fms, chunk + 1, samples)
+        print(f'{f"{chunk + 1}/{chunks}":>9} {samples:>8} {seconds * 1000:>10.1f} {change:>10.2e}')
+        if change < tolerance:
+            print(f'converged to {tolerance:.0e} after {chunk + 1} chunks')
+            break
+    if checkpoint and samples == config.ms_samples and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return estimate.transpose(1, 0, 2), samples
+
+
+def bake_fields(config=cfg.default_config):
+    # Bakes config into the fields of its resolution and returns (tLUT, msLUT).
+    set_params(config)
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = lut_fields(config)
+    cal_tLUT(tLUT)
+    cal_msLUT(config, tLUT, ms_buffer_lum, ms_buffer_fms, msLUT)
+    return tLUT, msLUT
+
+
+def bake_transmittance(config=cfg.default_config):
+    # Returns the tLUT of config in data texture layout, i.e. (v, u, 3).
+    set_params(config)
+    tLUT = lut_fields(config)[0]
+    cal_tLUT(tLUT)
+    return tLUT.to_numpy().transpose(1, 0, 2)
+
+
+def bake_multiscatter(config=cfg.default_config, tLUT=None):
+    # Returns the msLUT of config in data texture layout, from tLUT in the same
+    # layout, or from a transmittance bake if tLUT is None.
+    set_params(config)
+    tLUT_field, ms_buffer_lum, ms_buffer_fms, msLUT = lut_fields(config)
+    if tLUT is None:
+        cal_tLUT(tLUT_field)
+    else:
+        tLUT_field.from_numpy(tLUT.transpose(1, 0, 2))
+    cal_msLUT(config, tLUT_field, ms_buffer_lum, ms_buffer_fms, msLUT)
+    return msLUT.to_numpy().transpose(1, 0, 2)
+
+
+def bake_luts(config=cfg.default_config):
+    # Returns (tLUT, msLUT) in data texture layout, i.e. (v, u, 3).
+    tLUT = bake_transmittance(config)
+    return tLUT, bake_multiscatter(config, tLUT)
 
 
 '''=============== Sky View ==============='''
 sky_view_steps = 32
 skyLUT_res = (256, 256)
-skyLUT = vec3f.field(shape=(skyLUT_res[0], skyLUT_res[1]))
 
-view_pos = vec3f(0.0, ground_radius + 0.0002, 0.0)
+view_height = 0.0002
 sun_angle = 1.
 
-@ti.kernel
-def cal_skyLUT(sun_angle: ti.f64):
-    for i, j in skyLUT:
-        u = i / (skyLUT_res[0] - 1)
-        v = j / (skyLUT_res[1] - 1)
-        azimuth_angle = (u - 0.5) * 2.0 * np.pi
-        # Non-linear mapping of altitude. See Section 5.3 of the paper.
-        adjV = 0.0
-        if (v < 0.5):
-            coord = 1.0 - 2.0 * v
-            adjV = -coord * coord
-        else:
-            coord = v * 2.0 - 1.0
-            adjV = coord * coord
-        
-        height = view_pos.norm()
-        up = view_pos / height
-        horizon_angle = ti.acos(ti.sqrt(height * height - ground_radius * ground_radius) / height) - 0.5 * np.pi
-        altitude_angle = adjV * 0.5 * np.pi + horizon_angle
+@ti.func
+def sky_view_lum(tLUT: ti.template(), msLUT: ti.template(), u, v, sun_altitude, view_height, steps):
+    # Luminance seen along texel (u, v) of the sky-view LUT, with the sun in the -z direction.
+    p = atmo[None]
+    view_pos = vec3f(0.0, p.ground_radius + view_height, 0.0)
+    azimuth_angle = (u - 0.5) * 2.0 * np.pi
+    # Non-linear mapping of altitude. See Section 5.3 of the paper.
+    adjV = 0.0
+    if (v < 0.5):
+        coord = 1.0 - 2.0 * v
+        adjV = -coord * coord
+    else:
+        coord = v * 2.0 - 1.0
+        adjV = coord * coord
+    
+    height = view_pos.norm()
+    up = view_pos / height
+    horizon_angle = ti.acos(ti.sqrt(height * height - p.ground_radius * p.ground_radius) / height) - 0.5 * np.pi
+    altitude_angle = adjV * 0.5 * np.pi - horizon_angle
+    
+    cos_altitude = ti.cos(altitude_angle)
+    ray_dir = vec3f(cos_altitude * ti.sin(azimuth_angle), ti.sin(altitude_angle), -cos_altitude * ti.cos(azimuth_angle))
+    
+    sun_dir = vec3f(0.0, ti.sin(sun_altitude), -ti.cos(sun_altitude))
+    
+    atmo_dist = rayIntersectSphere(view_pos, ray_dir, p.atmosphere_radius)
+    ground_dist = rayIntersectSphere(view_pos, ray_dir, p.ground_radius)
+    t_max = atmo_dist if ground_dist < 0.0 else ti.min(ground_dist + 1, atmo_dist)
+    cos_theta = ray_dir.dot(sun_dir)
+
+    mie_phase_value = getMiePhase(cos_theta)
+    rayleigh_phase_value = getRayleighPhase(cos_theta)
+    
+    lum = vec3f(0.0)
+    transmittance = vec3f(1.0)
+    m = march_params(view_pos, ray_dir, t_max)
+    t = 0.0
+    for step_i in range(steps):
+        t, dt = march_step(m, step_i, steps, t)
         
-        cos_altitude = ti.cos(altitude_angle)
-        ray_dir = vec3f(cos_altitude * ti.sin(azimuth_angle), ti.sin(altitude_angle), -cos_altitude * ti.cos(azimuth_angle))
+        new_pos = view_pos + t * ray_dir
         
-        sun_altitude = sun_angle
-        sun_dir = vec3f(0.0, ti.sin(sun_altitude), -ti.cos(sun_altitude))
+        rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
         
-        atmo_dist = rayIntersectSphere(view_pos, ray_dir, atmosphere_radius)
-        ground_dist = rayIntersectSphere(view_pos, ray_dir, ground_radius)
-        t_max = atmo_dist if ground_dist < 0.0 else ground_dist
-        cos_theta = ray_dir.dot(sun_dir)
-    
-        mie_phase_value = getMiePhase(cos_theta)
-        rayleigh_phase_value = getRayleighPhase(cos_theta)
+        sample_transmittance = ti.exp(-dt * extinction)
+
+        sun_transmittance = getValFromTLUT(tLUT, new_pos, sun_dir)
+        psiMS = getValFromMsLUT(msLUT, new_pos, sun_dir)
         
-        lum = vec3f(0.0)
-        transmittance = vec3f(1.0)
-        t = 0.0
-        for step_i in range(sky_view_steps):
-            new_t = ((step_i + 0.3)/sky_view_steps) * t_max
-            dt = new_t - t
-            t = new_t
-            
-            new_pos = view_pos + t * ray_dir
-            
-            rayleigh_scattering, mie_scattering, extinction = getScatteringValues(new_pos)
-            
-            sample_transmittance = ti.exp(-dt * extinction)
+        rayleigh_in_scattering = rayleigh_scattering * (rayleigh_phase_value * sun_transmittance + psiMS)
+        mie_in_scattering = mie_scattering * (mie_phase_value * sun_transmittance + psiMS)
+        in_scattering = (rayleigh_in_scattering + mie_in_scattering)
 
-            sun_transmittance = getValFromTLUT(new_pos, sun_dir)
-            psiMS = getValFromMsLUT(new_pos, sun_dir)
-            
-            rayleigh_in_scattering = rayleigh_scattering * (rayleigh_phase_value * sun_transmittance + psiMS)
-            mie_in_scattering = mie_scattering * (mie_phase_value * sun_transmittance + psiMS)
-            in_scattering = (rayleigh_in_scattering + mie_in_scattering)
+        # Integrated scattering within path segment.
+        scattering_integral = (in_scattering - in_scattering * sample_transmittance) / extinction
+        lum += scattering_integral * transmittance
+        transmittance *= sample_transmittance
+    return lum
 
-            # Integrated scattering within path segment.
-            scattering_integral = (in_scattering - in_scattering * sample_transmittance) / extinction
-            lum += scattering_integral * transmittance
-            transmittance *= sample_transmittance
 
-        skyLUT[i, j] = (lum * 5) ** (1 / 2.2)
+@ti.kernel
+def cal_skyLUT(tLUT: ti.template(), msLUT: ti.template(), sun_angle: float, view_height: float, step: ti.i32):
+    # Shades one texel per step x step block and fills the block with it, so
+    # coarse previews cost 1 / step^2 of the full resolution.
+    for bi, bj in ti.ndrange(skyLUT_res[0] // step, skyLUT_res[1] // step):
+        i = bi * step
+        j = bj * step
+        u = (i + 0.5 * (step - 1)) / (skyLUT_res[0] - 1)
+        v = (j + 0.5 * (step - 1)) / (skyLUT_res[1] - 1)
+        lum = sky_view_lum(tLUT, msLUT, u, v, sun_angle, view_height, sky_view_steps)
+        color = (lum * 5) ** (1 / 2.2)
+        for di, dj in ti.ndrange(step, step):
+            skyLUT[i + di, j + dj] = color
 
 
-cal_tLUT()
-cal_msLUT()
+'''=============== Sky View Atlas ==============='''
+# viewPos of world0/composite1.fsh, which samples the atlas.
+sky_atlas_view_height = 0.0001
 
-tLUT_np = tLUT.to_numpy()
-msLUT_np = msLUT.to_numpy()
 
-ti.tools.imwrite(tLUT_np, './utils/atmosphere_transmittance.png')
-ti.tools.imwrite(msLUT_np * 5, './utils/atmosphere_multiple_scattering.png')
+@ti.func
+def sky_atlas_sun_altitude(w):
+    # Layer coordinate in [0, 1] to sun altitude. Same square mapping as the
+    # view altitude, so the layers are densest around sunrise and sunset.
+    coord = 2.0 * w - 1.0
+    return coord * ti.abs(coord) * 0.5 * np.pi
 
-tLUT_np = tLUT_np.transpose(1, 0, 2)
-msLUT_np = msLUT_np.transpose(1, 0, 2)
 
-if __name__ == '__main__':
-    gui = ti.GUI('Atmosphere', (256, 256))
+@ti.kernel
+def cal_sky_atlas(tLUT: ti.template(), msLUT: ti.template(), sky_atlas: ti.template(), view_height: float, steps: ti.i32):
+    # Every layer of sky_atlas is the sky-view LUT of one sun altitude, all baked in one launch.
+    for k, i, j in sky_atlas:
+        u = i / (sky_atlas.shape[1] - 1)
+        v = j / (sky_atlas.shape[2] - 1)
+        sun_altitude = sky_atlas_sun_altitude(k / (sky_atlas.shape[0] - 1))
+        sky_atlas[k, i, j] = sky_view_lum(tLUT, msLUT, u, v, sun_altitude, view_height, steps)
+
+
+def load_fields(config, tLUT_np, msLUT_np):
+    # Uploads LUTs in data texture layout, e.g. from lut_cache, instead of baking them.
+    set_params(config)
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = lut_fields(config)
+    tLUT.from_numpy(tLUT_np.transpose(1, 0, 2))
+    msLUT.from_numpy(msLUT_np.transpose(1, 0, 2))
+    return tLUT, msLUT
+
+
+def bake_sky_atlas(tLUT, msLUT, layers, view_height=sky_atlas_view_height, steps=sky_view_steps):
+    # Returns the linear luminance as (layers, v, u, 3), the texel order of a TEXTURE_3D.
+    sky_atlas = vec3f.field(shape=(layers, *skyLUT_res))
+    cal_sky_atlas(tLUT, msLUT, sky_atlas, view_height, steps)
+    return sky_atlas.to_numpy().transpose(0, 2, 1, 3)
+
+
+# Block sizes of the progressive preview, coarsest first. Dragging shows the
+# first one, every idle frame refines one level until full resolution.
+preview_steps = (8, 4, 2, 1)
+preview_idle_fps = 30
+
+
+def preview():
+    global sun_angle, view_height
+    config = cfg.default_config
+    tLUT, msLUT = bake_fields(config)
+    gui = ti.GUI('Atmosphere', skyLUT_res)
+    image = None
+    level = 0  # Index into preview_steps of the next render, len(preview_steps) once full resolution is shown.
+    kernel_ms = 0.0
+    mouse_last = gui.get_cursor_pos()
+    frame_start = time.perf_counter()
     while gui.running:
-        gui.get_event()
+        changed = False
+        for e in gui.get_events(ti.GUI.PRESS):
+            if e.key in (ti.GUI.UP, ti.GUI.DOWN):
+                # 100 m per key press, kept inside the atmosphere.
+                view_height += 0.0001 if e.key == ti.GUI.UP else -0.0001
+                view_height = min(max(view_height, 0.0001), config.atmosphere_radius - config.ground_radius - 0.0001)
+                changed = True
+            elif e.key == ti.GUI.ESCAPE:
+                gui.running = False
         mouse = gui.get_cursor_pos()
-        if gui.is_pressed(ti.GUI.LMB):
+        if gui.is_pressed(ti.GUI.LMB) and mouse[1] != mouse_last[1]:
             sun_angle += mouse[1] - mouse_last[1]
+            changed = True
         mouse_last = mouse
-        cal_skyLUT(sun_angle)
-        gui.set_image(skyLUT)
+        if changed:
+            level = 0
+
+        if level < len(preview_steps):
+            step = preview_steps[level]
+            start = time.perf_counter()
+            cal_skyLUT(tLUT, msLUT, sun_angle, view_height, step)
+            ti.sync()
+            kernel_ms = (time.perf_counter() - start) * 1000
+            # The GUI keeps its own copy, the field is only read back after a render.
+            image = skyLUT.to_numpy().astype(np.float32)
+            level += 1
+        else:
+            # Nothing to render, do not spin on a core.
+            time.sleep(max(0.0, 1 / preview_idle_fps - (time.perf_counter() - frame_start)))
+
+        now = time.perf_counter()
+        frame_ms = (now - frame_start) * 1000
+        frame_start = now
+        gui.set_image(image)
+        res = skyLUT_res[0] // preview_steps[level - 1]
+        gui.text(f'frame {frame_ms:5.1f} ms  kernel {kernel_ms:5.1f} ms  {res}x{res}', (0.02, 0.98), color=0xFFFFFF)
+        gui.text(f'sun {np.degrees(sun_angle):5.1f} deg  height {view_height * 1e6:4.0f} m', (0.02, 0.92), color=0xFFFFFF)
         gui.show()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends[:2], default=cfg.backend if cfg.backend != 'numpy' else 'taichi-cpu')
+    init(parser.parse_args().backend)
+    preview()
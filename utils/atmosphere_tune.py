@@ -0,0 +1,154 @@
+import argparse
+import dataclasses
+import json
+import time
+import numpy as np
+
+import atmosphere_config as cfg
+import atmosphere_lut
+
+# Finds the cheapest sample counts of the LUT bakes that stay within an error
+# budget. Every count is baked with the atmosphere_taichi kernels at decreasing
+# values and compared against a converged reference; errors are abs errors
+# relative to the peak of the reference. The max error is dominated by the few
+# texels grazing the horizon, so the budget is on the mean error by default.
+#
+# Candidates are baked with the integrator of the config, the step count
+# references always with uniform steps, so --integrator importance validates
+# importance sampling against the converged uniform march.
+#
+# The multiple scattering error of ms_steps and ms_samples is measured one
+# at a time, the other held at a cheap value in both the candidate and the
+# reference, and the pair is picked so the sum of both errors is in budget.
+tLUT_steps = [1024, 512, 256, 128, 64, 32, 16]
+tLUT_reference_steps = 8192
+ms_steps = [128, 64, 32, 16, 8]
+ms_reference_steps = 1024
+ms_samples = [4096, 2048, 1024, 512, 256, 128, 64]
+ms_reference_samples = 16384
+# Held fixed while the other multiple scattering count is swept.
+ms_fixed_steps = 32
+ms_fixed_samples = 256
+sky_steps = [32, 24, 16, 12, 8, 4]
+sky_reference_steps = 512
+# Sun altitudes of the sky-view comparison, as sky atlas layers.
+sky_layers = 5
+# Columns of a table row.
+metrics = dict(max=2, mean=3)
+
+
+def errors(lut, ref):
+    err = np.abs(lut - ref) / np.abs(ref).max()
+    return err.max(), err.mean()
+
+
+def sweep(name, counts, bake, ref):
+    # Bakes every count, returns rows of (count, seconds, max err, mean err).
+    rows = []
+    for count in counts:
+        start = time.perf_counter()
+        lut = bake(count)
+        seconds = time.perf_counter() - start
+        rows.append((count, seconds, *errors(lut, ref)))
+        print(f'{name:<24} {count:>6} {seconds * 1000:>10.1f} {rows[-1][2]:>10.2e} {rows[-1][3]:>10.2e}')
+    return rows
+
+
+def cheapest(rows, max_err, metric):
+    # Smallest count within max_err, the largest one if none is.
+    fits = [row for row in rows if row[metric] <= max_err]
+    return min(fits) if fits else max(rows)
+
+
+def tune(config=cfg.default_config, max_err=2e-3, metric='mean'):
+    # Returns the tables, the picked counts and the defaults they replace.
+    import atmosphere_taichi as ti_atmo
+    metric = metrics[metric]
+    tLUT_field, ms_buffer_lum, ms_buffer_fms, msLUT_field = ti_atmo.lut_fields(config)
+
+    def bake_tLUT(steps, integrator=config.integrator):
+        ti_atmo.set_params(dataclasses.replace(config, sun_transmittance_steps=steps, integrator=integrator))
+        ti_atmo.cal_tLUT(tLUT_field)
+        return tLUT_field.to_numpy()
+
+    def bake_msLUT(steps, samples, integrator=config.integrator):
+        ti_atmo.set_params(dataclasses.replace(config, ms_steps=steps, ms_samples=samples, integrator=integrator))
+        ti_atmo.cal_ms_buffer(tLUT_field, ms_buffer_lum, ms_buffer_fms)
+        ti_atmo.sum_ms_buffer(ms_buffer_lum, ms_buffer_fms, msLUT_field)
+        return msLUT_field.to_numpy()
+
+    def bake_sky(steps, integrator=config.integrator):
+        ti_atmo.set_params(dataclasses.replace(config, integrator=integrator))
+        return ti_atmo.bake_sky_atlas(tLUT_field, msLUT_field, sky_layers, steps=steps)
+
+    # Compile every kernel once, so the timings are bake time only.
+    start = time.perf_counter()
+    bake_tLUT(min(tLUT_steps))
+    bake_msLUT(min(ms_steps), min(ms_samples))
+    bake_sky(min(sky_steps))
+    print(f'compiled kernels in {time.perf_counter() - start:.2f} s')
+    print(f'{"count":<24} {"value":>6} {"bake ms":>10} {"max err":>10} {"mean err":>10}')
+
+    results = {}
+    ref = bake_tLUT(tLUT_reference_steps, 'uniform')
+    results['sun_transmittance_steps'] = sweep('sun_transmittance_steps', tLUT_steps, bake_tLUT, ref)
+    # The multiple scattering and sky-view bakes read the LUTs of the default
+    # config, so every candidate reads the same ones.
+    luts = atmosphere_lut.bake_luts(dataclasses.replace(config, integrator='uniform'))
+    ti_atmo.load_fields(config, *luts)
+
+    ref = bake_msLUT(ms_reference_steps, ms_fixed_samples, 'uniform')
+    results['ms_steps'] = sweep('ms_steps', ms_steps, lambda steps: bake_msLUT(steps, ms_fixed_samples), ref)
+    # Same integrator as the candidates, only the sample count differs.
+    ref = bake_msLUT(ms_fixed_steps, ms_reference_samples)
+    results['ms_samples'] = sweep('ms_samples', ms_samples, lambda samples: bake_msLUT(ms_fixed_steps, samples), ref)
+    ti_atmo.load_fields(config, *luts)
+
+    ref = bake_sky(sky_reference_steps, 'uniform')
+    results['sky_view_steps'] = sweep('sky_view_steps', sky_steps, bake_sky, ref)
+
+    best = {}
+    for name in ['sun_transmittance_steps', 'sky_view_steps']:
+        row = cheapest(results[name], max_err, metric)
+        best[name] = (row[0], row[metric])
+    # Bake time of the multiple scattering is about proportional to steps * samples.
+    pairs = [(steps_row[0] * samples_row[0], steps_row[0], samples_row[0], steps_row[metric] + samples_row[metric])
+             for steps_row in results['ms_steps'] for samples_row in results['ms_samples']]
+    fits = [pair for pair in pairs if pair[3] <= max_err]
+    _, steps, samples, ms_err = min(fits) if fits else max(pairs)
+    best['ms_steps'] = (steps, ms_err)
+    best['ms_samples'] = (samples, ms_err)
+    defaults = dict(sun_transmittance_steps=config.sun_transmittance_steps, sky_view_steps=ti_atmo.sky_view_steps,
+                    ms_steps=config.ms_steps, ms_samples=config.ms_samples)
+    return results, best, defaults
+
+
+def print_best(best, defaults, max_err, metric):
+    print(f'\ncheapest counts within a {metric} error of {max_err:.0e}:')
+    for name, (value, err) in best.items():
+        note = ' (steps + samples)' if name in ('ms_steps', 'ms_samples') else ''
+        note += ' over budget, largest count tried' if err > max_err else ''
+        print(f'  {name:<24} {defaults[name]:>6} -> {value:<6} {metric} err {err:.2e}{note}')
+    cost = best['ms_steps'][0] * best['ms_samples'][0] / (defaults['ms_steps'] * defaults['ms_samples'])
+    print(f'  multiple scattering bake: about {cost:.1%} of the default time')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends[:2], default=cfg.backend if cfg.backend != 'numpy' else 'taichi-cpu')
+    parser.add_argument('--max-err', type=float, default=2e-3, help='error budget relative to the peak of each LUT')
+    parser.add_argument('--metric', choices=metrics, default='mean', help='error the budget applies to')
+    parser.add_argument('--integrator', choices=cfg.integrators, default='uniform', help='integrator of the candidates')
+    parser.add_argument('--json', help='write the tables and the picked counts to this file')
+    args = parser.parse_args()
+
+    cfg.backend = args.backend
+    config = dataclasses.replace(cfg.default_config, integrator=args.integrator)
+    results, best, defaults = tune(config, args.max_err, args.metric)
+    print_best(best, defaults, args.max_err, args.metric)
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump(dict(max_err=args.max_err, metric=args.metric, integrator=args.integrator, defaults=defaults,
+                           best={name: value for name, (value, err) in best.items()},
+                           tables={name: [dict(value=row[0], seconds=row[1], max_err=row[2], mean_err=row[3]) for row in rows]
+                                   for name, rows in results.items()}), fout, indent=2)
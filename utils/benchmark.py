@@ -0,0 +1,305 @@
+import argparse
+import dataclasses
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import atmosphere_config as cfg
+
+# Times every bake stage of utils/ on its own, e.g.
+#   python utils/benchmark.py --out before.json
+#   python utils/benchmark.py --baseline before.json --threshold 0.2
+# Each stage runs in a fresh process so taichi kernels are compiled from
+# scratch and the peak memory is the stage's own. The first call is timed
+# apart from the repeats; for taichi stages the difference is the JIT
+# compile time. With --baseline the run fails if a stage got slower or
+# needs more memory by more than the threshold. --startup times the taichi
+# startup of a bake instead, once with an empty kernel cache and once warm.
+benchmark_path = './utils/benchmark.json'
+# Fewer multiple scattering samples than the default bake, so the suite stays
+# quick; --full benchmarks the default config.
+benchmark_config = dataclasses.replace(cfg.default_config, ms_samples=256)
+repeats = 5
+# Differences below these are noise, not regressions.
+min_delta_seconds = 0.005
+min_delta_mb = 4.0
+
+
+def _taichi(config):
+    import taichi as ti
+    import atmosphere_taichi
+    atmosphere_taichi.set_params(config)
+    return ti, atmosphere_taichi
+
+
+def stage_cal_tLUT(config):
+    ti, ti_atmo = _taichi(config)
+    tLUT = ti_atmo.lut_fields(config)[0]
+    return lambda: (ti_atmo.cal_tLUT(tLUT), ti.sync())
+
+
+def stage_cal_ms_buffer(config):
+    ti, ti_atmo = _taichi(config)
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = ti_atmo.lut_fields(config)
+    ti_atmo.cal_tLUT(tLUT)
+    return lambda: (ti_atmo.cal_ms_buffer(tLUT, ms_buffer_lum, ms_buffer_fms), ti.sync())
+
+
+def stage_sum_ms_buffer(config):
+    ti, ti_atmo = _taichi(config)
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = ti_atmo.lut_fields(config)
+    return lambda: (ti_atmo.sum_ms_buffer(ms_buffer_lum, ms_buffer_fms, msLUT), ti.sync())
+
+
+def stage_cal_skyLUT(config):
+    ti, ti_atmo = _taichi(config)
+    tLUT, ms_buffer_lum, ms_buffer_fms, msLUT = ti_atmo.lut_fields(config)
+    ti_atmo.cal_tLUT(tLUT)
+    ti_atmo.cal_msLUT(config, tLUT, ms_buffer_lum, ms_buffer_fms, msLUT)
+    return lambda: (ti_atmo.cal_skyLUT(tLUT, msLUT, ti_atmo.sun_angle, ti_atmo.view_height, 1), ti.sync())
+
+
+def stage_numpy_tLUT(config):
+    import atmosphere
+    return atmosphere.bake_tLUT
+
+
+def stage_numpy_msLUT(config):
+    import atmosphere
+    tLUT = atmosphere.bake_tLUT()
+    return lambda: atmosphere.bake_msLUT(tLUT)
+
+
+def stage_numpy_tLUT_reference(config):
+    import atmosphere
+    return atmosphere.bake_tLUT_reference
+
+
+def stage_numpy_msLUT_reference(config):
+    import atmosphere
+    tLUT = atmosphere.bake_tLUT()
+    return lambda: atmosphere.bake_msLUT_reference(tLUT)
+
+
+def stage_build_data(config):
+    import data
+    # The LUTs come from lut_cache, baked here if they are not cached yet.
+    data.atmosphere_luts(config)
+    return lambda: data.build_data(config)
+
+
+def _encode_stage(data_format):
+    def stage(config):
+        import data
+        texture = data.build_data(config)
+        return lambda: data.encode(texture, data.data_formats[data_format])
+    return stage
+
+
+def stage_write_data(config):
+    import data
+    raw = data.encode(data.build_data(config), data.data_formats['float32'])
+    path = os.path.join(tempfile.mkdtemp(), 'data.bin')
+    return lambda: data.write_data(raw, path)
+
+
+def stage_gaussian_array(config):
+    import gen_gaussian_kernel
+    return lambda: gen_gaussian_kernel.write_arrays(io.StringIO())
+
+
+def stage_gaussian_unrolled(config):
+    import gen_gaussian_kernel
+    return lambda: gen_gaussian_kernel.write_unrolled(io.StringIO())
+
+
+# name: (setup, repeats). A setup gets the config, does everything the stage
+# needs beforehand and returns the call to time.
+stages = {
+    'taichi.cal_tLUT': (stage_cal_tLUT, repeats),
+    'taichi.cal_ms_buffer': (stage_cal_ms_buffer, 3),
+    'taichi.sum_ms_buffer': (stage_sum_ms_buffer, repeats),
+    'taichi.cal_skyLUT': (stage_cal_skyLUT, repeats),
+    'atmosphere.bake_tLUT': (stage_numpy_tLUT, repeats),
+    'atmosphere.bake_msLUT': (stage_numpy_msLUT, 3),
+    'data.build_data': (stage_build_data, repeats),
+    'data.encode_float32': (_encode_stage('float32'), repeats),
+    'data.encode_float16': (_encode_stage('float16'), repeats),
+    'data.encode_rgb9e5': (_encode_stage('rgb9e5'), repeats),
+    'data.write_data': (stage_write_data, repeats),
+    'gaussian.write_arrays': (stage_gaussian_array, repeats),
+    'gaussian.write_unrolled': (stage_gaussian_unrolled, repeats),
+}
+# The per-texel loops of atmosphere.py take minutes, only run with --slow.
+slow_stages = {
+    'atmosphere.bake_tLUT_reference': (stage_numpy_tLUT_reference, 1),
+    'atmosphere.bake_msLUT_reference': (stage_numpy_msLUT_reference, 1),
+}
+
+
+def rss_mb():
+    with open('/proc/self/statm') as fin:
+        return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def run_stage(name, config):
+    # Runs in a fresh process, see benchmark.
+    setup, count = {**stages, **slow_stages}[name]
+    os.environ['TQDM_DISABLE'] = '1'
+    # Every taichi bake on the CPU, including LUTs data.py bakes on a cache miss.
+    cfg.backend = 'taichi-cpu'
+    start = time.perf_counter()
+    fn = setup(config)
+    setup_seconds = time.perf_counter() - start
+    rss_before = rss_mb()
+
+    start = time.perf_counter()
+    fn()
+    first_seconds = time.perf_counter() - start
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    # ru_maxrss is in KB on Linux.
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return dict(setup_seconds=setup_seconds, first_seconds=first_seconds,
+                compile_seconds=max(0.0, first_seconds - min(times)),
+                min_seconds=min(times), median_seconds=statistics.median(times), repeats=count,
+                peak_mb=peak_mb, stage_mb=max(0.0, peak_mb - rss_before))
+
+
+def run_startup(cache_dir):
+    # Runs in a fresh process, see startup. Times each step from a cold import
+    # to a second bake of the tLUT.
+    times = {}
+    start = time.perf_counter()
+    cfg.backend = 'taichi-cpu'
+    cfg.taichi_cache_dir = cache_dir
+    import taichi as ti
+    times['import taichi'] = time.perf_counter() - start
+    start = time.perf_counter()
+    import atmosphere_taichi
+    times['import atmosphere_taichi'] = time.perf_counter() - start
+    start = time.perf_counter()
+    atmosphere_taichi.init()
+    times['init'] = time.perf_counter() - start
+    start = time.perf_counter()
+    atmosphere_taichi.bake_transmittance(cfg.default_config)
+    times['first bake_transmittance'] = time.perf_counter() - start
+    start = time.perf_counter()
+    atmosphere_taichi.bake_transmittance(cfg.default_config)
+    times['second bake_transmittance'] = time.perf_counter() - start
+    return times
+
+
+def startup():
+    # Cold and warm runs share a kernel cache dir that starts out empty.
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ['cold', 'warm']:
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                results[run] = pool.submit(run_startup, cache_dir).result()
+    print(f'{"step":<34} {"cold s":>8} {"warm s":>8}')
+    for step in results['cold']:
+        print(f'{step:<34} {results["cold"][step]:>8.2f} {results["warm"][step]:>8.2f}')
+    print(f'{"total":<34} {sum(results["cold"].values()):>8.2f} {sum(results["warm"].values()):>8.2f}')
+    return results
+
+
+def environment():
+    import numpy as np
+    import taichi as ti
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=np.__version__, taichi=ti.__version__,
+                platform=platform.platform(), cpu_count=os.cpu_count(), cpu_threads=cfg.cpu_threads)
+
+
+def benchmark(names, config):
+    # Spawned rather than forked, taichi runtimes do not survive a fork.
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    print(f'{"stage":<34} {"setup s":>8} {"compile s":>9} {"run ms":>10} {"median ms":>10} {"peak MB":>8} {"stage MB":>8}')
+    for name in names:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_stage, name, config).result()
+        results[name] = result
+        print(f'{name:<34} {result["setup_seconds"]:>8.2f} {result["compile_seconds"]:>9.2f} '
+              f'{result["min_seconds"] * 1000:>10.2f} {result["median_seconds"] * 1000:>10.2f} '
+              f'{result["peak_mb"]:>8.1f} {result["stage_mb"]:>8.1f}')
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the stages that regressed against baseline, which is a benchmark JSON.
+    regressions = []
+    print(f'\n{"stage":<34} {"run ms":>10} {"baseline":>10} {"change":>8} {"peak MB":>8} {"baseline":>8}')
+    for name, result in results.items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f'{name:<34} {result["min_seconds"] * 1000:>10.2f} {"-":>10}')
+            continue
+        change = result['min_seconds'] / base['min_seconds'] - 1
+        slower = change > threshold and result['min_seconds'] - base['min_seconds'] > min_delta_seconds
+        bigger = (result['peak_mb'] > base['peak_mb'] * (1 + threshold)
+                  and result['peak_mb'] - base['peak_mb'] > min_delta_mb)
+        if slower or bigger:
+            regressions.append(name)
+        print(f'{name:<34} {result["min_seconds"] * 1000:>10.2f} {base["min_seconds"] * 1000:>10.2f} {change:>+8.1%} '
+              f'{result["peak_mb"]:>8.1f} {base["peak_mb"]:>8.1f}'
+              + ('  slower' if slower else '') + ('  more memory' if bigger else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', metavar='STAGE', help=f'stages to run, default all of: {", ".join(stages)}')
+    parser.add_argument('--slow', action='store_true', help='also run the per-texel reference loops of atmosphere.py')
+    parser.add_argument('--full', action='store_true', help='benchmark the default config instead of the reduced one')
+    parser.add_argument('--out', default=benchmark_path, help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='benchmark JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown or memory growth, 0.2 is 20%%')
+    parser.add_argument('--startup', action='store_true', help='time the cold and warm taichi startup instead of the stages')
+    args = parser.parse_args()
+
+    if args.startup:
+        results = startup()
+        with open(args.out, 'w') as fout:
+            json.dump(dict(environment=environment(), startup=results), fout, indent=2)
+        print(f'wrote {args.out}')
+        sys.exit()
+
+    names = args.stages or list(stages) + (list(slow_stages) if args.slow else [])
+    unknown = [name for name in names if name not in stages and name not in slow_stages]
+    if unknown:
+        parser.error(f'unknown stages {", ".join(unknown)}')
+    config = cfg.default_config if args.full else benchmark_config
+    results = benchmark(names, config)
+    with open(args.out, 'w') as fout:
+        json.dump(dict(environment=environment(), config=dataclasses.asdict(config), stages=results), fout, indent=2)
+    print(f'wrote {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        # Through JSON, so tuples compare equal to the lists they were stored as.
+        if baseline.get('config') != json.loads(json.dumps(dataclasses.asdict(config))):
+            print('warning: the baseline benchmarked a different config')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} stages regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+        print(f'no stage regressed by more than {args.threshold:.0%}')
@@ -0,0 +1,217 @@
+import argparse
+import glob
+import io
+import os
+import re
+import sys
+
+import gen_gaussian_kernel
+
+# Generates the world0 passes from the templates in utils/shader_templates. A
+# template is the pass with some lines replaced by directives:
+#   //@helper name          function name of shader_templates/helpers.glsl
+#   //@gaussian_tables      const tap tables, see gen_gaussian_kernel.write_tables
+#   //@gaussian_unrolled buffer=gaux3 arg=fog_data0 type=vec4 swizzle=.z horizontal=1
+#                           unrolled taps, see gen_gaussian_kernel.write_unrolled
+# The Gaussian directives only expand the sizes the pass can select: the values
+# of the option list of its GAUSSIAN_KERNEL_SIZE, or its value if it has none,
+# and the same for GAUSSIAN_KERNEL_STRIDE. Helpers shared by several passes are
+# written once in helpers.glsl. Edit the templates, then rerun this script.
+template_dir = './utils/shader_templates'
+helpers_path = os.path.join(template_dir, 'helpers.glsl')
+shader_dir = './shaders'
+
+directive_re = re.compile(r'^(\s*)//@(\w+)(.*)$')
+# OptiFine options: #define NAME value // [value value ...]
+define_re = re.compile(r'^\s*#define\s+(\w+)(?:\s+([^/\s]+))?\s*(?://\s*\[([^\]]*)\])?')
+function_re = re.compile(r'^\w+\s+(\w+)\s*\([^)]*\)\s*\{\s*$')
+
+
+def load_helpers(path=helpers_path):
+    # Function name: its source, every function ends at a } in the first column.
+    helpers = {}
+    lines = open(path).read().split('\n')
+    for i, line in enumerate(lines):
+        m = function_re.match(line)
+        if m:
+            end = lines.index('}', i)
+            helpers[m.group(1)] = '\n'.join(lines[i:end + 1])
+    return helpers
+
+
+def option_values(source, name):
+    # Values a #define of source can take, as strings.
+    for line in source.split('\n'):
+        m = define_re.match(line)
+        if m and m.group(1) == name:
+            return m.group(3).split() if m.group(3) else [m.group(2)]
+    return []
+
+
+def gaussian_sizes(source, all_sizes):
+    if all_sizes:
+        return list(gen_gaussian_kernel.sizes)
+    return [int(value) for value in option_values(source, 'GAUSSIAN_KERNEL_SIZE')]
+
+
+def gaussian_forms(source, all_sizes):
+    strides = {int(value) for value in option_values(source, 'GAUSSIAN_KERNEL_STRIDE')}
+    if all_sizes or not strides:
+        return (True, False)
+    return tuple(linear for linear in (True, False) if (1 in strides if linear else strides - {1}))
+
+
+def expand(source, helpers, all_sizes=False):
+    # Returns the pass generated from the template source.
+    out = io.StringIO()
+    for line in source.split('\n'):
+        m = directive_re.match(line)
+        if not m:
+            out.write(line + '\n')
+            continue
+        indent, name, args = m.groups()
+        if name == 'helper':
+            out.write(helpers[args.strip()] + '\n')
+        elif name == 'gaussian_tables':
+            gen_gaussian_kernel.write_tables(out, gaussian_sizes(source, all_sizes), gaussian_forms(source, all_sizes))
+        elif name == 'gaussian_unrolled':
+            params = dict(buffer=None, arg=None, type=None, swizzle='', horizontal='0')
+            params.update(arg.split('=', 1) for arg in args.split())
+            gen_gaussian_kernel.buffer, gen_gaussian_kernel.arg = params['buffer'], params['arg']
+            gen_gaussian_kernel.arg_type, gen_gaussian_kernel.swizzle = params['type'], params['swizzle']
+            gen_gaussian_kernel.horizontal = params['horizontal'] == '1'
+            gen_gaussian_kernel.write_unrolled(out, gaussian_sizes(source, all_sizes))
+        else:
+            raise ValueError(f'unknown directive //@{name}')
+    return out.getvalue()[:-1]
+
+
+def add_header(text, template):
+    # Right after #version, which has to come first.
+    first, rest = text.split('\n', 1)
+    return f'{first}\n// Generated by utils/build_shaders.py from {template}, edit the template.\n{rest}'
+
+
+'''=============== Preprocessor ==============='''
+def eval_condition(expr, defines):
+    expr = re.sub(r'defined\s*\(?\s*(\w+)\s*\)?', lambda m: '1' if m.group(1) in defines else '0', expr)
+    expr = re.sub(r'[A-Za-z_]\w*', lambda m: str(defines.get(m.group(0), 0)), expr)
+    expr = expr.replace('&&', ' and ').replace('||', ' or ')
+    expr = re.sub(r'!(?!=)', ' not ', expr)
+    return bool(eval(expr, {'__builtins__': {}}))
+
+
+def preprocess(source, defines=None):
+    # Resolves the object-like #defines and the #if/#ifdef/#elif/#else/#endif
+    # blocks of source like a GLSL preprocessor would, with defines overriding
+    # the #defines of source. Returns (active lines, defines at the end), where
+    # the active lines are the code lines the compiler gets.
+    overrides = dict(defines or {})
+    defines = dict(overrides)
+    active = []
+    # One (taking lines, a branch was taken, enclosing block taking lines) per open #if.
+    stack = []
+    taking = True
+    for line in source.split('\n'):
+        stripped = line.strip()
+        if not stripped.startswith('#'):
+            if taking:
+                active.append(line)
+            continue
+        words = stripped[1:].split(None, 1)
+        directive, rest = (words[0], words[1] if len(words) > 1 else '') if words else ('', '')
+        rest = rest.split('//')[0].strip()
+        if directive in ('if', 'ifdef', 'ifndef'):
+            if directive == 'if':
+                cond = taking and eval_condition(rest, defines)
+            else:
+                cond = taking and ((rest in defines) == (directive == 'ifdef'))
+            stack.append((cond, cond, taking))
+            taking = cond
+        elif directive == 'elif':
+            _, taken, outer = stack[-1]
+            cond = outer and not taken and eval_condition(rest, defines)
+            stack[-1] = (cond, taken or cond, outer)
+            taking = cond
+        elif directive == 'else':
+            _, taken, outer = stack[-1]
+            stack[-1] = (outer and not taken, True, outer)
+            taking = outer and not taken
+        elif directive == 'endif':
+            taking = stack.pop()[2]
+        elif not taking:
+            continue
+        elif directive == 'define':
+            m = define_re.match(stripped)
+            if m and m.group(1) not in overrides:
+                value = m.group(2) or '1'
+                defines[m.group(1)] = int(value) if re.fullmatch(r'-?\d+', value) else value
+        elif directive == 'undef':
+            defines.pop(rest, None)
+        else:
+            active.append(line)
+    return active, defines
+
+
+'''=============== Report ==============='''
+def source_stats(text):
+    # Proxies of what the driver does with a pass: every line and directive is
+    # scanned by the preprocessor, the active lines are what gets compiled.
+    lines = text.split('\n')
+    active = [line for line in preprocess(text)[0] if line.strip()]
+    return dict(bytes=len(text.encode()), lines=len(lines),
+                directives=sum(line.strip().startswith('#') for line in lines),
+                branches=sum(bool(re.match(r'\s*#\s*(if|ifdef|ifndef|elif)\b', line)) for line in lines),
+                active_lines=len(active), active_bytes=sum(len(line) + 1 for line in active))
+
+
+def print_report(stats):
+    columns = ['bytes', 'lines', 'directives', 'branches', 'active_lines', 'active_bytes']
+    print(f'{"pass":<24} ' + ' '.join(f'{column:>20}' for column in columns))
+    totals = {column: [0, 0] for column in columns}
+    for name, (before, after) in stats.items():
+        cells = []
+        for column in columns:
+            totals[column][0] += before[column]
+            totals[column][1] += after[column]
+            cells.append(f'{f"{before[column]} -> {after[column]}":>20}')
+        print(f'{name:<24} ' + ' '.join(cells))
+    print(f'{"total":<24} ' + ' '.join(f'{f"{b} -> {a}":>20}' for b, a in totals.values()))
+
+
+def build(all_sizes=False, check=False):
+    # Generates every template. With check, only reports passes that are out of
+    # date. Returns the paths that differ from the generated passes.
+    helpers = load_helpers()
+    stats = {}
+    stale = []
+    for template in sorted(glob.glob(os.path.join(template_dir, '*', '*.[fv]sh'))):
+        name = os.path.relpath(template, template_dir)
+        path = os.path.join(shader_dir, name)
+        with open(template) as fin:
+            text = add_header(expand(fin.read(), helpers, all_sizes), f'utils/shader_templates/{name}')
+        before = open(path).read() if os.path.exists(path) else ''
+        stats[name] = (source_stats(before), source_stats(text))
+        if text != before:
+            stale.append(path)
+            if not check:
+                with open(path, 'w') as fout:
+                    fout.write(text)
+    print_report(stats)
+    return stale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--all-sizes', action='store_true', help='expand every Gaussian size, as the passes did before')
+    parser.add_argument('--check', action='store_true', help='only check that the passes are up to date')
+    args = parser.parse_args()
+
+    stale = build(args.all_sizes, args.check)
+    if args.check:
+        if stale:
+            print(f'out of date: {", ".join(stale)}')
+            sys.exit(1)
+        print('all passes are up to date')
+    else:
+        print(f'wrote {len(stale)} passes' + (f': {", ".join(stale)}' if stale else ''))
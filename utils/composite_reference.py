@@ -0,0 +1,552 @@
+import argparse
+import os
+import time
+import numpy as np
+
+import atmosphere_config as cfg
+import atmosphere_lut
+import atmosphere_numpy
+import gen_gaussian_kernel
+import ssao_kernel
+from atmosphere import rayIntersectSphere, getMiePhase, getRayleighPhase
+
+# CPU reference of the expensive world0/composite*.fsh stages, for comparing
+# step counts by cost and quality without launching the game. Every pass is
+# run at the given settings and at a high sample reference, and the table
+# lists texture fetches, run time and error against the reference.
+#
+# G-buffer dumps are a directory of .npy files:
+#   depth.npy       (H, W)    depthtex1, non-linear [0, 1], 1 for sky
+#   normal.npy      (H, W, 3) view space normals (gnormal.xyz)
+#   albedo.npy      (H, W, 3) linear color (gcolor.rgb after inverse gamma)
+#   reflective.npy  (H, W)    optional, pixels running SSR (block_id1 > 0.5)
+#   projection.npy  (4, 4)    optional gbufferProjection
+# Row 0 is the bottom row, as texture coordinates go in GL.
+
+ssao_radius = 0.25
+ssao_intensity = 1.0
+gaussian_size = 31
+ssr_step_max_iter = 100
+ssr_div_max_iter = 8
+# SSR_MODE 1: levels of the min depth pyramid composite4/7.fsh build, max
+# traversal steps, and how far behind the depth buffer a ray still hits.
+ssr_hiz_levels = 6
+ssr_hiz_max_iter = 64
+ssr_hiz_thickness = 1.0
+atmosphere_samples = 32
+# Sky-view LUT rows composite1.fsh marches every frame, and its viewPos height.
+sky_res = (256, 128)
+sky_view_height = 0.0001
+
+# High sample settings the error is measured against. Bloom is measured against
+# the per tap kernel of the same size. The SSAO reference uses rand(), whose
+# first samples are those of the rand() rows, so it favours them if anything.
+reference = dict(ssao=1024, atmosphere=512, ssr=(1000, 16))
+
+
+def perspective(fov, aspect, near=0.05, far=256.0):
+    f = 1 / np.tan(np.radians(fov) / 2)
+    return np.array([[f / aspect, 0, 0, 0],
+                     [0, f, 0, 0],
+                     [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                     [0, 0, -1, 0]])
+
+
+def texcoords(h, w):
+    t, s = np.meshgrid((np.arange(h) + 0.5) / h, (np.arange(w) + 0.5) / w, indexing='ij')
+    return s, t
+
+
+def screen_to_view(projection, s, t, depth):
+    ndc = np.stack([s * 2 - 1, t * 2 - 1, depth * 2 - 1, np.ones_like(s)], axis=-1)
+    clip = ndc @ np.linalg.inv(projection).T
+    return clip[..., :3] / clip[..., 3:]
+
+
+def view_to_screen(projection, view):
+    clip = np.concatenate([view, np.ones_like(view[..., :1])], axis=-1) @ projection.T
+    return clip[..., :3] / clip[..., 3:] * 0.5 + 0.5
+
+
+def fetch_nearest(img, s, t):
+    h, w = img.shape[:2]
+    return img[np.clip(np.floor(t * h).astype(int), 0, h - 1), np.clip(np.floor(s * w).astype(int), 0, w - 1)]
+
+
+def fetch_linear(img, s, t):
+    h, w = img.shape[:2]
+    x = np.clip(s * w - 0.5, 0, w - 1)
+    y = np.clip(t * h - 0.5, 0, h - 1)
+    x0 = np.minimum(np.floor(x).astype(int), w - 2)
+    y0 = np.minimum(np.floor(y).astype(int), h - 2)
+    fx = (x - x0)[..., None] if img.ndim == 3 else x - x0
+    fy = (y - y0)[..., None] if img.ndim == 3 else y - y0
+    return ((img[y0, x0] * (1 - fx) + img[y0, x0 + 1] * fx) * (1 - fy)
+            + (img[y0 + 1, x0] * (1 - fx) + img[y0 + 1, x0 + 1] * fx) * fy)
+
+
+def seed(s, t):
+    return s * 12.9898 + t * 78.223
+
+
+def rand_composite(state):
+    # rand() of composite.fsh, returns (value, new state).
+    val = np.mod(np.sin(state) * 43758.5453, 1.0)
+    return val, np.mod(state, 1.0) * 38.287
+
+
+def rand_composite8(state):
+    # rand() of composite8.fsh.
+    val = np.mod(np.sin(state) * 43758.5453, 1.0)
+    return val, val * 38.287 + 4.3783
+
+
+def load_gbuffer(path):
+    gbuffer = {name: np.load(os.path.join(path, f'{name}.npy'))
+               for name in ['depth', 'normal', 'albedo', 'reflective', 'projection']
+               if os.path.exists(os.path.join(path, f'{name}.npy'))}
+    h, w = gbuffer['depth'].shape
+    gbuffer.setdefault('projection', perspective(70, w / h))
+    gbuffer.setdefault('reflective', gbuffer['depth'] < 1)
+    return gbuffer
+
+
+def synthetic_gbuffer(w=320, h=180):
+    # A floor, a wall and two spheres in front of the camera.
+    projection = perspective(70, w / h)
+    s, t = texcoords(h, w)
+    ray = screen_to_view(projection, s, t, np.ones_like(s))
+    ray /= np.linalg.norm(ray, axis=-1, keepdims=True)
+    dist = np.full((h, w), np.inf)
+    normal = np.zeros((h, w, 3))
+    albedo = np.zeros((h, w, 3))
+    reflective = np.zeros((h, w), dtype=bool)
+
+    def plane(n, d, color, mirror):
+        hit = d / np.minimum(ray @ np.array(n, dtype=float), -1e-9)
+        closer = (hit > 0) & (hit < dist)
+        dist[closer] = hit[closer]
+        normal[closer] = n
+        pos = ray[closer] * hit[closer, None]
+        checker = (np.floor(pos[:, 0]) + np.floor(pos[:, 2]) + np.floor(pos[:, 1])) % 2
+        albedo[closer] = np.array(color) * (0.6 + 0.4 * checker[:, None])
+        reflective[closer] = mirror
+
+    def sphere(center, radius, color):
+        center = np.array(center, dtype=float)
+        b = ray @ center
+        disc = b * b - center @ center + radius * radius
+        hit = b - np.sqrt(np.maximum(disc, 0))
+        closer = (disc > 0) & (hit > 0) & (hit < dist)
+        dist[closer] = hit[closer]
+        pos = ray[closer] * hit[closer, None]
+        normal[closer] = (pos - center) / radius
+        albedo[closer] = color
+        reflective[closer] = False
+
+    plane((0, 1, 0), -1.6, (0.2, 0.3, 0.5), True)
+    plane((0, 0, 1), -40.0, (0.6, 0.5, 0.4), False)
+    sphere((-2, -0.6, -8), 1.0, (0.8, 0.2, 0.1))
+    sphere((2.5, 0.2, -14), 1.8, (0.2, 0.7, 0.3))
+
+    view = ray * np.where(np.isfinite(dist), dist, 1.0)[..., None]
+    depth = np.where(np.isfinite(dist), view_to_screen(projection, view)[..., 2], 1.0)
+    return dict(depth=depth, normal=normal, albedo=albedo, reflective=reflective, projection=projection)
+
+
+'''=============== SSAO (composite.fsh) ==============='''
+def ssao(gbuffer, samples, radius=ssao_radius, intensity=ssao_intensity, baked=True):
+    # Returns (ao, fetches). baked samples the kernel and noise tile of the data
+    # texture like composite.fsh, otherwise the per sample rand() calls it had
+    # before are used. Fetches of the kernel and noise texels are not counted.
+    depth, normal, projection = gbuffer['depth'], gbuffer['normal'], gbuffer['projection']
+    h, w = depth.shape
+    s, t = texcoords(h, w)
+    view = screen_to_view(projection, s, t, depth)
+    dist = np.linalg.norm(view, axis=-1)
+    active = (depth < 1) & (dist < 64)
+    view, normal, dist = view[active], normal[active], dist[active]
+    state = seed(s[active], t[active])
+
+    helper = np.where((normal[:, 1] < 0.707)[:, None], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0])
+    tangent = np.cross(normal, helper)
+    tangent /= np.linalg.norm(tangent, axis=-1, keepdims=True)
+    bitangent = np.cross(normal, tangent)
+    if baked:
+        y, x = np.nonzero(active)
+        noise = ssao_kernel.ssao_noise()[y % ssao_kernel.noise_size, x % ssao_kernel.noise_size]
+        kernel = ssao_kernel.hemisphere_samples(ssao_kernel.ssao_kernel()[:samples], noise)
+    oc = np.zeros(len(view))
+    for i in range(samples):
+        if baked:
+            local = radius * kernel[:, i]
+        else:
+            y, state = rand_composite(state)
+            xz = np.sqrt(1 - y * y)
+            theta, state = rand_composite(state)
+            theta = 2 * np.pi * theta
+            r, state = rand_composite(state)
+            r = r * radius
+            local = r[:, None] * np.stack([xz * np.cos(theta), y, xz * np.sin(theta)], axis=-1)
+        sample = radius * (local[:, :1] * bitangent + local[:, 1:2] * normal + local[:, 2:] * tangent) + view
+        sample = view_to_screen(projection, sample)
+        sample_depth = fetch_nearest(depth, sample[:, 0], sample[:, 1])
+        oc += (sample[:, 2] > sample_depth) & (sample[:, 2] - 0.001 < sample_depth)
+    ao = np.ones((h, w))
+    fade = 1 - np.clip((dist - 32) / 32, 0, 1) ** 2 * (3 - 2 * np.clip((dist - 32) / 32, 0, 1))
+    ao[active] = np.clip(1 - intensity * oc / samples * fade, 0, 1)
+    return ao, samples * int(active.sum())
+
+
+'''=============== Atmosphere (composite1.fsh) ==============='''
+def sky_view(luts, sun_dir, samples, config=cfg.default_config):
+    # The sky-view rows composite1.fsh marches every frame. Returns (lum, fetches).
+    tLUT, msLUT = luts
+    u, v = np.meshgrid((np.arange(sky_res[0]) + 0.5) / sky_res[0], (np.arange(sky_res[1]) + 0.5) / sky_res[1])
+    u = (u * sky_res[0] - 0.5) / (sky_res[0] - 1)
+    v = (v * sky_res[1] - 0.5) / (sky_res[1] - 1)
+    azimuth = (u - 0.5) * 2 * np.pi
+    adj_v = np.where(v < 0.5, -(1 - 2 * v) ** 2, (2 * v - 1) ** 2)
+    view_pos = np.array([0.0, config.ground_radius + sky_view_height, 0.0])
+    height = np.linalg.norm(view_pos)
+    horizon = np.arccos(np.sqrt(height ** 2 - config.ground_radius ** 2) / height) - 0.5 * np.pi
+    altitude = adj_v * 0.5 * np.pi - horizon
+    ray_dir = np.stack([np.cos(altitude) * np.sin(azimuth), np.sin(altitude), -np.cos(altitude) * np.cos(azimuth)], axis=-1)
+
+    atmo_dist = rayIntersectSphere(view_pos, ray_dir, config.atmosphere_radius)
+    ground_dist = rayIntersectSphere(view_pos, ray_dir, config.ground_radius)
+    t_max = np.where(ground_dist < 0, atmo_dist, np.minimum(ground_dist + 1, atmo_dist))
+    cos_theta = ray_dir @ sun_dir
+    mie_phase = getMiePhase(cos_theta)[..., None]
+    rayleigh_phase = getRayleighPhase(-cos_theta)[..., None]
+
+    lum = np.zeros(ray_dir.shape)
+    transmittance = np.ones(ray_dir.shape)
+    t = np.zeros(t_max.shape)
+    for i in range(samples):
+        new_t = (i + 0.3) / samples * t_max
+        dt = (new_t - t)[..., None]
+        t = new_t
+        pos = view_pos + t[..., None] * ray_dir
+        rayleigh_scattering, mie_scattering, extinction = atmosphere_numpy.getScatteringValues(config, pos)
+        sample_transmittance = np.exp(-dt * extinction)
+        sun_transmittance = atmosphere_numpy.getValFromTLUT(config, tLUT, pos, sun_dir)
+        psi_ms = atmosphere_numpy.getValFromTLUT(config, msLUT, pos, sun_dir)
+        in_scattering = (rayleigh_scattering * (rayleigh_phase * sun_transmittance + psi_ms)
+                         + mie_scattering * (mie_phase * sun_transmittance + psi_ms))
+        lum += (in_scattering - in_scattering * sample_transmittance) / extinction * transmittance
+        transmittance *= sample_transmittance
+    return lum, 2 * samples * sky_res[0] * sky_res[1]
+
+
+'''=============== Bloom ==============='''
+def gaussian_blur(img, size, linear):
+    # Separable blur of the bloom passes, per tap or with merged bilinear taps. Returns (img, fetches).
+    h, w = img.shape[:2]
+    s, t = texcoords(h, w)
+    weights = gen_gaussian_kernel.gaussian_weights(size)
+    if linear:
+        offsets, weights = gen_gaussian_kernel.linear_taps(weights)
+        offsets = np.concatenate([-np.array(offsets[:0:-1]), offsets])
+        weights = np.concatenate([weights[:0:-1], weights])
+    else:
+        offsets = np.arange(size) - size // 2
+    for axis in range(2):
+        out = np.zeros_like(img)
+        for o, wgt in zip(offsets, weights):
+            out += wgt * (fetch_linear(img, s + o / w, t) if axis == 0 else fetch_linear(img, s, t + o / h))
+        img = out
+    return img, 2 * len(offsets) * h * w
+
+
+'''=============== SSR (composite8.fsh) ==============='''
+def ssr(gbuffer, step_max_iter, div_max_iter):
+    # Reflected color of the reflective pixels, black where the ray leaves the
+    # screen or misses. Returns (color, hit mask, fetches).
+    depth, normal, albedo, projection = gbuffer['depth'], gbuffer['normal'], gbuffer['albedo'], gbuffer['projection']
+    h, w = depth.shape
+    s, t = texcoords(h, w)
+    view_all = screen_to_view(projection, s, t, depth)
+    # gdepth.x as written by composite.fsh.
+    dist_buffer = np.where(depth < 1, np.linalg.norm(view_all, axis=-1), 9999.0)
+    active = gbuffer['reflective'] & (depth < 1)
+    view = view_all[active]
+    n = normal[active]
+    incident = view / np.linalg.norm(view, axis=-1, keepdims=True)
+    direction = incident - 2 * np.sum(incident * n, axis=-1, keepdims=True) * n
+    state = seed(s[active], t[active])
+
+    count = len(view)
+    march = np.ones(count, dtype=bool)
+    flag = np.ones(count, dtype=bool)
+    hit = np.zeros(count, dtype=bool)
+    hit_coord = np.zeros((count, 2))
+    t_ray = np.zeros(count)
+    reflect_coord = view.copy()
+    reflect_dist = np.linalg.norm(reflect_coord, axis=-1)
+    fetches = 0
+    for i in range(step_max_iter):
+        idx = np.nonzero(march)[0]
+        if len(idx) == 0:
+            break
+        d, rc, v = direction[idx], reflect_coord[idx], view[idx]
+        k = np.linalg.norm((d - (np.sum(d * rc, -1) / np.sum(rc * rc, -1))[:, None] * rc)[:, :2], axis=-1)
+        t_step = np.minimum(0.001 * -v[:, 2] / k * (reflect_dist[idx] + 10), 2)
+        r, state[idx] = rand_composite8(state[idx])
+        t_step *= 0.75 + 0.5 * r
+        rc = v + (t_ray[idx] + t_step)[:, None] * d
+        behind = rc[:, 2] > 0
+        screen = view_to_screen(projection, rc)
+        dist = fetch_linear(dist_buffer, screen[:, 0], screen[:, 1])
+        fetches += len(idx)
+        outside = (screen[:, 0] < 0) | (screen[:, 0] > 1) | (screen[:, 1] < 0) | (screen[:, 1] > 1)
+        march[idx[behind | outside]] = False
+        live = ~(behind | outside)
+        reflect_coord[idx] = rc
+        reflect_dist[idx] = np.linalg.norm(rc, axis=-1)
+
+        crossing = live & flag[idx] & (reflect_dist[idx] > dist)
+        leaving = live & ~flag[idx] & (reflect_dist[idx] < dist)
+        if crossing.any():
+            # Bisect the step that went behind the depth buffer.
+            c = idx[crossing]
+            rd_c, sc, dc = reflect_dist[c], screen[crossing], dist[crossing]
+            lo, hi = np.zeros(len(c)), t_step[crossing]
+            for j in range(div_max_iter):
+                mid = 0.5 * (lo + hi)
+                rc_c = view[c] + (t_ray[c] + mid)[:, None] * direction[c]
+                rd_c = np.linalg.norm(rc_c, axis=-1)
+                sc = view_to_screen(projection, rc_c)
+                dc = fetch_linear(dist_buffer, sc[:, 0], sc[:, 1])
+                fetches += len(c)
+                behind_c = rd_c > dc
+                hi = np.where(behind_c, mid, hi)
+                lo = np.where(behind_c, lo, mid)
+                t_step[crossing] = mid
+            reflect_dist[c] = rd_c
+            fetches += len(c)
+            on_surface = ((rd_c > dc - 1e-2) & (rd_c < dc + 1e-2)
+                          & (np.abs(dc - fetch_nearest(dist_buffer, sc[:, 0], sc[:, 1])) < 1))
+            hit[c[on_surface]] = True
+            hit_coord[c[on_surface]] = sc[on_surface, :2]
+            march[c[on_surface]] = False
+            flag[c[~on_surface]] = False
+        flag[idx[leaving]] = True
+        t_ray[idx[live]] += t_step[live]
+
+    color = np.zeros((h, w, 3))
+    hit_mask = np.zeros((h, w), dtype=bool)
+    hit_mask[active] = hit
+    color[hit_mask] = fetch_linear(albedo, hit_coord[hit, 0], hit_coord[hit, 1])
+    return color, hit_mask, fetches
+
+
+def hiz_pyramid(depth, levels=ssr_hiz_levels):
+    # Level i is the min of 2x2 texels of level i - 1, the last row and column
+    # repeated for odd sizes, so it has ceil(size / 2^i) texels. composite4.fsh
+    # builds levels 1-3 from depthtex0, composite7.fsh levels 4-6 from level 3.
+    # Returns (levels, fetches of building them).
+    pyramid = [depth]
+    fetches = 0
+    for i in range(1, levels + 1):
+        d = pyramid[-1]
+        d = np.pad(d, ((0, d.shape[0] % 2), (0, d.shape[1] % 2)), mode='edge')
+        pyramid.append(d.reshape(d.shape[0] // 2, 2, d.shape[1] // 2, 2).min(axis=(1, 3)))
+        fetches += pyramid[-1].size * 4 ** ((i - 1) % 3 + 1)
+    return pyramid, fetches
+
+
+def hiz_cell_exit(start, ray, t, level, size):
+    # t just past the point where the ray leaves its cell of level at t.
+    cell_size = 2.0 ** level[:, None] / size
+    p = start[:, :2] + t[:, None] * ray[:, :2]
+    boundary = (np.floor(p / cell_size) + (ray[:, :2] > 0)) * cell_size
+    exit = ((boundary - start[:, :2]) / ray[:, :2]).min(axis=1)
+    return exit + 0.01 / np.abs(ray[:, :2] * size).max(axis=1)
+
+
+def ssr_hiz(gbuffer, max_iter, levels=ssr_hiz_levels, thickness=ssr_hiz_thickness, far=256.0):
+    # SSR_MODE 1 of composite8.fsh: the ray is a line in screen space, s, t and
+    # depth linear in its parameter, traversed through the min depth pyramid.
+    # While the ray stays in front of the min depth of its cell it skips the
+    # cell and goes up a level, else it goes down a level. Behind the depth
+    # buffer at level 0 it hits if it is less than thickness behind. Returns
+    # (color, hit mask, fetches), the fetches without building the pyramid.
+    depth, normal, albedo, projection = gbuffer['depth'], gbuffer['normal'], gbuffer['albedo'], gbuffer['projection']
+    h, w = depth.shape
+    size = np.array([w, h])
+    s, t = texcoords(h, w)
+    view_all = screen_to_view(projection, s, t, depth)
+    dist_buffer = np.where(depth < 1, np.linalg.norm(view_all, axis=-1), 9999.0)
+    pyramid, _ = hiz_pyramid(depth, levels)
+    active = gbuffer['reflective'] & (depth < 1)
+    view = view_all[active]
+    n = normal[active]
+    incident = view / np.linalg.norm(view, axis=-1, keepdims=True)
+    direction = incident - 2 * np.sum(incident * n, axis=-1, keepdims=True) * n
+
+    # Up to far, or to just before the camera plane.
+    with np.errstate(divide='ignore'):
+        length = np.where(direction[:, 2] > 0, np.minimum(far, -0.99 * view[:, 2] / direction[:, 2]), far)
+    start = np.stack([s[active], t[active], depth[active]], axis=-1)
+    ray = view_to_screen(projection, view + length[:, None] * direction) - start
+    ray[:, :2] = np.where(np.abs(ray[:, :2]) < 1e-9, 1e-9, ray[:, :2])
+    # Where the ray leaves the screen.
+    t_max = np.maximum(-start[:, :2] / ray[:, :2], (1 - start[:, :2]) / ray[:, :2]).min(axis=1)
+    t_max = np.minimum(t_max, 1.0)
+
+    count = len(view)
+    level = np.zeros(count, dtype=int)
+    t_ray = hiz_cell_exit(start, ray, np.zeros(count), level, size)
+    march = t_ray <= t_max
+    hit = np.zeros(count, dtype=bool)
+    hit_coord = np.zeros((count, 2))
+    fetches = 0
+    for i in range(max_iter):
+        idx = np.nonzero(march)[0]
+        if len(idx) == 0:
+            break
+        st, r, lv, tr = start[idx], ray[idx], level[idx], t_ray[idx]
+        p = st + tr[:, None] * r
+        cell = np.floor(p[:, :2] * size / 2.0 ** lv[:, None]).astype(int)
+        cell_depth = np.empty(len(idx))
+        for l in np.unique(lv):
+            sel = lv == l
+            ph, pw = pyramid[l].shape
+            cell_depth[sel] = pyramid[l][np.clip(cell[sel, 1], 0, ph - 1), np.clip(cell[sel, 0], 0, pw - 1)]
+        fetches += len(idx)
+        t_cell = hiz_cell_exit(st, r, tr, lv, size)
+        with np.errstate(divide='ignore'):
+            t_depth = np.where(r[:, 2] > 0, (cell_depth - st[:, 2]) / r[:, 2], np.inf)
+        in_front = p[:, 2] < cell_depth
+        crossing = in_front & (t_depth < t_cell)
+        # Skip the cell.
+        skip = in_front & ~crossing
+        t_ray[idx[skip]] = t_cell[skip]
+        level[idx[skip]] = np.minimum(lv[skip] + 1, levels)
+        # Refine where the ray goes behind the cell.
+        t_cross = np.where(crossing, np.maximum(tr, t_depth), tr)
+        down = (crossing | ~in_front) & (lv > 0)
+        t_ray[idx[down]] = t_cross[down]
+        level[idx[down]] = lv[down] - 1
+        # Behind a texel of depthtex0, a hit if it is close to the surface.
+        test = (crossing | ~in_front) & (lv == 0)
+        if test.any():
+            c = idx[test]
+            q = st[test] + t_cross[test, None] * r[test]
+            reflect_dist = np.linalg.norm(screen_to_view(projection, q[:, 0], q[:, 1], q[:, 2]), axis=-1)
+            dist = fetch_nearest(dist_buffer, q[:, 0], q[:, 1])
+            fetches += len(c)
+            on_surface = reflect_dist < dist + thickness
+            hit[c[on_surface]] = True
+            hit_coord[c[on_surface]] = q[on_surface, :2]
+            march[c[on_surface]] = False
+            t_ray[c[~on_surface]] = t_cell[test][~on_surface]
+        march[idx] &= t_ray[idx] <= t_max[idx]
+
+    color = np.zeros((h, w, 3))
+    hit_mask = np.zeros((h, w), dtype=bool)
+    hit_mask[active] = hit
+    color[hit_mask] = fetch_linear(albedo, hit_coord[hit, 0], hit_coord[hit, 1])
+    return color, hit_mask, fetches
+
+
+def error(img, ref, mask=None):
+    diff = np.abs(img - ref)
+    if mask is not None:
+        diff = diff[mask]
+    return (diff.mean(), diff.max()) if diff.size else (0.0, 0.0)
+
+
+def run(gbuffer, passes, settings, out_dir=None):
+    h, w = gbuffer['depth'].shape
+    pixels = h * w
+    print(f'G-buffer {w}x{h}, reference settings {reference}')
+    print(f'{"pass":<11} {"setting":<10} {"fetches":>10} {"per px":>8} {"time ms":>9} {"mean err":>10} {"max err":>10}')
+
+    def row(name, setting, fetches, seconds, err, per=pixels):
+        print(f'{name:<11} {str(setting):<10} {fetches:>10} {fetches / per:>8.2f} {seconds * 1000:>9.1f} {err[0]:>10.2e} {err[1]:>10.2e}')
+
+    def timed(fn, *args):
+        start = time.perf_counter()
+        res = fn(*args)
+        return res, time.perf_counter() - start
+
+    outputs = {}
+    if 'ssao' in passes:
+        (ref, _), _ = timed(ssao, gbuffer, reference['ssao'], ssao_radius, ssao_intensity, False)
+        # composite1/2 blur the AO before it is used, so what is left after the blur is what shows.
+        ref_blurred = gaussian_blur(ref, gaussian_size, True)[0]
+        blurred = {}
+        for baked in [True, False]:
+            name = 'ssao' if baked else 'ssao rand'
+            for samples in settings['ssao']:
+                (ao, fetches), seconds = timed(ssao, gbuffer, samples, ssao_radius, ssao_intensity, baked)
+                row(name, samples, fetches, seconds, error(ao, ref))
+                outputs[f'{name.replace(" ", "_")}_{samples}'] = ao
+                blurred[f'{name} {samples}'] = error(gaussian_blur(ao, gaussian_size, True)[0], ref_blurred)
+        for name, err in blurred.items():
+            print(f'{name:<14} after the {gaussian_size} tap blur: mean err {err[0]:.2e}, max err {err[1]:.2e}')
+    if 'atmosphere' in passes:
+        luts = atmosphere_lut.bake_luts()
+        altitude = np.radians(settings['sun_altitude'])
+        sun_dir = np.array([0.0, np.sin(altitude), -np.cos(altitude)])
+        (ref, _), _ = timed(sky_view, luts, sun_dir, reference['atmosphere'])
+        for samples in settings['atmosphere']:
+            (lum, fetches), seconds = timed(sky_view, luts, sun_dir, samples)
+            row('atmosphere', samples, fetches, seconds, error(lum, ref), per=sky_res[0] * sky_res[1])
+            outputs[f'atmosphere_{samples}'] = lum
+    if 'bloom' in passes:
+        for size in settings['bloom']:
+            (ref, _), _ = timed(gaussian_blur, gbuffer['albedo'], size, False)
+            for linear in [False, True]:
+                (img, fetches), seconds = timed(gaussian_blur, gbuffer['albedo'], size, linear)
+                row('bloom', f'{size}{" lin" if linear else ""}', fetches, seconds, error(img, ref))
+                outputs[f'bloom_{size}{"_linear" if linear else ""}'] = img
+    if 'ssr' in passes:
+        (ref, ref_hit, _), _ = timed(ssr, gbuffer, *reference['ssr'])
+        reflective = gbuffer['reflective']
+        hits = {}
+        for steps in settings['ssr_steps']:
+            for div in settings['ssr_div']:
+                (color, hit, fetches), seconds = timed(ssr, gbuffer, steps, div)
+                row('ssr', f'{steps}/{div}', fetches, seconds, error(color, ref, reflective))
+                outputs[f'ssr_{steps}_{div}'] = color
+                hits[f'ssr {steps}/{div}'] = hit
+        for max_iter in settings['ssr_hiz_iter']:
+            (color, hit, fetches), seconds = timed(ssr_hiz, gbuffer, max_iter)
+            row('ssr hiz', max_iter, fetches, seconds, error(color, ref, reflective))
+            outputs[f'ssr_hiz_{max_iter}'] = color
+            hits[f'ssr hiz {max_iter}'] = hit
+        if settings['ssr_hiz_iter']:
+            _, fetches = hiz_pyramid(gbuffer['depth'])
+            print(f'hiz pyramid build {fetches} fetches, {fetches / pixels:.2f} per px')
+        print(f'ssr reference hits {ref_hit.sum()} of {int(reflective.sum())} reflective pixels')
+        for name, hit in hits.items():
+            print(f'{name:<14} hits {hit.sum():>8}, same as the reference on {(hit == ref_hit)[reflective].mean():.1%} of them')
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+        for name, img in outputs.items():
+            np.save(os.path.join(out_dir, f'{name}.npy'), img)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--gbuffer', help='directory of G-buffer .npy dumps')
+    source.add_argument('--synthetic', action='store_true', help='use a generated test scene')
+    parser.add_argument('--passes', nargs='+', choices=['ssao', 'atmosphere', 'bloom', 'ssr'], default=['ssao', 'atmosphere', 'bloom', 'ssr'])
+    parser.add_argument('--ssao-samples', type=int, nargs='+', default=[8, 16, 32, 64], help='SSAO_SAMPLE_NUM')
+    parser.add_argument('--atmosphere-samples', type=int, nargs='+', default=[8, 16, atmosphere_samples, 64], help='ATMOSPHERE_SAMPLES')
+    parser.add_argument('--sun-altitude', type=float, default=20.0, help='degrees, for the atmosphere pass')
+    parser.add_argument('--gaussian-sizes', type=int, nargs='+', default=[9, gaussian_size], help='GAUSSIAN_KERNEL_SIZE')
+    parser.add_argument('--ssr-steps', type=int, nargs='+', default=[25, 50, ssr_step_max_iter], help='SSR_STEP_MAX_ITER')
+    parser.add_argument('--ssr-div', type=int, nargs='+', default=[4, ssr_div_max_iter], help='SSR_DIV_MAX_ITER')
+    parser.add_argument('--ssr-hiz-iter', type=int, nargs='*', default=[32, ssr_hiz_max_iter], help='SSR_HIZ_MAX_ITER of SSR_MODE 1')
+    parser.add_argument('--out', help='write the pass outputs as .npy to this directory')
+    args = parser.parse_args()
+
+    gbuffer = synthetic_gbuffer() if args.synthetic else load_gbuffer(args.gbuffer)
+    settings = dict(ssao=args.ssao_samples, atmosphere=args.atmosphere_samples, sun_altitude=args.sun_altitude,
+                    bloom=args.gaussian_sizes, ssr_steps=args.ssr_steps, ssr_div=args.ssr_div, ssr_hiz_iter=args.ssr_hiz_iter)
+    run(gbuffer, args.passes, settings, args.out)
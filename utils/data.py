@@ -1,43 +1,312 @@
-import struct
+import argparse
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
 import numpy as np
 import imageio
 
-data = np.zeros((256, 256, 4))
+import atmosphere_config as cfg
+import atmosphere_lut
+import ssao_kernel
+import sun_color
+
+data_width = 256
+# Rows of data.bin. The shaders were written against 256; with --compact only
+# the rows the layout uses are stored.
+data_height = 256
+
+# Storage formats of data.bin, always little endian, with the internal format,
+# pixel format and pixel type shaders.properties has to declare for them.
+DataFormat = namedtuple('DataFormat', ['dtype', 'channels', 'internal_format', 'pixel_format', 'pixel_type'])
+data_formats = {
+    'float32': DataFormat(np.dtype('<f4'), 4, 'RGBA16F', 'RGBA', 'FLOAT'),
+    'float16': DataFormat(np.dtype('<f2'), 4, 'RGBA16F', 'RGBA', 'HALF_FLOAT'),
+    # Shared exponent HDR texels in one 32 bit word. There is no alpha, which no pass reads.
+    'rgb9e5': DataFormat(np.dtype('<u4'), 1, 'RGB9_E5', 'RGB', 'UNSIGNED_INT_5_9_9_9_REV'),
+}
+data_bin_path = './utils/data.bin'
+data_png_path = './utils/data.png'
+# Fingerprints of the sections currently in data.bin, see update_data.
+manifest_path = './utils/data.json'
+# shaders.properties line and layout notes matching data.bin.
+properties_path = './utils/data.properties'
+
+rebuild_luts = False
+
+# A named block of rows [rows[0], rows[1]) of the data texture. The section is
+# rebuilt whenever one of its source files or params(config) changes;
+# build(section, config) returns its rows as a (rows, 256, 4) array. config is
+# the cfg.AtmosphereConfig the texture is built for.
+Section = namedtuple('Section', ['name', 'rows', 'sources', 'params', 'build'])
+
+
+def new_block(section):
+    return np.zeros((section.rows[1] - section.rows[0], data_width, 4))
+
 
 ''' COLOR TEMPERATURE '''
-with open('./utils/color_temperature.txt', 'r') as fin:
-    lines = fin.readlines()
+def build_color_temperature(section, config):
+    with open('./utils/color_temperature.txt', 'r') as fin:
+        lines = fin.readlines()
+
+    color_temperature_data = []
+    for line in lines:
+        if '10deg' in line:
+            color_temperature_data.append([float(i) for i in line.split()[6:9]] + [1])
 
-color_temperature_data = []
-for line in lines:
-    if '10deg' in line:
-        color_temperature_data.append([float(i) for i in line.split()[6:9]] + [1])
+    block = new_block(section)
+    block[0, :len(color_temperature_data)] = np.array(color_temperature_data)
+    return block
 
-data[0, :len(color_temperature_data)] = np.array(color_temperature_data)
 
 ''' WATER ABSORPTION '''
-water_absorption_data = imageio.imread('./utils/water_absorption.png') / 255.
-data[1, :water_absorption_data.shape[1]] = water_absorption_data ** (2.2)
+def build_water_absorption(section, config):
+    water_absorption_data = imageio.imread('./utils/water_absorption.png') / 255.
+    block = new_block(section)
+    block[0, :water_absorption_data.shape[1]] = water_absorption_data ** (2.2)
+    return block
+
 
 ''' WATER SCATTERING '''
-water_scattering_data = imageio.imread('./utils/water_scattering.png') / 255.
-water_scattering_data[..., :3] /= 2
-data[2, :water_scattering_data.shape[1]] = water_scattering_data ** (2.2)
+def build_water_scattering(section, config):
+    water_scattering_data = imageio.imread('./utils/water_scattering.png') / 255.
+    water_scattering_data[..., :3] /= 2
+    block = new_block(section)
+    block[0, :water_scattering_data.shape[1]] = water_scattering_data ** (2.2)
+    return block
+
 
 '''ATMOSPHERE'''
-import atmosphere_taichi as atmo
-data[3:67, :, :3] = atmo.tLUT_np
-data[3:67, :, 3] = 1
-data[67:99, :32, :3] = atmo.msLUT_np
-data[67:99, :32, 3] = 1
-
-img = np.array(data)
-img = img * 255
-img = img.astype(np.uint8)
-imageio.imwrite('./utils/data.png', img)
-
-data = list(data.reshape(-1))
-print(data)
-
-with open('./utils/data.bin', 'wb') as fout:
-    fout.write(struct.pack('f'*len(data), *data))
+@functools.lru_cache(maxsize=None)
+def atmosphere_luts(config):
+    # Both LUT sections come from one (cached) bake.
+    return atmosphere_lut.bake_luts(config, rebuild=rebuild_luts)
+
+
+def build_transmittance(section, config):
+    tLUT, msLUT = atmosphere_luts(config)
+    block = new_block(section)
+    block[:, :, :3] = tLUT
+    block[:, :, 3] = 1
+    return block
+
+
+def build_multiple_scattering(section, config):
+    tLUT, msLUT = atmosphere_luts(config)
+    block = new_block(section)
+    block[:, :msLUT.shape[1], :3] = msLUT
+    block[:, :msLUT.shape[1], 3] = 1
+    return block
+
+
+'''SUN COLOR'''
+def build_sun_color(section, config):
+    tLUT, msLUT = atmosphere_luts(config)
+    block = new_block(section)
+    block[0, :, :3] = sun_color.sun_color_ramp(config, tLUT, data_width)
+    block[0, :, 3] = 1
+    return block
+
+
+'''SSAO'''
+def build_ssao_kernel(section, config):
+    block = new_block(section)
+    kernel = ssao_kernel.ssao_kernel(data_width)
+    block[0, :, :2] = ssao_kernel.encode(kernel[:, :2])
+    block[0, :, 2] = kernel[:, 2]
+    block[0, :, 3] = 1
+    return block
+
+
+def build_ssao_noise(section, config):
+    noise = ssao_kernel.ssao_noise().reshape(-1, 3)
+    block = new_block(section)
+    block[0, :len(noise), :3] = noise
+    block[0, :, 3] = 1
+    return block
+
+
+# Rows 102 - 229 are left free, world0/composite1.fsh renders the sky-view LUT
+# into them. Sections stay below them, so --compact stores none of those rows.
+layout = [
+    Section('color_temperature', (0, 1), ['./utils/color_temperature.txt'], None, build_color_temperature),
+    Section('water_absorption', (1, 2), ['./utils/water_absorption.png'], None, build_water_absorption),
+    Section('water_scattering', (2, 3), ['./utils/water_scattering.png'], None, build_water_scattering),
+    Section('transmittance', (3, 67), [], atmosphere_lut.lut_inputs, build_transmittance),
+    Section('multiple_scattering', (67, 99), [], atmosphere_lut.lut_inputs, build_multiple_scattering),
+    Section('sun_color', (99, 100), ['./utils/sun_color.py'], atmosphere_lut.lut_inputs, build_sun_color),
+    Section('ssao_kernel', (100, 101), ['./utils/ssao_kernel.py'], None, build_ssao_kernel),
+    Section('ssao_noise', (101, 102), ['./utils/ssao_kernel.py'], None, build_ssao_noise),
+]
+
+
+def file_hash(path):
+    with open(path, 'rb') as fin:
+        return hashlib.sha256(fin.read()).hexdigest()
+
+
+def fingerprint(section, config):
+    h = hashlib.sha256(json.dumps([section.rows, section.params(config) if section.params else None]).encode())
+    for path in section.sources:
+        h.update(file_hash(path).encode())
+    return h.hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(manifest_path, 'r') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def layout_height():
+    return max(section.rows[1] for section in layout)
+
+
+def build_data(config, height=data_height):
+    data = np.zeros((height, data_width, 4))
+    for section in layout:
+        data[section.rows[0]:section.rows[1]] = section.build(section, config)
+    return data
+
+
+'''RGB9E5'''
+# EXT_texture_shared_exponent: 9 bit mantissas and a 5 bit exponent with bias 15.
+rgb9e5_max = 511 / 512 * 2.0**16
+
+
+def encode_rgb9e5(rgb):
+    rgb = np.clip(rgb, 0.0, rgb9e5_max)
+    max_c = rgb.max(axis=-1)
+    exp = np.maximum(-16, np.floor(np.log2(np.maximum(max_c, 2.0**-32)))) + 16
+    exp = np.where(np.floor(max_c / 2.0**(exp - 24) + 0.5) == 512, exp + 1, exp)
+    mantissa = np.floor(rgb / 2.0**(exp - 24)[..., None] + 0.5).astype(np.uint32)
+    return mantissa[..., 0] | mantissa[..., 1] << 9 | mantissa[..., 2] << 18 | exp.astype(np.uint32) << 27
+
+
+def decode_rgb9e5(words):
+    mantissa = np.stack([words & 511, words >> 9 & 511, words >> 18 & 511], axis=-1)
+    return mantissa * 2.0**((words >> 27).astype(np.float64) - 24)[..., None]
+
+
+def encode(data, fmt):
+    if fmt.channels == 1:
+        return encode_rgb9e5(data[..., :3])[..., None]
+    return data.astype(fmt.dtype)
+
+
+def decode(raw, fmt):
+    if fmt.channels == 1:
+        rgb = decode_rgb9e5(raw[..., 0])
+        return np.concatenate([rgb, np.ones_like(rgb[..., :1])], axis=-1)
+    return raw.astype(np.float64)
+
+
+def read_data(fmt, height):
+    return decode(np.fromfile(data_bin_path, dtype=fmt.dtype).reshape(height, data_width, fmt.channels), fmt)
+
+
+def write_data(raw, path=data_bin_path):
+    # Writes the texture buffer as-is, without going through Python floats.
+    np.ascontiguousarray(raw).tofile(path)
+
+
+def write_properties(data_format, height):
+    fmt = data_formats[data_format]
+    with open(properties_path, 'w') as fout:
+        fout.write('# Generated by utils/data.py, matches utils/data.bin.\n')
+        fout.write('# Rows of the data texture:\n')
+        for section in layout:
+            fout.write(f'#   {section.name:<20} {section.rows[0]:>3} - {section.rows[1] - 1:>3}\n')
+        fout.write(f'# world0/composite.fsh: #define DATA_TEXTURE_HEIGHT {height}\n')
+        fout.write(f'texture.composite.colortex15=textures/data.bin TEXTURE_2D {fmt.internal_format} '
+                   f'{data_width} {height} {fmt.pixel_format} {fmt.pixel_type}\n')
+
+
+def update_data(full=False, data_format='float32', compact=False, config=cfg.default_config):
+    # Rebuilds the sections whose inputs changed since the last run and patches
+    # their rows into the existing data.bin in place. Falls back to writing the
+    # whole texture when data.bin is missing, was changed by something else, or
+    # the layout or storage format changed.
+    manifest = load_manifest()
+    fingerprints = {section.name: fingerprint(section, config) for section in layout}
+    rows = {section.name: list(section.rows) for section in layout}
+    fmt = data_formats[data_format]
+    height = layout_height() if compact else data_height
+    shape = (height, data_width, fmt.channels)
+
+    full = (full
+            or not os.path.exists(data_bin_path)
+            or os.path.getsize(data_bin_path) != np.prod(shape) * fmt.dtype.itemsize
+            or manifest.get('format') != data_format
+            or manifest.get('height') != height
+            or manifest.get('rows') != rows
+            or manifest.get('data_hash') != file_hash(data_bin_path))
+
+    if full:
+        stale = layout
+        data = build_data(config, height)
+        start = time.perf_counter()
+        write_data(encode(data, fmt))
+        print(f'wrote {data_bin_path} as {data_format} {data_width}x{height} '
+              f'({os.path.getsize(data_bin_path) / 2**20:.2f} MB) in {(time.perf_counter() - start) * 1000:.1f} ms')
+    else:
+        stale = [section for section in layout if manifest['sections'].get(section.name) != fingerprints[section.name]]
+        if not stale:
+            print('data.bin is up to date')
+            return
+        raw = np.memmap(data_bin_path, dtype=fmt.dtype, mode='r+', shape=shape)
+        for section in stale:
+            raw[section.rows[0]:section.rows[1]] = encode(section.build(section, config), fmt)
+        raw.flush()
+        del raw
+
+    img = read_data(fmt, height)
+    img = img * 255
+    img = img.astype(np.uint8)
+    imageio.imwrite(data_png_path, img)
+    write_properties(data_format, height)
+
+    with open(manifest_path, 'w') as fout:
+        json.dump({'data_hash': file_hash(data_bin_path), 'format': data_format, 'height': height,
+                   'rows': rows, 'sections': fingerprints}, fout, indent=2)
+    print(f'rebuilt {", ".join(section.name for section in stale)}' + (' (full write)' if full else ''))
+
+
+def verify_data(config=cfg.default_config):
+    # Decodes data.bin and compares every section against its float64 build.
+    manifest = load_manifest()
+    fmt = data_formats[manifest['format']]
+    data = read_data(fmt, manifest['height'])
+    channels = 3 if fmt.channels == 1 else 4
+    print(f'{"section":<20} {"max abs err":>12} {"max rel err":>12}  ({manifest["format"]})')
+    for section in layout:
+        ref = section.build(section, config)[..., :channels]
+        err = np.abs(data[section.rows[0]:section.rows[1], :, :channels] - ref)
+        # Relative to the texel, ignoring texels too dark to matter.
+        significant = np.abs(ref) > 1e-3 * np.abs(ref).max()
+        rel = (err[significant] / np.abs(ref[significant])).max() if significant.any() else 0.0
+        print(f'{section.name:<20} {err.max():>12.3e} {rel:>12.3e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends, default=cfg.backend, help='atmosphere LUT backend, defaults to $ATMO_BACKEND')
+    parser.add_argument('--precision', choices=cfg.precisions, default=cfg.precision, help='float precision of the taichi bakes, defaults to $ATMO_PRECISION')
+    parser.add_argument('--rebuild', action='store_true', help='rebake the atmosphere LUTs even if they are cached')
+    parser.add_argument('--full', action='store_true', help='rebuild every section and rewrite data.bin')
+    parser.add_argument('--format', choices=data_formats, default='float32', help='storage format of data.bin')
+    parser.add_argument('--compact', action='store_true', help='store only the rows the layout uses')
+    parser.add_argument('--verify', action='store_true', help='decode data.bin and report the error of every section')
+    args = parser.parse_args()
+
+    cfg.backend = args.backend
+    cfg.precision = args.precision
+    rebuild_luts = args.rebuild
+    update_data(args.full or args.rebuild, args.format, args.compact)
+    if args.verify:
+        verify_data()
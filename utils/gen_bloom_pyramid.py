@@ -0,0 +1,165 @@
+import argparse
+import cv2
+import numpy as np
+from scipy import ndimage, optimize
+
+import gen_gaussian_kernel
+
+# Fits a downsample / blur / upsample bloom pyramid to a wide Gaussian. Level 0
+# is the full resolution bloom buffer, level l is downsampled l times by 2x2
+# box filtering (one bilinear fetch), blurred by a small separable Gaussian of
+# `taps` taps and read back with one bilinear fetch. The bloom is the weighted
+# sum of the levels, with the weights fitted to the target kernel.
+#
+# The pyramid is not shift invariant, so level responses are averaged over all
+# sub-pixel phases of the coarsest level before fitting. The sigma of the level
+# blur is fitted along with the blend weights.
+#
+# Level 0 is the existing colortex8, levels l > 0 are tiles of colortex10. Every
+# fetch of a tile is clamped to it, so the blur and the bilinear reads repeat
+# the tile edge like the screen edge of colortex8, and the fit pads the same way.
+target_size = 99
+levels_range = range(1, 6)
+taps_range = (3, 5, 7, 9)
+
+
+def target_kernel(size, n):
+    # The 2D kernel of gen_gaussian_kernel for this size, centered in n x n.
+    g = np.zeros(n)
+    g[n // 2 - size // 2:n // 2 + size // 2 + 1] = gen_gaussian_kernel.gaussian_weights(size)
+    return np.outer(g, g)
+
+
+def downsample(x):
+    return 0.5 * (x[..., 0::2] + x[..., 1::2])
+
+
+def upsample(y, factor):
+    # Bilinear read of a level at the full resolution texel centers.
+    pos = np.clip((np.arange(y.shape[-1] * factor) + 0.5) / factor - 0.5, 0, y.shape[-1] - 1)
+    i = np.minimum(np.floor(pos).astype(int), y.shape[-1] - 2)
+    f = pos - i
+    return y[..., i] * (1 - f) + y[..., i + 1] * f
+
+
+def level_response(level, weights, n):
+    # 1D impulse response of one level, averaged over the phases of the coarsest texel.
+    phases = 2 ** level
+    x = np.zeros((phases, n))
+    x[np.arange(phases), n // 2 + np.arange(phases)] = 1
+    for _ in range(level):
+        x = downsample(x)
+    x = ndimage.convolve1d(x, weights, axis=-1, mode='nearest')
+    x = upsample(x, phases)
+    return np.mean([np.roll(x[phase], -phase) for phase in range(phases)], axis=0)
+
+
+def blur_weights(taps, sigma):
+    return cv2.getGaussianKernel(taps, sigma).squeeze()
+
+
+def fit_blend(levels, weights, size):
+    # Returns (blend weights of levels 0..levels, max error, L1 error) of the 2D fit.
+    # Wide enough for the target and the coarsest level, a whole number of coarsest texels.
+    taps = len(weights)
+    n = 2 ** levels * int(np.ceil(max(4 * size, 2 ** levels * (taps + 4)) / 2 ** levels))
+    # The kernels are separable, so only a window around the center matters for the fit.
+    window = slice(n // 2 - size, n // 2 + size + 1)
+    responses = [level_response(level, weights, n)[window] for level in range(levels + 1)]
+    target = target_kernel(size, n)[window, window]
+    A = np.stack([np.outer(r, r).ravel() for r in responses], axis=1)
+    blend, _ = optimize.nnls(A, target.ravel())
+    err = np.abs((A @ blend).reshape(target.shape) - target)
+    return blend, err.max() / target.max(), err.sum() / target.sum()
+
+
+def fit_pyramid(levels, taps, size=target_size):
+    # Fits the sigma of the per level blur and the blend weights of the levels,
+    # minimizing the max error. Returns (blur weights, blend weights, max error, L1 error).
+    res = optimize.minimize_scalar(lambda sigma: fit_blend(levels, blur_weights(taps, sigma), size)[1],
+                                   bounds=(0.3, taps), method='bounded', options=dict(xatol=1e-3))
+    weights = blur_weights(taps, res.x)
+    return (weights, *fit_blend(levels, weights, size))
+
+
+def pyramid_fetches(levels, taps):
+    # Fetches per full resolution pixel: downsampling and blurring the levels
+    # (a level has 1 / 4^l of the pixels) plus one fetch per level to combine them.
+    blur = 2 * gen_gaussian_kernel.fetches(taps, True)
+    return sum((1 if level else 0) / 4 ** level + blur / 4 ** level for level in range(levels + 1)) + levels + 1
+
+
+def report(size=target_size):
+    full = 2 * size
+    print(f'target: {size} taps, {full} fetches per pixel unrolled, {2 * gen_gaussian_kernel.fetches(size, True)} linear')
+    print(f'{"levels":>6} {"taps":>4} {"fetches":>8} {"max err":>8} {"L1 err":>8}')
+    for levels in levels_range:
+        for taps in taps_range:
+            weights, blend, max_err, l1_err = fit_pyramid(levels, taps, size)
+            print(f'{levels:>6} {taps:>4} {pyramid_fetches(levels, taps):>8.2f} {max_err:>8.2%} {l1_err:>8.2%}')
+
+
+def write_snippets(f, levels, taps, size=target_size):
+    weights, blend, max_err, l1_err = fit_pyramid(levels, taps, size)
+    f.write(f'// Bloom pyramid approximating a {size} tap Gaussian, generated by utils/gen_bloom_pyramid.py.\n')
+    f.write(f'// {levels} levels with a {taps} tap blur: {pyramid_fetches(levels, taps):.2f} fetches per pixel instead of '
+            f'{2 * size}, max error {max_err:.2%} of the peak, L1 error {l1_err:.2%}.\n')
+    f.write(f'#define BLOOM_LEVELS {levels}\n')
+    f.write(f'const float bloom_level_weights[BLOOM_LEVELS + 1] = float[BLOOM_LEVELS + 1]'
+            f'({", ".join(f"{w:.6f}" for w in blend)});\n\n')
+    f.write('// Level 0 is colortex8 at full resolution. Level l > 0 is the tile\n')
+    f.write('// [bloom_tile(l), bloom_tile(l) + 0.5^l] of colortex10, so no tile overlaps level 0.\n')
+    f.write('const int colortex10Format = RGBA16F;\n\n')
+    f.write('vec2 bloom_tile(int level) {\n')
+    f.write('    return vec2(1.0 - exp2(1.0 - float(level)), 0.0);\n')
+    f.write('}\n\n')
+    f.write('// Keeps a fetch of level l > 0 half a texel inside its tile, so it repeats the tile edge.\n')
+    f.write('vec2 bloom_clamp(vec2 uv, int level) {\n')
+    f.write('    vec2 half_texel = 0.5 / vec2(viewWidth, viewHeight);\n')
+    f.write('    return clamp(uv, bloom_tile(level) + half_texel, bloom_tile(level) + exp2(-float(level)) - half_texel);\n')
+    f.write('}\n\n')
+    f.write('// Downsample pass of level l into colortex10, before the blur passes. One bilinear\n')
+    f.write('// fetch averages 2x2 texels of level l - 1.\n')
+    f.write('//     vec2 uv = (texcoord - bloom_tile(l)) * 2.0;\n')
+    f.write('//     gl_FragData[0] = l > 1 ? texture2D(colortex10, uv + bloom_tile(l - 1)) : texture2D(colortex8, uv);\n\n')
+    f.write(f'// Blur passes of colortex10, {taps} taps merged into bilinear fetches, see gen_gaussian_kernel.py.\n')
+    f.write('// Level 0 runs the same loop on colortex8 without bloom_clamp.\n')
+    offsets, merged = gen_gaussian_kernel.linear_taps(weights)
+    f.write(f'#define GAUSSIAN_FETCHES {len(offsets)}\n')
+    gen_gaussian_kernel.write_array(f, 'gaussian_offsets', offsets)
+    gen_gaussian_kernel.write_array(f, 'gaussian_weights', merged)
+    f.write('    int l = int(1.0 - log2(1.0 - texcoord.x));  // the tile of this texel\n')
+    f.write('    vec4 bloom_color = texture2D(colortex10, texcoord) * gaussian_weights[0];\n')
+    f.write('    for (int i = 1; i < GAUSSIAN_FETCHES; i++) {\n')
+    f.write('        vec2 d = offset(vec2(gaussian_offsets[i], 0));  // vec2(0, gaussian_offsets[i]) for the vertical pass\n')
+    f.write('        bloom_color += (texture2D(colortex10, bloom_clamp(texcoord + d, l)) + '
+            'texture2D(colortex10, bloom_clamp(texcoord - d, l))) * gaussian_weights[i];\n')
+    f.write('    }\n')
+    f.write('\n// Combine pass:\n')
+    f.write('    vec4 bloom = texture2D(colortex8, texcoord) * bloom_level_weights[0];\n')
+    f.write('    for (int l = 1; l <= BLOOM_LEVELS; l++)\n')
+    f.write('        bloom += texture2D(colortex10, bloom_clamp(texcoord * exp2(-float(l)) + bloom_tile(l), l)) * bloom_level_weights[l];\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=target_size, help='taps of the target Gaussian')
+    parser.add_argument('--levels', type=int, help='pyramid levels of the snippets, the best fit under --max-err by default')
+    parser.add_argument('--taps', type=int, help='taps of the per level blur')
+    parser.add_argument('--max-err', type=float, default=0.02, help='max error relative to the peak when picking a configuration')
+    parser.add_argument('--out', default='bloom_pyramid.txt')
+    args = parser.parse_args()
+
+    report(args.size)
+    levels, taps = args.levels, args.taps
+    if levels is None or taps is None:
+        # The cheapest configuration within the error budget.
+        fits = [(pyramid_fetches(l, t), l, t) for l in levels_range for t in taps_range
+                if (levels is None or l == levels) and (taps is None or t == taps)
+                and fit_pyramid(l, t, args.size)[2] <= args.max_err]
+        if not fits:
+            parser.error(f'no configuration fits within --max-err {args.max_err}')
+        _, levels, taps = min(fits)
+    with open(args.out, 'w') as f:
+        write_snippets(f, levels, taps, args.size)
+    print(f'wrote {args.out}: {levels} levels, {taps} taps')
@@ -1,16 +1,117 @@
+import argparse
 import cv2
 
 buffer = 'composite'
 arg = 'bloom_color'
+arg_type = 'vec4'
+swizzle = ''
 horizontal = False
+sizes = range(3, 100, 2)
 
-with open('gaussian_script.txt', 'w') as f:
-    for size in range(3, 100, 2):
+
+def gaussian_weights(size):
+    return cv2.getGaussianKernel(size, -1).squeeze()
+
+
+def linear_taps(weights):
+    # One side of the symmetric kernel, center first. Neighbouring taps k, k + 1
+    # with weights w1, w2 are merged into one bilinear fetch at k + w2 / (w1 + w2)
+    # with weight w1 + w2, so a size N kernel takes about (N + 1) / 2 fetches.
+    half = weights[len(weights) // 2:]
+    offsets, merged = [0.0], [half[0]]
+    for k in range(1, len(half), 2):
+        if k + 1 < len(half):
+            w = half[k] + half[k + 1]
+            offsets.append(k + half[k + 1] / w)
+            merged.append(w)
+        else:
+            offsets.append(float(k))
+            merged.append(half[k])
+    return offsets, merged
+
+
+def fetches(size, linear):
+    # Texture fetches of one pass.
+    return 2 * len(linear_taps(gaussian_weights(size))[0]) - 1 if linear else size
+
+
+def offset_vec(o):
+    return f'vec2({o}, 0)' if horizontal else f'vec2(0, {o})'
+
+
+def write_unrolled(f, sizes=sizes):
+    # One texture2D per tap, fully unrolled.
+    for size in sizes:
         f.write(f'    #if GAUSSIAN_KERNEL_SIZE == {size}\n')
-        f.write(f'    vec4 {arg} =\n')
-        for i, val in enumerate(cv2.getGaussianKernel(size, -1).squeeze()):
-            if horizontal:
-                f.write(f'        texture2D({buffer}, texcoord + offset(vec2({i - size // 2}, 0))) * {val:.6f}' + (';' if i == size - 1 else ' +') + '\n')
-            else:
-                f.write(f'        texture2D({buffer}, texcoord + offset(vec2(0, {i - size // 2}))) * {val:.6f}' + (';' if i == size - 1 else ' +') + '\n')
+        f.write(f'    {arg_type} {arg} =\n')
+        for i, val in enumerate(gaussian_weights(size)):
+            f.write(f'        texture2D({buffer}, texcoord + offset({offset_vec(i - size // 2)})){swizzle} * {val:.6f}'
+                    + (';' if i == size - 1 else ' +') + '\n')
         f.write('    #endif\n')
+
+
+def write_array(f, name, values):
+    f.write(f'const float {name}[GAUSSIAN_FETCHES] = float[GAUSSIAN_FETCHES]({", ".join(f"{v:.6f}" for v in values)});\n')
+
+
+def write_tables(f, sizes=sizes, forms=(True, False)):
+    # Const tables of one side of the kernel. With GAUSSIAN_KERNEL_STRIDE > 1 the
+    # taps are not adjacent texels and cannot be merged, so every tap is fetched.
+    # forms are the linear flags to write; the stride only selects between them
+    # if both are written.
+    if len(forms) > 1:
+        f.write('#if GAUSSIAN_KERNEL_STRIDE == 1\n')
+    for linear in forms:
+        if linear != forms[0]:
+            f.write('#else\n')
+        for size in sizes:
+            weights = gaussian_weights(size)
+            if linear:
+                offsets, weights = linear_taps(weights)
+            else:
+                offsets, weights = list(range(size // 2 + 1)), weights[size // 2:]
+            f.write(f'#if GAUSSIAN_KERNEL_SIZE == {size}\n')
+            f.write(f'#define GAUSSIAN_FETCHES {len(offsets)}\n')
+            write_array(f, 'gaussian_offsets', offsets)
+            write_array(f, 'gaussian_weights', weights)
+            f.write('#endif\n')
+    if len(forms) > 1:
+        f.write('#endif\n')
+
+
+def write_arrays(f):
+    # The tables and the loop walking them.
+    write_tables(f)
+    f.write('\n')
+    f.write(f'    {arg_type} {arg} = texture2D({buffer}, texcoord){swizzle} * gaussian_weights[0];\n')
+    f.write('    for (int i = 1; i < GAUSSIAN_FETCHES; i++) {\n')
+    f.write(f'        vec2 d = offset({offset_vec("gaussian_offsets[i]")});\n')
+    f.write(f'        {arg} += (texture2D({buffer}, texcoord + d){swizzle} + texture2D({buffer}, texcoord - d){swizzle}) * gaussian_weights[i];\n')
+    f.write('    }\n')
+
+
+def report():
+    print(f'{"size":>4} {"taps":>5} {"linear":>6} {"saved":>6}')
+    for size in sizes:
+        linear = fetches(size, True)
+        print(f'{size:>4} {size:>5} {linear:>6} {size - linear:>5} ({1 - linear / size:.0%})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--form', choices=['unrolled', 'array'], default='array',
+                        help='unrolled texture2D taps, or const tables of merged bilinear taps and a loop')
+    parser.add_argument('--buffer', default=buffer)
+    parser.add_argument('--arg', default=arg)
+    parser.add_argument('--type', default=arg_type)
+    parser.add_argument('--swizzle', default=swizzle, help='e.g. .z to blur a single channel')
+    parser.add_argument('--horizontal', action='store_true')
+    parser.add_argument('--out', default='gaussian_script.txt')
+    parser.add_argument('--report', action='store_true', help='print the fetches per pass of every size')
+    args = parser.parse_args()
+    buffer, arg, arg_type, swizzle, horizontal = args.buffer, args.arg, args.type, args.swizzle, args.horizontal
+
+    with open(args.out, 'w') as f:
+        write_unrolled(f) if args.form == 'unrolled' else write_arrays(f)
+    if args.report:
+        report()
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Content-addressed store for baked LUTs: every entry is a directory named after
+# the hash of its bake inputs and holds one .npy per array. Entries are evicted
+# least recently used first once the cache grows past cache_max_bytes.
+cache_dir = os.environ.get('ATMO_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+cache_max_bytes = int(float(os.environ.get('ATMO_CACHE_MAX_MB', 256)) * 2**20)
+
+
+def cache_key(inputs):
+    # inputs must be JSON serializable; tuples and lists hash the same.
+    text = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def load(key, names):
+    path = os.path.join(cache_dir, key)
+    try:
+        arrays = [np.load(os.path.join(path, f'{name}.npy')) for name in names]
+    except (OSError, ValueError):
+        return None
+    os.utime(path)  # Mark as recently used.
+    return arrays
+
+
+def store(key, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    # Write into a scratch directory and rename it, so readers never see half an entry.
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), array)
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Another process stored the same entry first.
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(keep=key)
+
+
+def entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict(max_bytes=None, keep=None):
+    max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [entry for entry in os.scandir(cache_dir) if entry.is_dir() and not entry.name.startswith('.')]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry_size(entry.path) for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry.name == keep:
+            continue
+        total -= entry_size(entry.path)
+        shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,110 @@
+import argparse
+import dataclasses
+import numpy as np
+
+import atmosphere_config as cfg
+
+# Lookups into the baked LUTs. Every bake stores texel i of an n texel axis at
+# coordinate i / (n - 1), so the first and last texels sit on the ends of the
+# range, and the shaders fetch texel centers the same way, at
+# (0.5 + u * (n - 1)) / n. Lookups clamp to the edge texels.
+#
+# LUTs are (v, u, channels) arrays here; atmosphere_taichi.lut_sample is the
+# same lookup on a [u, v] indexed taichi field. 'cubic' is Catmull-Rom, which
+# passes through the texels, clamped to the 2x2 texels around the point so it
+# does not overshoot next to the kinks of the LUTs.
+
+
+def texel_coords(u, n):
+    # The texel at or below u and the weight of the next one.
+    x = np.clip(u, 0.0, 1.0) * (n - 1)
+    i = np.clip(np.floor(x), 0, n - 2).astype(np.int64)
+    return i, x - i
+
+
+def linear_weights(f):
+    # Weights of texels i, i + 1.
+    return np.stack([1 - f, f], axis=-1)
+
+
+def cubic_weights(f):
+    # Weights of texels i - 1 .. i + 2.
+    return np.stack([f * (-0.5 + f * (1.0 - 0.5 * f)),
+                     1.0 + f * f * (-2.5 + 1.5 * f),
+                     f * (0.5 + f * (2.0 - 1.5 * f)),
+                     f * f * (-0.5 + 0.5 * f)], axis=-1)
+
+
+def sample(lut, u, v, lut_filter='linear'):
+    # Looks lut up at every (u, v) of the broadcast coordinates, returns (..., channels).
+    if lut_filter not in cfg.lut_filters:
+        raise ValueError(f'unknown LUT filter {lut_filter!r}, expected one of {", ".join(cfg.lut_filters)}')
+    u, v = np.broadcast_arrays(u, v)
+    h, w = lut.shape[:2]
+    i, fu = texel_coords(u, w)
+    j, fv = texel_coords(v, h)
+    if lut_filter == 'linear':
+        first, wu, wv = 0, linear_weights(fu), linear_weights(fv)
+    else:
+        first, wu, wv = -1, cubic_weights(fu), cubic_weights(fv)
+    res = 0.0
+    lo = hi = None
+    for b in range(wv.shape[-1]):
+        for a in range(wu.shape[-1]):
+            texel = lut[np.clip(j + first + b, 0, h - 1), np.clip(i + first + a, 0, w - 1)]
+            res = res + (wv[..., b] * wu[..., a])[..., None] * texel
+            if lut_filter == 'cubic' and 1 <= a <= 2 and 1 <= b <= 2:
+                lo = texel if lo is None else np.minimum(lo, texel)
+                hi = texel if hi is None else np.maximum(hi, texel)
+    if lut_filter == 'cubic':
+        res = np.clip(res, lo, hi)
+    return res
+
+
+def lut_uv(config, height, sun_cos_theta):
+    # LUT coordinates of a point at height (megameters from the planet center)
+    # with the sun at sun_cos_theta from its zenith.
+    return 0.5 + 0.5 * sun_cos_theta, (height - config.ground_radius) / (config.atmosphere_radius - config.ground_radius)
+
+
+'''=============== Report ==============='''
+def lookup_error(lut, ref, lut_filter, points=1 << 16, seed=0):
+    # Max and mean abs error, relative to the peak of ref, of lookups into lut
+    # against lookups into the finer ref at random points.
+    u, v = np.random.default_rng(seed).random((2, points))
+    err = np.abs(sample(lut, u, v, lut_filter) - sample(ref, u, v, 'cubic')) / np.abs(ref).max()
+    return err.max(), err.mean()
+
+
+# Fewer multiple scattering samples than the default bake, so the msLUT at
+# twice the default resolution bakes in seconds.
+report_config = dataclasses.replace(cfg.default_config, ms_samples=256)
+
+
+def report(config=report_config, scales=(1, 2, 4)):
+    # Error of linear and cubic lookups into LUTs baked at the default resolution
+    # and at fractions of it, against a LUT baked at twice the default resolution.
+    import atmosphere_taichi
+    bakes = dict(tLUT=('tLUT_res', atmosphere_taichi.bake_transmittance),
+                 msLUT=('msLUT_res', atmosphere_taichi.bake_multiscatter))
+    print(f'{"LUT":<6} {"res":>9} {"filter":>7} {"max err":>10} {"mean err":>10}')
+    for name, (res_name, bake) in bakes.items():
+        res = getattr(config, res_name)
+        luts = {}
+        for scale in (0.5, *scales):
+            scaled = (int(res[0] / scale), int(res[1] / scale))
+            luts[scaled] = bake(dataclasses.replace(config, **{res_name: scaled}))
+        ref_res, *rest = luts
+        for scaled in rest:
+            for lut_filter in cfg.lut_filters:
+                max_err, mean_err = lookup_error(luts[scaled], luts[ref_res], lut_filter)
+                print(f'{name:<6} {f"{scaled[0]}x{scaled[1]}":>9} {lut_filter:>7} {max_err:>10.2e} {mean_err:>10.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends[:2], default=cfg.backend if cfg.backend != 'numpy' else 'taichi-cpu')
+    args = parser.parse_args()
+
+    cfg.backend = args.backend
+    report()
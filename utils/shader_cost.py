@@ -0,0 +1,276 @@
+import argparse
+import math
+import os
+import re
+import numpy as np
+
+import build_shaders
+
+# Static worst-case cost per pixel of the world0 composite passes at an option
+# preset: texture fetches, transcendental calls and loop iterations. #defines
+# and #if blocks are resolved like build_shaders.preprocess does. Conditions on
+# runtime values are not: loops run their full trip count (break is ignored),
+# an if costs its most expensive branch and both sides of ?: count. A call
+# costs the body of the called function. Passes generated from
+# utils/shader_templates are analyzed from their template with every Gaussian
+# size expanded, so a preset can pick any size.
+#
+# A preset maps #define names to values. NAME applies to every pass that
+# defines it, pass:NAME, e.g. composite1:GAUSSIAN_KERNEL_SIZE, to one pass.
+shader_dir = os.path.join(build_shaders.shader_dir, 'world0')
+template_dir = os.path.join(build_shaders.template_dir, 'world0')
+
+presets = {
+    'default': {},
+    'low': {'SSAO_SAMPLE_NUM': 8, 'ATMOSPHERE_SAMPLES': 16, 'SSR_STEP_MAX_ITER': 50, 'SSR_DIV_MAX_ITER': 4,
+            'composite1:GAUSSIAN_KERNEL_SIZE': 15, 'composite2:GAUSSIAN_KERNEL_SIZE': 15},
+    'high': {'SSAO_SAMPLE_NUM': 64, 'ATMOSPHERE_SAMPLES': 64, 'SSR_STEP_MAX_ITER': 200, 'SSR_DIV_MAX_ITER': 16,
+             'composite1:GAUSSIAN_KERNEL_SIZE': 63, 'composite2:GAUSSIAN_KERNEL_SIZE': 63},
+}
+
+fetch_functions = {'texture', 'texture2D', 'texture3D', 'texture2DLod', 'texture3DLod', 'textureLod',
+                   'textureGrad', 'textureOffset', 'texelFetch', 'shadow2D'}
+# A vector argument still counts as one call.
+transcendental_functions = {'exp', 'exp2', 'log', 'log2', 'pow', 'sqrt', 'inversesqrt',
+                            'sin', 'cos', 'tan', 'asin', 'acos', 'atan'}
+columns = ['fetches', 'transcendentals', 'iterations']
+
+call_re = re.compile(r'\b(\w+)\s*\(')
+# Return type, name and parameters of a function definition, before its {.
+signature_re = re.compile(r'(\w+)\s+(\w+)\s*\(([^()]*)\)\s*$')
+
+
+def pass_names():
+    names = [name for name in os.listdir(shader_dir) if re.fullmatch(r'composite\d*\.fsh', name)]
+    return sorted(names, key=lambda name: int(re.sub(r'\D', '', name) or -1))
+
+
+def pass_source(name, helpers):
+    template = os.path.join(template_dir, name)
+    if os.path.exists(template):
+        with open(template) as fin:
+            return build_shaders.expand(fin.read(), helpers, all_sizes=True)
+    with open(os.path.join(shader_dir, name)) as fin:
+        return fin.read()
+
+
+def pass_defines(preset, name):
+    # The overrides of preset for the pass name, pass:NAME over NAME.
+    overrides = {key: value for key, value in preset.items() if ':' not in key}
+    for key, value in preset.items():
+        if ':' in key and key.split(':', 1)[0] == name.split('.')[0]:
+            overrides[key.split(':', 1)[1]] = value
+    return overrides
+
+
+'''=============== Parser ==============='''
+def match_close(text, pos):
+    # Index after the bracket closing the one at pos.
+    opening = text[pos]
+    closing = {'(': ')', '{': '}'}[opening]
+    depth = 0
+    for i in range(pos, len(text)):
+        if text[i] == opening:
+            depth += 1
+        elif text[i] == closing:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    raise ValueError(f'unbalanced {opening}')
+
+
+def split_args(text):
+    # Arguments of a call, text without the parentheses.
+    args, depth, start = [], 0, 0
+    for i, c in enumerate(text):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            args.append(text[start:i].strip())
+            start = i + 1
+    return args + [text[start:].strip()] if text.strip() else []
+
+
+def strip_comments(text):
+    return re.sub(r'//[^\n]*', '', re.sub(r'/\*.*?\*/', '', text, flags=re.S))
+
+
+def parse_functions(text):
+    # Function name: (parameter names, body) of the definitions in text.
+    functions = {}
+    start, i = 0, 0
+    while i < len(text):
+        if text[i] == '{':
+            end = match_close(text, i)
+            m = signature_re.search(text[start:i])
+            if m:
+                params = [re.findall(r'\w+', param)[-1] for param in m.group(3).split(',') if param.strip() and param.strip() != 'void']
+                functions[m.group(2)] = (params, text[i + 1:end - 1])
+            start = i = end
+            continue
+        if text[i] == ';':
+            start = i + 1
+        i += 1
+    return functions
+
+
+def evaluate(expr, env):
+    # Value of a constant expression over the numbers of env, None if it is not constant.
+    try:
+        expr = re.sub(r'\b[A-Za-z_]\w*\b', lambda m: m.group(0) if m.group(0) in ('int', 'float') else repr(env[m.group(0)]), expr)
+        return eval(expr, {'__builtins__': {}, 'int': int, 'float': float})
+    except (KeyError, SyntaxError, NameError, TypeError, ZeroDivisionError):
+        return None
+
+
+def trip_count(header, env):
+    # Iterations of for (header), which has to count an int by a constant step.
+    init, cond, step = (part.strip() for part in header.split(';'))
+    m_init = re.fullmatch(r'(?:int\s+)?(\w+)\s*=\s*(.+)', init)
+    m_cond = re.fullmatch(r'(\w+)\s*(<=|<|>=|>)\s*(.+)', cond)
+    m_step = re.fullmatch(r'(\w+)\s*(\+\+|--)|(\+\+|--)\s*(\w+)|(\w+)\s*(\+=|-=)\s*(.+)', step)
+    if m_init and m_cond and m_step:
+        start, stop = evaluate(m_init.group(2), env), evaluate(m_cond.group(3), env)
+        ops = [op for op in m_step.groups() if op in ('++', '--', '+=', '-=')]
+        delta = {'++': 1, '--': -1}.get(ops[0]) or evaluate(m_step.group(7), env) * (1 if ops[0] == '+=' else -1)
+        if start is not None and stop is not None and delta:
+            stop += {'<': 0, '<=': 1, '>': 0, '>=': -1}[m_cond.group(2)]
+            return max(0, math.ceil((stop - start) / delta))
+    raise ValueError(f'cannot bound the loop for ({header})')
+
+
+class Analyzer:
+    # Worst-case cost of the functions of one pass, as arrays over columns.
+    def __init__(self, text, defines):
+        self.functions = parse_functions(text)
+        self.defines = {}
+        for name, value in defines.items():
+            self.defines[name] = value if isinstance(value, int) else evaluate(str(value), {})
+        self.defines = {name: value for name, value in self.defines.items() if value is not None}
+        self.cache = {}
+
+    def function_cost(self, name, args, env):
+        # Parameters bound to constant arguments can bound loops of the body.
+        params, body = self.functions[name]
+        bound = {param: value for param, value in zip(params, (evaluate(arg, env) for arg in args)) if value is not None}
+        key = (name, tuple(sorted(bound.items())))
+        if key not in self.cache:
+            self.cache[key] = self.block_cost(body, {**self.defines, **bound})
+        return self.cache[key]
+
+    def expr_cost(self, text, env):
+        cost = np.zeros(len(columns), dtype=np.int64)
+        for m in call_re.finditer(text):
+            name = m.group(1)
+            if name in fetch_functions:
+                cost[0] += 1
+            elif name in transcendental_functions:
+                cost[1] += 1
+            elif name in self.functions:
+                args = split_args(text[m.end():match_close(text, m.end() - 1) - 1])
+                cost += self.function_cost(name, args, env)
+        return cost
+
+    def statement_cost(self, text, pos, env):
+        # Cost of the statement at pos and the index after it.
+        pos = re.compile(r'\s*').match(text, pos).end()
+        if text[pos] == '{':
+            end = match_close(text, pos)
+            return self.block_cost(text[pos + 1:end - 1], env), end
+        m = re.compile(r'(for|if|while)\s*\(').match(text, pos)
+        if not m:
+            end = pos
+            while text[end] != ';':
+                end = match_close(text, end) if text[end] in '({' else end + 1
+            return self.expr_cost(text[pos:end], env), end + 1
+        if m.group(1) == 'while':
+            raise ValueError('cannot bound while loops')
+        close = match_close(text, m.end() - 1)
+        header = text[m.end():close - 1]
+        body, end = self.statement_cost(text, close, env)
+        if m.group(1) == 'for':
+            unit = np.array([0, 0, 1])
+            return self.expr_cost(header, env) + trip_count(header, env) * (body + unit), end
+        m_else = re.compile(r'\s*else\b').match(text, end)
+        if m_else:
+            other, end = self.statement_cost(text, m_else.end(), env)
+            body = np.maximum(body, other)
+        return self.expr_cost(header, env) + body, end
+
+    def block_cost(self, text, env):
+        cost = np.zeros(len(columns), dtype=np.int64)
+        pos = 0
+        while text[pos:].strip():
+            statement, pos = self.statement_cost(text, pos, env)
+            cost += statement
+        return cost
+
+    def main_cost(self):
+        return self.function_cost('main', [], self.defines)
+
+
+def analyze(preset):
+    # Pass name: worst-case cost per pixel at preset.
+    helpers = build_shaders.load_helpers()
+    costs = {}
+    known = set()
+    for name in pass_names():
+        source = pass_source(name, helpers)
+        known.update(m.group(1) for m in map(build_shaders.define_re.match, source.split('\n')) if m)
+        lines, defines = build_shaders.preprocess(source, pass_defines(preset, name))
+        costs[name] = Analyzer(strip_comments('\n'.join(lines)), defines).main_cost()
+    unknown = {key for key in preset if key.split(':')[-1] not in known}
+    if unknown:
+        raise ValueError(f'no pass defines {", ".join(sorted(unknown))}')
+    return costs
+
+
+'''=============== Report ==============='''
+def print_table(costs, other=None, resolution=(1920, 1080)):
+    # Per pass and total cost, with other as the before -> after of a diff. The
+    # last column is the fetches per frame, in millions, if every pixel took the
+    # worst case, also in passes that only draw part of the screen.
+    pixels = resolution[0] * resolution[1] / 1e6
+    names = columns + ['Mfetches/frame']
+    rows = {name: np.append(cost, cost[0] * pixels) for name, cost in costs.items()}
+    rows['total'] = sum(rows.values())
+    if other is not None:
+        other_rows = {name: np.append(cost, cost[0] * pixels) for name, cost in other.items()}
+        other_rows['total'] = sum(other_rows.values())
+    print(f'{"pass":<16} ' + ' '.join(f'{name:>20}' for name in names))
+    for name, row in rows.items():
+        cells = [f'{value:.6g}' for value in row]
+        if other is not None:
+            cells = [f'{value:.6g} -> {after:.6g}' for value, after in zip(row, other_rows[name])]
+        print(f'{name:<16} ' + ' '.join(f'{cell:>20}' for cell in cells))
+
+
+def parse_preset(tokens):
+    # Preset of preset names and NAME=VALUE tokens, later ones override.
+    preset = {}
+    for token in tokens:
+        if '=' in token:
+            key, value = token.split('=', 1)
+            preset[key] = int(value) if re.fullmatch(r'-?\d+', value) else value
+        elif token in presets:
+            preset.update(presets[token])
+        else:
+            raise argparse.ArgumentTypeError(f'unknown preset {token!r}, expected NAME=VALUE or one of {", ".join(presets)}')
+    return preset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('preset', nargs='*', default=['default'], help='preset names and NAME=VALUE or pass:NAME=VALUE overrides')
+    parser.add_argument('--diff', nargs='+', metavar='PRESET', help='compare against this preset')
+    parser.add_argument('--resolution', type=int, nargs=2, default=(1920, 1080), metavar=('WIDTH', 'HEIGHT'))
+    args = parser.parse_args()
+
+    try:
+        costs = analyze(parse_preset(args.preset))
+        other = analyze(parse_preset(args.diff)) if args.diff else None
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    print_table(costs, other, args.resolution)
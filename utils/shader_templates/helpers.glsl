@@ -0,0 +1,133 @@
+// Functions shared by several world0 passes, inlined by //@helper name, see utils/build_shaders.py.
+
+vec3 screen_coord_to_view_coord(vec3 screen_coord) {
+    vec4 ndc_coord = vec4(screen_coord * 2 - 1, 1);
+    vec4 clid_coord = gbufferProjectionInverse * ndc_coord;
+    vec3 view_coord = clid_coord.xyz / clid_coord.w;
+    return view_coord;
+}
+
+vec3 view_coord_to_screen_coord(vec3 view_coord) {
+    vec4 clid_coord = gbufferProjection * vec4(view_coord, 1);
+    vec3 ndc_coord = clid_coord.xyz / clid_coord.w;
+    vec3 screen_coord = ndc_coord * 0.5 + 0.5;
+    return screen_coord;
+}
+
+vec2 offset(vec2 ori) {
+    return vec2(ori.x * GAUSSIAN_KERNEL_STRIDE / viewWidth, ori.y * GAUSSIAN_KERNEL_STRIDE / viewHeight);
+}
+
+vec3 view_coord_to_world_coord(vec3 view_coord) {
+    vec3 world_coord = (gbufferModelViewInverse * vec4(view_coord, 1.0)).xyz;
+    return world_coord;
+}
+
+float fog(float dist, float decay) {
+    dist = dist < 0 ? 0 : dist;
+    dist = dist * decay / 16 + 1;
+    dist = dist * dist;
+    dist = dist * dist;
+    dist = dist * dist;
+    dist = dist * dist;
+    return 1 / dist;
+}
+
+float grayscale(vec3 color) {
+    return color.r * 0.299 + color.g * 0.587 + color.b * 0.114;
+}
+
+vec3 LUT_water_scattering(float decay) {
+    return texture2D(colortex15, vec2((0.5 + (1 - decay) * 255) / viewWidth, 2.5 / viewHeight)).rgb;
+}
+
+vec3 LUT_sun_color(vec3 sunDir) {
+	float sunCosZenithAngle = sunDir.y;
+    vec2 uv = vec2((0.5 + 255 * clamp(0.5 + 0.5 * sunCosZenithAngle, 0.0, 1.0)) / viewWidth,
+                   99.5 / viewHeight);
+    return texture2D(colortex15, uv).rgb;
+}
+
+vec3 LUT_sky(vec3 rayDir) {
+    float height = length(viewPos);
+    vec3 up = viewPos / height;
+    
+    float horizonAngle = acos(sqrt(height * height - groundRadiusMM * groundRadiusMM) / height);
+    float altitudeAngle = horizonAngle - acos(dot(rayDir, up)); // Between -PI/2 and PI/2
+    float azimuthAngle; // Between 0 and 2*PI
+    if (abs(altitudeAngle) > (0.5*PI - .0001)) {
+        // Looking nearly straight up or down.
+        azimuthAngle = 0.0;
+    } else {
+        vec3 projectedDir = normalize(rayDir - up*(dot(rayDir, up)));
+        float sinTheta = projectedDir.x;
+        float cosTheta = -projectedDir.z;
+        azimuthAngle = atan(sinTheta, cosTheta) + PI;
+    }
+    
+    float v = 0.5 + 0.5*sign(altitudeAngle)*sqrt(abs(altitudeAngle)*2.0/PI);
+    vec2 uv = vec2(azimuthAngle / (2.0*PI), v);
+    uv.x = (0.5 + uv.x * 255) / viewWidth;
+    uv.y = (0.5 + uv.y * 127 + 102) / viewHeight;
+    return texture2D(colortex15, uv).rgb;
+}
+
+vec3 cal_water_color(float self_lum, float target_lum, float y_diff, float decay) {
+    float cutoff = target_lum < 1e-3 ? abs((target_lum - self_lum) * 15 / y_diff) + 1e-3 : 1;
+    cutoff = cutoff > 1 ? 1 : cutoff;
+    float max_ = -log(decay);
+    vec3 res = vec3(0.0);
+    for (int i = 0; i < 8; i++) {
+        float k = -log(1 - (i + 0.5) / 8 * (1 - decay)) / max_ / cutoff;
+        k = self_lum > target_lum ? (k > 1 ? 1 : k) : (k - (1 / cutoff) < -1 ? 0 : k - (1 / cutoff) + 1);
+        res += (1 - (i + 0.5) / 8 * (1 - decay)) * LUT_water_scattering(mix(self_lum, target_lum, k));
+    }
+    res = res / 8 * (1 - decay);
+    return res;
+}
+
+vec4 hiz_level_rect(int level) {
+    // Texels of level of the Hi-Z pyramid, offset in xy and size in zw. Level 0
+    // is depthtex0, level i is ceil(size / 2^i) texels of colortex9 on the
+    // right of level i - 1, each the min depth of 2x2 texels of level i - 1.
+    vec2 size = vec2(viewWidth, viewHeight);
+    float offset = 0.0;
+    for (int i = 1; i <= SSR_HIZ_LEVELS; i++) {
+        if (i > level) break;
+        if (i > 1) offset += size.x;
+        size = ceil(size * 0.5);
+    }
+    return vec4(offset, 0.0, size);
+}
+
+float hiz_fetch(int level, vec2 cell) {
+    vec4 rect = hiz_level_rect(level);
+    cell = clamp(cell, vec2(0.0), rect.zw - 1.0);
+    float depth;
+    if (level == 0) depth = texture2D(depthtex0, (cell + 0.5) / vec2(viewWidth, viewHeight)).x;
+    else depth = texture2D(colortex9, (rect.xy + cell + 0.5) / vec2(viewWidth, viewHeight)).x;
+    return depth;
+}
+
+float hiz_build(int first, int last) {
+    // Value of this pixel of colortex9 if it is a texel of levels first to
+    // last, which are at most 3 levels above level first - 1, else -1.
+    vec2 pixel = floor(gl_FragCoord.xy);
+    for (int level = first; level <= last; level++) {
+        vec4 rect = hiz_level_rect(level);
+        vec2 cell = pixel - rect.xy;
+        if (cell.x >= 0.0 && cell.y >= 0.0 && cell.x < rect.z && cell.y < rect.w) {
+            float footprint = exp2(float(level - first + 1));
+            float depth = 1.0;
+            for (int y = 0; y < 8; y++) {
+                if (float(y) >= footprint) break;
+                for (int x = 0; x < 8; x++) {
+                    if (float(x) >= footprint) break;
+                    depth = min(depth, hiz_fetch(first - 1, cell * footprint + vec2(x, y)));
+                }
+            }
+            return depth;
+        }
+    }
+    return -1.0;
+}
@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+import numpy as np
+
+import atmosphere_config as cfg
+import atmosphere_lut
+import data
+
+# Sky-view LUTs baked for a range of sun altitudes and stacked into a 3D
+# texture, so world0/composite1.fsh can look the sky up instead of ray
+# marching it every frame. Layer k holds the sun altitude
+#   sign(w) * w^2 * PI / 2, with w = 2 * k / (layers - 1) - 1,
+# and the sun in the -z direction; the shader rotates the azimuth into that frame.
+# Written where the shaders.properties line of sky_atlas.properties loads it.
+sky_atlas_path = './shaders/textures/sky_atlas.bin'
+sky_atlas_properties_path = './utils/sky_atlas.properties'
+sky_atlas_layers = 16
+
+# Texels and steps of the per-frame sky march in world0/composite1.fsh.
+shader_sky_texels = 256 * 128
+shader_sky_steps = 32
+
+
+def bake_sky_atlas(config=cfg.default_config, layers=sky_atlas_layers):
+    tLUT, msLUT = atmosphere_lut.bake_luts(config)
+    import atmosphere_taichi
+    fields = atmosphere_taichi.load_fields(config, tLUT, msLUT)
+    start = time.perf_counter()
+    atlas = atmosphere_taichi.bake_sky_atlas(*fields, layers)
+    print(f'baked {layers} sun altitudes of {atmosphere_taichi.skyLUT_res[0]}x{atmosphere_taichi.skyLUT_res[1]} '
+          f'in one launch: {(time.perf_counter() - start) * 1000:.0f} ms')
+    return atlas
+
+
+def write_sky_atlas(atlas, data_format='rgb9e5'):
+    fmt = data.data_formats[data_format]
+    layers, height, width = atlas.shape[:3]
+    rgba = np.concatenate([atlas, np.ones_like(atlas[..., :1])], axis=-1)
+    data.write_data(data.encode(rgba, fmt), sky_atlas_path)
+    with open(sky_atlas_properties_path, 'w') as fout:
+        fout.write('# Generated by utils/sky_atlas.py, matches shaders/textures/sky_atlas.bin.\n')
+        fout.write(f'# world0/composite1.fsh: #define SKY_ATLAS 1, #define SKY_ATLAS_LAYERS {layers}\n')
+        fout.write(f'texture.composite.colortex14=textures/sky_atlas.bin TEXTURE_3D {fmt.internal_format} '
+                   f'{width} {height} {layers} {fmt.pixel_format} {fmt.pixel_type}\n')
+    size = os.path.getsize(sky_atlas_path)
+    print(f'wrote {sky_atlas_path} as {data_format} {width}x{height}x{layers} ({size / 2**20:.2f} MB)')
+    # Each march step of the shader reads the transmittance and multiple scattering LUTs.
+    print(f'per frame: {shader_sky_texels} atlas fetches instead of {shader_sky_texels * shader_sky_steps} march steps '
+          f'and {2 * shader_sky_texels * shader_sky_steps} LUT fetches')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends[:2], default=cfg.backend if cfg.backend != 'numpy' else 'taichi-cpu')
+    parser.add_argument('--layers', type=int, default=sky_atlas_layers, help='number of sun altitudes')
+    parser.add_argument('--format', choices=data.data_formats, default='rgb9e5', help='storage format of sky_atlas.bin')
+    args = parser.parse_args()
+
+    cfg.backend = args.backend
+    write_sky_atlas(bake_sky_atlas(layers=args.layers), args.format)
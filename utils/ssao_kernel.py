@@ -0,0 +1,140 @@
+import argparse
+import numpy as np
+
+# SSAO sample kernel and noise tile of the data texture, see data.py.
+#
+# Samples of world0/composite.fsh have the distribution the per sample rand()
+# calls had: cos zenith, azimuth and length uniform in [0, 1). Kernel texel i
+# holds sample i as the length times cos and sin of the azimuth, x along the
+# bitangent and y along the tangent, and the cos zenith. The samples are 3D
+# Sobol points, so for every SSAO_SAMPLE_NUM, a power of 2, the first samples
+# put one azimuth, one zenith and one length in each of that many intervals.
+#
+# Noise texel y * 16 + x holds, for the screen pixels at x, y modulo 16, the
+# rotation of the azimuths in turns and the shifts of the lengths and cos
+# zeniths, modulo 1, from three blue noise tiles. Every pixel still gets a
+# stratified kernel, neighbouring pixels get different ones, and the error
+# left is high frequency, which the SSAO blur of composite1/2 removes.
+#
+# Texels store the signed values v as 0.5 + 0.5 * v, so they fit every data.bin
+# format, the values in [0, 1) as they are.
+kernel_size = 256
+noise_size = 16
+# Primitive polynomials and initial direction numbers of the Sobol dimensions
+# after the first, see Joe and Kuo, "Constructing Sobol sequences with better
+# two-dimensional projections".
+sobol_polynomials = [(1, 0, [1]), (2, 1, [1, 3])]
+sobol_bits = 16
+blue_noise_sigma = 1.5
+
+
+def sobol(n):
+    # (n, 3) first points of the Sobol sequence, centered in their cells of n.
+    directions = [[1 << (sobol_bits - 1 - i) for i in range(sobol_bits)]]
+    for degree, a, m in sobol_polynomials:
+        v = [m_i << (sobol_bits - 1 - i) for i, m_i in enumerate(m)]
+        for i in range(degree, sobol_bits):
+            x = v[i - degree] ^ (v[i - degree] >> degree)
+            for k in range(1, degree):
+                if (a >> (degree - 1 - k)) & 1:
+                    x ^= v[i - k]
+            v.append(x)
+        directions.append(v)
+    points = np.zeros((n, 3), dtype=np.int64)
+    for i in range(1, n):
+        # Gray code order, each point flips the direction of the lowest zero bit of i - 1.
+        bit = ((i - 1) ^ i).bit_length() - 1
+        points[i] = points[i - 1] ^ np.array([d[bit] for d in directions])
+    return points / (1 << sobol_bits) + 0.5 / n
+
+
+def ssao_kernel(n=kernel_size):
+    # (n, 3): length times cos and sin of the azimuth, cos zenith.
+    y, theta, r = sobol(n).T
+    theta = 2 * np.pi * theta
+    return np.stack([r * np.cos(theta), r * np.sin(theta), y], axis=-1)
+
+
+def blue_noise(size=noise_size, seed=0, sigma=blue_noise_sigma):
+    # (size, size) tileable blue noise in (0, 1), by void and cluster
+    # (Ulichney 1993): pixels are ranked by adding the one in the largest void
+    # of a Gaussian filtered pattern, wrapping around the edges.
+    n = size * size
+    d = np.minimum(np.arange(size), size - np.arange(size))
+    kernel_f = np.fft.fft2(np.exp(-(d[:, None] ** 2 + d[None, :] ** 2) / (2 * sigma ** 2)))
+
+    def energy(pattern):
+        return np.fft.ifft2(np.fft.fft2(pattern) * kernel_f).real.ravel()
+
+    pattern = np.zeros((size, size))
+    pattern.flat[np.random.default_rng(seed).choice(n, n // 10, replace=False)] = 1
+    # Move the tightest cluster into the largest void until that is a no-op.
+    while True:
+        cluster = np.argmax(np.where(pattern.ravel() > 0, energy(pattern), -np.inf))
+        pattern.flat[cluster] = 0
+        void = np.argmin(np.where(pattern.ravel() > 0, np.inf, energy(pattern)))
+        pattern.flat[void] = 1
+        if void == cluster:
+            break
+    rank = np.zeros(n)
+    ones = int(pattern.sum())
+    p = pattern.copy()
+    for r in range(ones - 1, -1, -1):
+        cluster = np.argmax(np.where(p.ravel() > 0, energy(p), -np.inf))
+        p.flat[cluster] = 0
+        rank[cluster] = r
+    p = pattern.copy()
+    for r in range(ones, n):
+        void = np.argmin(np.where(p.ravel() > 0, np.inf, energy(p)))
+        p.flat[void] = 1
+        rank[void] = r
+    return ((rank + 0.5) / n).reshape(size, size)
+
+
+def ssao_noise(size=noise_size):
+    # (size, size, 3): azimuth rotation, length shift, cos zenith shift.
+    return np.stack([blue_noise(size, seed=seed) for seed in range(3)], axis=-1)
+
+
+def hemisphere_samples(kernel, noise):
+    # (..., n, 3) samples in the tangent frame of the kernel rotated and shifted
+    # by the noise texels (..., 3), as composite.fsh computes them.
+    r = np.linalg.norm(kernel[:, :2], axis=-1)
+    azimuth = kernel[:, :2] / np.maximum(r, 1e-4)[:, None]
+    angle = 2 * np.pi * noise[..., None, 0]
+    # The tangent is rotated towards the bitangent by angle.
+    x = np.cos(angle) * azimuth[:, 0] + np.sin(angle) * azimuth[:, 1]
+    z = np.cos(angle) * azimuth[:, 1] - np.sin(angle) * azimuth[:, 0]
+    r = np.mod(r + noise[..., None, 1], 1.0)
+    y = np.mod(kernel[:, 2] + noise[..., None, 2], 1.0)
+    xz = np.sqrt(1 - y * y)
+    return r[..., None] * np.stack([xz * x, y, xz * z], axis=-1)
+
+
+def encode(v):
+    return 0.5 + 0.5 * v
+
+
+def decode(texel):
+    return texel * 2 - 1
+
+
+def low_frequency_energy(tile):
+    # Share of the power of tile, without its mean, below half the Nyquist frequency.
+    f = np.abs(np.fft.fft2(tile - tile.mean())) ** 2
+    k = np.fft.fftfreq(tile.shape[0])
+    low = np.hypot(k[:, None], k[None, :]) < 0.25
+    return f[low].sum() / f.sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0, help='seed of the white noise to compare against')
+    args = parser.parse_args()
+
+    white = np.random.default_rng(args.seed).random((noise_size, noise_size))
+    print(f'low frequency energy: blue noise {low_frequency_energy(blue_noise()):.3f}, white noise {low_frequency_energy(white):.3f}')
+    # Largest gap between the sorted values of a coordinate, 1 / n when stratified.
+    for n in [4, 8, 16, 32, 64, 128, 256]:
+        gaps = np.diff(np.sort(sobol(kernel_size)[:n], axis=0), axis=0).max(axis=0)
+        print(f'{n:>4} samples: largest gap of cos zenith {gaps[0]:.4f}, azimuth / 2 pi {gaps[1]:.4f}, length {gaps[2]:.4f}')
@@ -1,14 +1,55 @@
-from matplotlib import pyplot as plt
+import argparse
 import numpy as np
+import imageio
 
-img = np.zeros((1, 512, 3), dtype=float)
+import atmosphere_config as cfg
+import atmosphere_lut
+import lut_interp
 
-for i in range(512):
-    m_time = i / 511 * np.pi - 0.5 * np.pi
-    r = 1 * (np.exp(0.001-0.001/(np.cos(0.99 * m_time))))
-    g = 1 * (np.exp(0.001-0.01/(np.cos(0.99 * m_time))))
-    b = 1 * (np.exp(0.001-0.03/(np.cos(0.99 * m_time))))
-    img[0, i] = [r, g, b]
+# Sun color ramp of the data texture, see data.py. Texel i holds the sun light
+# at the view height of world0/composite*.fsh with the sun at cos zenith
+# 2 * i / (width - 1) - 1: the transmittance of the baked tLUT averaged over
+# the sun disc, counting only the part of the disc above the horizon.
+sun_color_width = 256
+# viewPos of the shaders, in megameters above the ground.
+view_height = 0.0001
+# Angular radius of the sun disc the shaders draw, in radians.
+sun_radius = 2 * np.pi / 180
+disc_samples = 64
+sun_color_png_path = './utils/sun_color.png'
 
-plt.imshow(img, aspect='auto')
-plt.show()
+
+def sun_color_ramp(config, tLUT, width=sun_color_width):
+    # Returns the (width, 3) ramp. The disc is sampled on a Vogel spiral, only
+    # the elevation of a sample matters.
+    altitude = np.arcsin(np.linspace(-1, 1, width))
+    k = np.arange(disc_samples)
+    offset = sun_radius * np.sqrt((k + 0.5) / disc_samples) * np.sin(k * np.pi * (3 - np.sqrt(5)))
+    sample_altitude = np.clip(altitude[:, None] + offset, -0.5 * np.pi, 0.5 * np.pi)
+    horizon = -np.arccos(config.ground_radius / (config.ground_radius + view_height))
+    visible = (sample_altitude > horizon)[..., None]
+    u, v = lut_interp.lut_uv(config, config.ground_radius + view_height, np.sin(sample_altitude))
+    transmittance = lut_interp.sample(tLUT, u, v, config.lut_filter)
+    return (transmittance * visible).mean(axis=1)
+
+
+def write_preview(ramp, path=sun_color_png_path, height=32):
+    img = np.clip(np.repeat(ramp[None], height, axis=0), 0, 1) ** (1 / 2.2)
+    imageio.imwrite(path, (img * 255).astype(np.uint8))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=cfg.backends, default=cfg.backend, help='atmosphere LUT backend, defaults to $ATMO_BACKEND')
+    parser.add_argument('--out', default=sun_color_png_path, help='preview image of the ramp')
+    args = parser.parse_args()
+
+    cfg.backend = args.backend
+    tLUT, msLUT = atmosphere_lut.bake_luts(cfg.default_config)
+    ramp = sun_color_ramp(cfg.default_config, tLUT)
+    print(f'{"sun altitude":>12} {"r":>8} {"g":>8} {"b":>8}')
+    for degrees in [-4, -2, 0, 2, 5, 10, 30, 90]:
+        i = round((0.5 + 0.5 * np.sin(np.radians(degrees))) * (sun_color_width - 1))
+        print(f'{degrees:>12} {ramp[i, 0]:>8.4f} {ramp[i, 1]:>8.4f} {ramp[i, 2]:>8.4f}')
+    write_preview(ramp, args.out)
+    print(f'wrote {args.out}')
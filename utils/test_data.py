@@ -0,0 +1,69 @@
+import math
+import numpy as np
+
+import data
+
+
+# EXT_texture_shared_exponent, section 3.8.x "Encoding of special internal
+# formats", written out one texel at a time.
+N, B, E_max = 9, 15, 31
+sharedexp_max = (2**N - 1) / 2**N * 2**(E_max - B)
+
+
+def spec_encode(rgb):
+    rc = [max(0.0, min(sharedexp_max, c)) for c in rgb]
+    maxrgb = max(rc)
+    exp_shared_p = max(-B - 1, math.floor(math.log2(maxrgb)) if maxrgb > 0 else -B - 1) + 1 + B
+    max_s = math.floor(maxrgb / 2**(exp_shared_p - B - N) + 0.5)
+    exp_shared = exp_shared_p if max_s < 2**N else exp_shared_p + 1
+    rs, gs, bs = (math.floor(c / 2**(exp_shared - B - N) + 0.5) for c in rc)
+    return rs | gs << 9 | bs << 18 | exp_shared << 27
+
+
+def spec_decode(word):
+    exp = word >> 27
+    return [(word >> shift & 511) * 2.0**(exp - B - N) for shift in (0, 9, 18)]
+
+
+def test_rgb9e5_max_matches_spec():
+    assert data.rgb9e5_max == sharedexp_max
+
+
+def test_encode_rgb9e5_matches_spec():
+    rng = np.random.default_rng(0)
+    rgb = 2.0**rng.uniform(-30, 20, (4096, 3)) * rng.choice([0, 1, 1, 1, -1], (4096, 3))
+    words = data.encode_rgb9e5(rgb)
+    assert words.dtype == np.uint32
+    assert [int(w) for w in words] == [spec_encode(c) for c in rgb.tolist()]
+
+
+def test_rgb9e5_round_trip():
+    rng = np.random.default_rng(1)
+    rgb = 2.0**rng.uniform(-14, 15, (4096, 3))
+    words = data.encode_rgb9e5(rgb)
+    decoded = data.decode_rgb9e5(words)
+    np.testing.assert_array_equal(decoded, [spec_decode(int(w)) for w in words])
+    # Rounded to half a step of the shared exponent, which is at most 2^-9 of the largest channel.
+    assert np.all(np.abs(decoded - rgb) <= rgb.max(axis=-1, keepdims=True) * 2.0**-N)
+
+
+def test_rgb9e5_representable_values_are_exact():
+    rgb = np.array([[0.0, 0.0, 0.0], [1.0, 0.5, 0.25], [511.0, 3.0, 0.0], [2.0**-24, 0.0, 2.0**-23]])
+    np.testing.assert_array_equal(data.decode_rgb9e5(data.encode_rgb9e5(rgb)), rgb)
+
+
+def test_rgb9e5_max():
+    words = data.encode_rgb9e5(np.array([[data.rgb9e5_max] * 3, [1e10, np.inf, data.rgb9e5_max * 2]]))
+    assert [int(w) for w in words] == [511 | 511 << 9 | 511 << 18 | 31 << 27] * 2
+    np.testing.assert_array_equal(data.decode_rgb9e5(words), data.rgb9e5_max)
+
+
+def test_rgb9e5_rounding_carry():
+    # The red mantissa rounds up to 512 at exponent 15, so the shared exponent
+    # goes up by one and red becomes 256 at the coarser step.
+    rgb = np.array([1 - 2.0**-11, 0.25, 2.0**-12])
+    word = int(data.encode_rgb9e5(rgb))
+    assert word == spec_encode(rgb.tolist())
+    assert word >> 27 == 16
+    assert word & 511 == 256
+    np.testing.assert_array_equal(data.decode_rgb9e5(np.uint32(word)), [1.0, 0.25, 0.0])
@@ -0,0 +1,69 @@
+import dataclasses
+import numpy as np
+import pytest
+
+import atmosphere_config as cfg
+import lut_interp
+
+
+def random_lut(shape=(5, 7), seed=0):
+    # Steps between neighbouring texels, where an unclamped Catmull-Rom overshoots.
+    rng = np.random.default_rng(seed)
+    return rng.random((*shape, 3)) * rng.choice([0.01, 1.0, 100.0], (*shape, 1))
+
+
+def random_uv(points=4096, seed=1):
+    # Some points outside [0, 1], lookups clamp to the edge texels.
+    return np.random.default_rng(seed).uniform(-0.1, 1.1, (2, points))
+
+
+@pytest.mark.parametrize('lut_filter', cfg.lut_filters)
+def test_sample_hits_texels(lut_filter):
+    lut = random_lut()
+    h, w = lut.shape[:2]
+    v, u = np.meshgrid(np.arange(h) / (h - 1), np.arange(w) / (w - 1), indexing='ij')
+    np.testing.assert_allclose(lut_interp.sample(lut, u, v, lut_filter), lut, rtol=1e-12, atol=0)
+
+
+def test_cubic_stays_within_texels():
+    lut = random_lut()
+    h, w = lut.shape[:2]
+    u, v = random_uv()
+    i, _ = lut_interp.texel_coords(u, w)
+    j, _ = lut_interp.texel_coords(v, h)
+    texels = np.stack([lut[j, i], lut[j, i + 1], lut[j + 1, i], lut[j + 1, i + 1]])
+    res = lut_interp.sample(lut, u, v, 'cubic')
+    assert np.all(res >= texels.min(axis=0))
+    assert np.all(res <= texels.max(axis=0))
+
+
+def test_sample_rejects_unknown_filter():
+    with pytest.raises(ValueError):
+        lut_interp.sample(random_lut(), 0.5, 0.5, 'nearest')
+
+
+@pytest.mark.parametrize('lut_filter', cfg.lut_filters)
+def test_sample_matches_taichi(lut_filter, monkeypatch):
+    ti = pytest.importorskip('taichi')
+    # Like every bake here, on the CPU; the precision is fixed by the first init of the process.
+    monkeypatch.setattr(cfg, 'backend', 'taichi-cpu')
+    import atmosphere_taichi
+    atmosphere_taichi.set_params(dataclasses.replace(cfg.default_config, lut_filter=lut_filter))
+
+    lut = random_lut()
+    u, v = random_uv()
+    texture = atmosphere_taichi.vec3f.field(shape=lut.shape[1::-1])
+    texture.from_numpy(lut.transpose(1, 0, 2))
+    uv = atmosphere_taichi.vec2f.field(shape=u.shape)
+    uv.from_numpy(np.stack([u, v], axis=-1))
+    res = atmosphere_taichi.vec3f.field(shape=u.shape)
+
+    @ti.kernel
+    def sample_kernel():
+        for k in uv:
+            res[k] = atmosphere_taichi.lut_sample(texture, uv[k][0], uv[k][1])
+
+    sample_kernel()
+    tolerance = 1e-12 if atmosphere_taichi.precision == 'f64' else 1e-5
+    np.testing.assert_allclose(res.to_numpy(), lut_interp.sample(lut, u, v, lut_filter),
+                               rtol=tolerance, atol=tolerance * np.abs(lut).max())